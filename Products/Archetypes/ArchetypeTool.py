@@ -25,6 +25,12 @@ from Products.Archetypes.utils import findDict
 from Products.Archetypes.utils import DisplayList
 from Products.Archetypes.utils import mapply
 from Products.Archetypes.Renderer import renderer
+from Products.Archetypes.consistency import checkConsistency
+from Products.Archetypes.extraction import reindexContent
+from Products.Archetypes.indexing import AsyncIndexQueue
+from Products.Archetypes.indexing import memoStats
+from Products.Archetypes.indexing import processIndexingQueue
+from Products.Archetypes.indexing import processQueue
 
 from Products.CMFCore import permissions
 from Products.CMFCore.ActionProviderBase import ActionProviderBase
@@ -1033,6 +1039,48 @@ class ArchetypeTool(UniqueObject, ActionProviderBase, \
         if not o._isSchemaCurrent():
             self._removeSchemaAndUpdateObject(o, path)
 
+    # Objects or catalog entries checked in one transaction by
+    # checkConsistency
+    consistency_chunk_size = 500
+    _consistency_state = None
+
+    security.declareProtected(permissions.ManagePortal,
+                              'manage_checkConsistency')
+    def manage_checkConsistency(self, repair=False, steps=1, chunk_size=None,
+                                restart=False):
+        """Check the next chunks of the consistency check within the
+        current transaction, see checkConsistency.
+        """
+        return self.checkConsistency(repair=bool(repair), steps=int(steps),
+                                     chunk_size=chunk_size,
+                                     restart=bool(restart))
+
+    security.declarePrivate('checkConsistency')
+    def checkConsistency(self, repair=False, steps=1, chunk_size=None,
+                         restart=False, commit=False):
+        """Cross check the uid catalog, the reference catalog and the content
+
+        Counts the uid catalog entries whose path doesn't lead to their
+        object, the reference catalog entries without reference, the
+        references pointing to an unknown UID and the referenceable objects
+        missing from the uid catalog. With repair, these entries are
+        uncataloged, the references deleted and the objects cataloged.
+
+        Every call checks at most steps chunks of chunk_size, separated by
+        savepoints, or with commit each committed on its own, and returns.
+        Only commit from scripts, not from a request. Its state is kept on
+        the tool: calling it again continues an incomplete check, or starts
+        a new one, so it is meant to be called over and over by a worker,
+        like processIndexingQueue, without getting in the way of editors.
+        restart gives up an incomplete check.
+
+        Returns the counts of the check and whether it is complete.
+        """
+        return checkConsistency(self, repair=bool(repair),
+            max_steps=int(steps),
+            chunk_size=int(chunk_size or self.consistency_chunk_size),
+            restart=bool(restart), commit=commit)
+
     security.declareProtected(permissions.ManagePortal,
                               'manage_updateSchema')
     def manage_migrate(self, REQUEST=None):
@@ -1044,6 +1092,11 @@ class ArchetypeTool(UniqueObject, ActionProviderBase, \
         return out
 
     # Catalog management
+
+    # The ids of the catalogs updated asynchronously, see setAsyncCatalogs
+    async_catalogs = ()
+    _indexing_queue = None
+
     security.declareProtected(permissions.View,
                               'listCatalogs')
     def listCatalogs(self):
@@ -1076,11 +1129,110 @@ class ArchetypeTool(UniqueObject, ActionProviderBase, \
             Each catalog is has to be a tool, means unique in site root.
         """
         self.catalog_map[portal_type] = catalogList
+        self._v_catalogs_by_type = None
+
+    security.declareProtected(permissions.ManagePortal, 'getAsyncCatalogs')
+    def getAsyncCatalogs(self):
+        """Ids of the catalogs updated asynchronously
+        """
+        return self.async_catalogs
+
+    security.declareProtected(permissions.ManagePortal, 'setAsyncCatalogs')
+    def setAsyncCatalogs(self, catalogList):
+        """Update the catalogs of catalogList asynchronously.
+
+        Their catalog operations are queued persistently and performed by
+        processIndexingQueue, so they lag behind the content. The uid
+        catalog, which references are resolved with, is always updated
+        synchronously.
+        """
+        self.async_catalogs = tuple([name for name in catalogList
+                                     if name != UID_CATALOG])
+
+    security.declarePrivate('getIndexingQueue')
+    def getIndexingQueue(self):
+        if self._indexing_queue is None:
+            self._indexing_queue = AsyncIndexQueue()
+        return self._indexing_queue
+
+    security.declareProtected(permissions.ManagePortal,
+                              'manage_processIndexingQueue')
+    def manage_processIndexingQueue(self, batch_size=100, max_batches=10):
+        """Perform the next queued operations of the asynchronous catalogs
+        within the current transaction, e.g. from a clock server.
+        """
+        return self.processIndexingQueue(int(batch_size), int(max_batches))
+
+    security.declarePrivate('processIndexingQueue')
+    def processIndexingQueue(self, batch_size=100, max_batches=None,
+                             commit=False):
+        """Perform the queued operations of the asynchronous catalogs.
+
+        The batches of batch_size records are separated by savepoints, or
+        with commit each committed on its own. Only commit from a worker
+        which isn't published: a script run with "bin/instance run" or a
+        thread of a dedicated instance.
+        """
+        return processIndexingQueue(self, batch_size, max_batches,
+                                    commit=commit)
+
+    security.declareProtected(permissions.ManagePortal, 'drainIndexingQueue')
+    def drainIndexingQueue(self):
+        """Perform all queued operations of the asynchronous catalogs now,
+        within the current transaction.
+        """
+        processQueue()
+        return processIndexingQueue(self, 1000, commit=False)
+
+    security.declareProtected(permissions.ManagePortal,
+                              'manage_reindexContent')
+    def manage_reindexContent(self, batch_size=50, workers=None):
+        """Reindex all Archetypes content in its catalogs, within the
+        current transaction.
+        """
+        if workers is not None:
+            workers = int(workers)
+        return self.reindexContent(batch_size=int(batch_size),
+                                   workers=workers)
+
+    security.declarePrivate('reindexContent')
+    def reindexContent(self, batch_size=50, workers=None, commit=False):
+        """Reindex all Archetypes content in its catalogs.
+
+        The text of the file fields of the next batch of objects is
+        extracted by worker threads while a batch is reindexed, see
+        extraction.py. After every batch a savepoint is made, or with
+        commit the transaction is committed. Only commit from scripts, not
+        from a request. Returns the number of objects reindexed.
+        """
+        return reindexContent(self, batch_size=batch_size, workers=workers,
+                              commit=commit)
+
+    security.declareProtected(permissions.ManagePortal,
+                              'getIndexableMemoStats')
+    def getIndexableMemoStats(self):
+        """How many index and metadata values were computed, and how many
+        reused for another catalog, since startup.
+        """
+        return memoStats()
 
     security.declareProtected(permissions.View, 'getCatalogsByType')
     def getCatalogsByType(self, portal_type):
         """Return the catalog objects assoicated with a given type.
         """
+        # every (re|un)indexObject asks, so the catalogs are remembered
+        # until the end of the transaction
+        txn = transaction.get()
+        cache = getattr(self, '_v_catalogs_by_type', None)
+        if cache is None or cache[0] is not txn:
+            cache = self._v_catalogs_by_type = (txn, {})
+        catalogs = cache[1].get(portal_type)
+        if catalogs is None:
+            catalogs = cache[1][portal_type] = \
+                self._getCatalogsByType(portal_type)
+        return list(catalogs)
+
+    def _getCatalogsByType(self, portal_type):
         catalogs = []
         catalog_map = getattr(self, 'catalog_map', None)
         if catalog_map is not None:
@@ -1,8 +1,12 @@
 import os.path
+from hashlib import sha1
 from zope.interface import implements
 
 from Products.Archetypes.interfaces import IBaseUnit
 from Products.Archetypes.log import log
+from Products.Archetypes.transformcache import NO_TRANSFORM
+from Products.Archetypes.transformcache import transform_cache
+from Products.Archetypes.transformcache import transformChain
 from Products.Archetypes.utils import shasattr
 from logging import ERROR
 
@@ -96,35 +100,63 @@ class BaseUnit(File):
         if not getattr(instance, 'aq_parent', None) is not None:
             return orig
 
+        portal_encoding = kwargs.get('encoding', None) or \
+                          self.portalEncoding(instance)
+        digest = self._rawDigest(orig)
         transformer = getToolByName(instance, 'portal_transforms')
-        data = transformer.convertTo(mt, orig, object=self, usedby=self.id,
-                                     context=instance,
-                                     mimetype=self.mimetype,
-                                     filename=self.filename)
-
-        if data:
-            _data = data.getData()
-            instance.addSubObjects(data.getSubObjects())
-            portal_encoding = kwargs.get('encoding', None) or \
-                              self.portalEncoding(instance)
-            encoding = data.getMetadata().get("encoding") or encoding \
-                       or portal_encoding
-            if portal_encoding != encoding:
-                _data = unicode(_data, encoding).encode(portal_encoding)
-            return _data
+        chain = transformChain(transformer, self.mimetype, mt)
+        key = (str(self.mimetype), mt, portal_encoding,
+               instance.absolute_url(), chain)
+        data = None
+        if chain is not None:
+            data = transform_cache.get(digest, key)
+        if data is None:
+            data, subobjects = self._convert(transformer, instance, mt, orig,
+                                             portal_encoding)
+            if not subobjects and chain is not None:
+                # subobjects are only added to the instance by transforming
+                transform_cache.set(digest, key, data)
+        if data is not NO_TRANSFORM:
+            return data
 
         # we have not been able to transform data
         # return the raw data if it's not binary data
         # FIXME: is this really the behaviour we want ?
         if not self.isBinary():
-            portal_encoding = kwargs.get('encoding', None) or \
-                              self.portalEncoding(instance)
             if portal_encoding != encoding:
                 orig = self.getRaw(portal_encoding)
             return orig
 
         return None
 
+    def _convert(self, transformer, instance, mt, orig, portal_encoding):
+        """Transform orig to the mimetype mt
+
+        Returns the data, or NO_TRANSFORM if there is no way to mt, and the
+        subobjects added to the instance.
+        """
+        data = transformer.convertTo(mt, orig, object=self, usedby=self.id,
+                                     context=instance,
+                                     mimetype=self.mimetype,
+                                     filename=self.filename)
+        if not data:
+            return NO_TRANSFORM, None
+
+        _data = data.getData()
+        subobjects = data.getSubObjects()
+        instance.addSubObjects(subobjects)
+        encoding = data.getMetadata().get("encoding") or \
+                   self.original_encoding or portal_encoding
+        if portal_encoding != encoding:
+            _data = unicode(_data, encoding).encode(portal_encoding)
+        return _data, subobjects
+
+    def _rawDigest(self, orig):
+        digest = getattr(self, '_v_raw_digest', None)
+        if digest is None:
+            digest = self._v_raw_digest = sha1(orig).hexdigest()
+        return digest
+
     def __str__(self):
         return self.getRaw()
 
@@ -222,6 +254,10 @@ class BaseUnit(File):
     def _cacheExpire(self):
         if shasattr(self, '_v_transform_cache'):
             delattr(self, '_v_transform_cache')
+        digest = getattr(self, '_v_raw_digest', None)
+        if digest is not None:
+            transform_cache.invalidate(digest)
+            del self._v_raw_digest
 
     ### index_html
     security.declareProtected(permissions.View, "index_html")
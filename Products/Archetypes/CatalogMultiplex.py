@@ -1,4 +1,7 @@
-from logging import WARNING
+from itertools import islice
+from logging import INFO, WARNING
+
+import transaction
 
 from Acquisition import aq_base
 from AccessControl import ClassSecurityInfo
@@ -7,7 +10,14 @@ from Products.CMFCore.utils import getToolByName
 from Products.CMFCore.interfaces import ICatalogTool
 from Products.CMFCore.permissions import ModifyPortalContent
 from Products.CMFCore.CMFCatalogAware import CatalogAware, WorkflowAware, OpaqueItemManager
+from Products.Archetypes import config
 from Products.Archetypes.config import CATALOGMAP_USES_PORTALTYPE, TOOL_NAME
+from Products.Archetypes.indexing import INDEX, REINDEX, UNINDEX
+from Products.Archetypes.indexing import deferCatalogs
+from Products.Archetypes.indexing import getQueue
+from Products.Archetypes.indexing import indexables
+from Products.Archetypes.indexing import processQueue
+from Products.Archetypes.indexing import queueIndexing
 from Products.Archetypes.log import log
 from Products.Archetypes.Referenceable import Referenceable
 from Products.Archetypes.utils import shasattr, isFactoryContained
@@ -33,17 +43,27 @@ class CatalogMultiplex(CatalogAware, WorkflowAware, OpaqueItemManager):
     def indexObject(self):
         if isFactoryContained(self):
             return
-        catalogs = self.getCatalogs()
-        url = self.__url()
-        for c in catalogs:
-            c.catalog_object(self, url)
+        if queueIndexing():
+            getQueue().index(self, self.__url())
+        else:
+            self._indexObject(self.__url())
+
+    def _indexObject(self, url):
+        catalogs = deferCatalogs(self, self.getCatalogs(), INDEX, url)
+        for c, indexable in indexables(self, catalogs):
+            c.catalog_object(indexable, url)
 
     security.declareProtected(ModifyPortalContent, 'unindexObject')
     def unindexObject(self):
         if isFactoryContained(self):
             return
-        catalogs = self.getCatalogs()
-        url = self.__url()
+        if queueIndexing():
+            getQueue().unindex(self, self.__url())
+        else:
+            self._unindexObject(self.__url())
+
+    def _unindexObject(self, url):
+        catalogs = deferCatalogs(self, self.getCatalogs(), UNINDEX, url)
         for c in catalogs:
             if c._catalog.uids.get(url, None) is not None:
                 c.uncatalog_object(url)
@@ -51,36 +71,106 @@ class CatalogMultiplex(CatalogAware, WorkflowAware, OpaqueItemManager):
     security.declareProtected(ModifyPortalContent, 'reindexObjectSecurity')
     def reindexObjectSecurity(self, skip_self=False):
         """update security information in all registered catalogs.
+
+        The subtree is updated in batches of sorted paths with a savepoint
+        in between, objects are turned into ghosts again once their batch
+        is done. Past config.SECURITY_REINDEX_LIMIT objects the rest of the
+        subtree is queued for the asynchronous indexing queue. Returns the
+        number of catalog entries updated.
         """
         if isFactoryContained(self):
-            return
-        at = getToolByName(self, TOOL_NAME, None)
-        if at is None:
-            return
+            return 0
+        # the subtree is read from the catalogs
+        processQueue()
 
-        catalogs = [c for c in at.getCatalogsByType(self.meta_type)
+        catalogs = [c for c in self.getCatalogs()
                                if ICatalogTool.providedBy(c)]
         path = self.__url()
+        idxs = list(self._cmf_security_indexes)
+        limit = config.SECURITY_REINDEX_LIMIT
+        updated = deferred = 0
 
         for catalog in catalogs:
-            for brain in catalog.unrestrictedSearchResults(path=path):
-                brain_path = brain.getPath()
-                if brain_path == path and skip_self:
-                    continue
-                # Get the object
-                if hasattr(aq_base(brain), '_unrestrictedGetObject'):
-                    try:
-                        ob = brain._unrestrictedGetObject()
-                    except (KeyError, AttributeError):
-                        ob = None
-                if ob is None:
-                    log("reindexObjectSecurity: Cannot get %s from catalog" %
-                        brain_path, level=WARNING)
-                    continue
-
-                # Recatalog with the same catalog uid.
-                catalog.reindexObject(ob, idxs=self._cmf_security_indexes,
-                                        update_metadata=0, uid=brain_path)
+            cursor = None
+            while True:
+                batch = self._subtreePaths(catalog, path, cursor)
+                if not batch:
+                    break
+                cursor = batch[-1]
+                if limit and updated >= limit:
+                    deferred += self._deferSecurity(catalog, path, batch,
+                                                    idxs)
+                    break
+                objects = self._subtreeObjects(batch)
+                for brain_path in batch:
+                    if brain_path == path and skip_self:
+                        continue
+                    ob = objects.get(brain_path)
+                    if ob is None:
+                        log("reindexObjectSecurity: Cannot get %s from "
+                            "catalog" % brain_path, level=WARNING)
+                        continue
+
+                    # Recatalog with the same catalog uid.
+                    catalog.reindexObject(ob, idxs=idxs,
+                                          update_metadata=0, uid=brain_path)
+                    updated += 1
+                transaction.savepoint(optimistic=True)
+                for ob in objects.values():
+                    base = aq_base(ob)
+                    if base is not aq_base(self) and \
+                           getattr(base, '_p_changed', None) is False:
+                        base._p_deactivate()
+
+        if deferred:
+            log("reindexObjectSecurity: updated %s objects below %s, "
+                "queued %s" % (updated, path, deferred), level=INFO)
+        return updated
+
+    def _subtreePaths(self, catalog, path, cursor=None):
+        """The next batch of cataloged paths of path and below
+        """
+        uids = catalog._catalog.uids
+        batch = []
+        if cursor is None:
+            if uids.get(path, None) is not None:
+                batch.append(path)
+            keys = uids.keys(min=path + '/', max=path + '/\xff')
+        else:
+            keys = uids.keys(min=cursor, max=path + '/\xff',
+                             excludemin=True)
+        size = config.SECURITY_REINDEX_BATCH_SIZE - len(batch)
+        batch.extend(islice(keys, size))
+        return batch
+
+    def _subtreeObjects(self, paths):
+        """Map sorted paths to objects, traversing every container once
+        """
+        root = self.getPhysicalRoot()
+        objects = {}
+        for path in paths:
+            parent, _, name = path.rpartition('/')
+            container = objects.get(parent)
+            if container is None:
+                ob = root.unrestrictedTraverse(path, None)
+            else:
+                ob = container.unrestrictedTraverse(name, None)
+            objects[path] = ob
+        return objects
+
+    def _deferSecurity(self, catalog, path, batch, idxs):
+        """Queue the security update of batch and the paths following it
+        """
+        queue = getToolByName(self, TOOL_NAME).getIndexingQueue()
+        catalog_id = catalog.getId()
+        count = 0
+        while batch:
+            for brain_path in batch:
+                queue.put(brain_path, REINDEX, idxs, [catalog_id],
+                          update_metadata=0)
+            count += len(batch)
+            batch = self._subtreePaths(catalog, path, batch[-1])
+        return count
 
     security.declareProtected(ModifyPortalContent, 'reindexObject')
     def reindexObject(self, idxs=None):
@@ -103,21 +193,25 @@ class CatalogMultiplex(CatalogAware, WorkflowAware, OpaqueItemManager):
 
         self.http__refreshEtag()
 
+        if queueIndexing():
+            getQueue().reindex(self, self.__url(), idxs)
+        else:
+            self._reindexObject(self.__url(), idxs)
+
+    def _reindexObject(self, url, idxs):
         catalogs = self.getCatalogs()
         if not catalogs:
             return
 
-        url = self.__url()
-
-        for c in catalogs:
-            if c is not None:
-                # We want the intersection of the catalogs idxs
-                # and the incoming list.
-                lst = idxs
-                indexes = c.indexes()
-                if idxs:
-                    lst = [i for i in idxs if i in indexes]
-                c.catalog_object(self, url, idxs=lst)
+        catalogs = deferCatalogs(self, catalogs, REINDEX, url, idxs)
+        for c, indexable in indexables(self, catalogs):
+            # We want the intersection of the catalogs idxs
+            # and the incoming list.
+            lst = idxs
+            indexes = c.indexes()
+            if idxs:
+                lst = [i for i in idxs if i in indexes]
+            c.catalog_object(indexable, url, idxs=lst)
 
         # We only make this call if idxs is not passed.
         #
@@ -9,6 +9,7 @@ from Products.Archetypes.setuphandlers import install_uidcatalog
 from Products.Archetypes.config import TOOL_NAME, REFERENCE_CATALOG, \
     UID_CATALOG, UUID_ATTR
 from Products.Archetypes.interfaces.base import IBaseObject
+from Products.Archetypes.utils import shasattr
 
 # WARNING!
 # Using full transactions after every migration step may be dangerous but it's
@@ -263,6 +264,75 @@ def migrateCatalogIndexes(portal, out):
     [addIndex(rc, n, t) for n, t in add_indexes]
 
 
+def migrateReferenceAdjacency(portal, out):
+    rc = getToolByName(portal, REFERENCE_CATALOG)
+    print >>out, 'Building reference adjacency index'
+    count = rc.manage_rebuildAdjacency()
+    print >>out, "%s references indexed." % count
+
+    if USE_FULL_TRANSACTIONS:
+        transaction.commit()
+    else:
+        transaction.savepoint(optimistic=True)
+
+
+def migrateReferenceAnnotations(portal, out):
+    """Move the at_references of all sources into BTreeFolder2 containers
+    """
+    rc = getToolByName(portal, REFERENCE_CATALOG)
+    print >>out, 'Migrating reference annotations to BTree folders'
+    count = 0
+    for uid in rc.uniqueValuesFor('sourceUID'):
+        source = rc.lookupObject(uid)
+        if source is None or not shasattr(source, '_migrateReferenceAnnotations'):
+            continue
+        if source._migrateReferenceAnnotations():
+            count += 1
+            if not count % 10:
+                print >>out, '.',
+            # avoid eating up all RAM
+            if not count % 250:
+                print >>out, '*',
+                transaction.savepoint(optimistic=True)
+
+    if USE_FULL_TRANSACTIONS:
+        transaction.commit()
+    else:
+        transaction.savepoint(optimistic=True)
+    print >>out, "\n%s reference annotations migrated." % count
+
+
+def migrateBlobs(portal, out):
+    """Move the files of fields with a blob content_class into blobs
+    """
+    uc = getToolByName(portal, UID_CATALOG)
+    rc = getToolByName(portal, REFERENCE_CATALOG)
+    print >>out, 'Migrating file and image fields to blobs'
+    count = 0
+    for uid in uc.uniqueValuesFor('UID'):
+        obj = rc.lookupObject(uid)
+        if obj is None or not IBaseObject.providedBy(obj):
+            continue
+        moved = 0
+        for field in obj.Schema().fields():
+            if shasattr(field, 'migrateToBlob'):
+                moved += field.migrateToBlob(obj)
+        if moved:
+            count += 1
+            if not count % 10:
+                print >>out, '.',
+            # avoid eating up all RAM
+            if not count % 250:
+                print >>out, '*',
+                transaction.savepoint(optimistic=True)
+
+    if USE_FULL_TRANSACTIONS:
+        transaction.commit()
+    else:
+        transaction.savepoint(optimistic=True)
+    print >>out, "\n%s objects migrated to blobs." % count
+
+
 def refreshCatalogs(portal, out):
     uc = getToolByName(portal, UID_CATALOG)
     rc = getToolByName(portal, REFERENCE_CATALOG)
@@ -292,5 +362,8 @@ def migrate(self):
     removeOldUIDs(portal, out)
     migrateCatalogIndexes(portal, out)
     refreshCatalogs(portal, out)
+    migrateReferenceAdjacency(portal, out)
+    migrateReferenceAnnotations(portal, out)
+    migrateBlobs(portal, out)
     print >>out, "Archetypes Migration Successful"
     return out.getvalue()
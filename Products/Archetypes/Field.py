@@ -1,6 +1,7 @@
 from copy import deepcopy
 from cgi import escape
-from cStringIO import StringIO
+from hashlib import sha1
+from tempfile import SpooledTemporaryFile
 from logging import ERROR, DEBUG
 from types import ClassType, FileType, StringType, UnicodeType
 
@@ -22,11 +23,17 @@ from DateTime import DateTime
 from DateTime.DateTime import safelocaltime
 from DateTime.interfaces import DateTimeError
 from ExtensionClass import Base
+from Persistence import PersistentMapping
 from OFS.Image import File
 from OFS.Image import Pdata
 from OFS.Image import Image as BaseImage
+from OFS.Image import getImageInfo
 from OFS.interfaces import ITraversable
+from ZPublisher.HTTPRangeSupport import expandRanges
+from ZPublisher.HTTPRangeSupport import parseRange
 from ZPublisher.HTTPRequest import FileUpload
+from App.Common import rfc1123_date
+from ZODB.utils import z64
 from ZODB.POSException import ConflictError
 
 from Products.CMFCore.utils import getToolByName
@@ -69,8 +76,17 @@ from Products.Archetypes.Widget import LinesWidget
 from Products.Archetypes.Widget import StringWidget
 from Products.Archetypes.Widget import ReferenceWidget
 from Products.Archetypes.BaseUnit import BaseUnit
+from Products.Archetypes.blobs import BlobFile
+from Products.Archetypes.blobs import CHUNK_SIZE
 from Products.Archetypes.ReferenceEngine import Reference
 from Products.Archetypes.log import log
+from Products.Archetypes.extraction import extractText
+from Products.Archetypes.extraction import extractedText
+from Products.Archetypes.extraction import indexableKey
+from Products.Archetypes.extraction import limitText
+from Products.Archetypes.imagescaling import ImageScaler
+from Products.Archetypes.imagescaling import fitSize
+from Products.Archetypes.transformcache import transform_cache
 from Products.Archetypes.utils import DisplayList
 from Products.Archetypes.utils import IntDisplayList
 from Products.Archetypes.utils import Vocabulary
@@ -78,9 +94,13 @@ from Products.Archetypes.utils import className
 from Products.Archetypes.utils import mapply
 from Products.Archetypes.utils import shasattr
 from Products.Archetypes.utils import contentDispositionHeader
+from Products.Archetypes.WebDAVSupport import PdataStreamIterator
+from Products.Archetypes.WebDAVSupport import rangesResponse
 from Products.Archetypes.mimetype_utils import getAllowedContentTypes as getAllowedContentTypesProperty
 from Products.Archetypes import config
 from Products.Archetypes.Storage import AttributeStorage
+from Products.Archetypes.annotations import AT_IMAGE_SCALES
+from Products.Archetypes.annotations import getAnnotation
 from Products.Archetypes.Storage import ObjectManagedStorage
 from Products.Archetypes.Storage import ReadOnlyStorage
 from Products.Archetypes.Registry import setSecurity
@@ -119,6 +139,8 @@ STRING_TYPES = [StringType, UnicodeType]
 
 _marker = []
 CHUNK = 1 << 14
+# data indexed by FileField is spooled to disk past this size
+SPOOL_SIZE = 1 << 20
 
 __docformat__ = 'reStructuredText'
 
@@ -987,6 +1009,7 @@ class FileField(ObjectField):
         if file is None:
             file = self._make_file(self.getName(), title='',
                                    file='', instance=instance)
+        opened = None
         if IBaseUnit.providedBy(value):
             mimetype = value.getContentType() or mimetype
             filename = value.getFilename() or filename
@@ -999,7 +1022,10 @@ class FileField(ObjectField):
             # In case someone changes the 'content_class'
             filename = getattr(value, 'filename', value.getId())
             mimetype = getattr(value, 'content_type', mimetype)
-            value = value.data
+            if isinstance(aq_base(value), BlobFile):
+                value = opened = value.open()
+            else:
+                value = value.data
         elif isinstance(value, FileUpload) or shasattr(value, 'filename'):
             filename = value.filename
         elif isinstance(value, FileType) or shasattr(value, 'name'):
@@ -1030,11 +1056,18 @@ class FileField(ObjectField):
         filename = filename[max(filename.rfind('/'),
                                 filename.rfind('\\'),
                                 filename.rfind(':')) + 1:]
-        file.manage_upload(value)
+        try:
+            file.manage_upload(value)
+        finally:
+            if opened is not None:
+                opened.close()
         if mimetype is None or mimetype == 'text/x-unknown-content-type':
-            body = file.data
-            if not isinstance(body, basestring):
-                body = body.data
+            if isinstance(aq_base(file), BlobFile):
+                body = file.head()
+            else:
+                body = file.data
+                if not isinstance(body, basestring):
+                    body = body.data
             mtr = getToolByName(instance, 'mimetypes_registry', None)
             if mtr is not None:
                 kw = {'mimetype': None,
@@ -1187,7 +1220,12 @@ class FileField(ObjectField):
             filename = ''  # self.getName()
         mimetype = self.getContentType(instance, fromBaseUnit=False)
         value = self.getRaw(instance) or self.getDefault(instance)
-        if isinstance(aq_base(value), File):
+        if isinstance(aq_base(value), BlobFile):
+            if full:
+                value = value.data
+            else:
+                value = value.head()
+        elif isinstance(aq_base(value), File):
             value = value.data
             if full:
                 # This will read the whole file in memory, which is
@@ -1239,15 +1277,20 @@ class FileField(ObjectField):
     def download(self, instance, REQUEST=None, RESPONSE=None, no_output=False):
         """Kicks download.
 
-        Writes data including file name and content type to RESPONSE
+        Writes data including file name and content type to RESPONSE.
+        Conditional requests are answered with 304 before the data is
+        read, single and multiple byte ranges are supported.
         """
         file = self.get(instance, raw=True)
         if not REQUEST:
             REQUEST = aq_get(instance, 'REQUEST')
         if not RESPONSE:
             RESPONSE = REQUEST.RESPONSE
-        filename = self.getFilename(instance)
+        # not getFilename, which builds a base unit from the data
+        filename = getattr(aq_base(file), 'filename', None)
         if filename is not None:
+            # taking care of stupid IE
+            filename = filename.split("\\")[-1]
             if FILE_NORMALIZER:
                 filename = IUserPreferredFileNameNormalizer(REQUEST).normalize(
                     unicode(filename, instance.getCharset()))
@@ -1259,7 +1302,102 @@ class FileField(ObjectField):
             RESPONSE.setHeader("Content-Disposition", header_value)
         if no_output:
             return file
-        return file.index_html(REQUEST, RESPONSE)
+
+        base = aq_base(file)
+        if isinstance(base, BaseUnit):
+            data = file.getRaw(encoding=file.original_encoding)
+        elif isinstance(base, BlobFile):
+            # opened when a range of it is asked for
+            data = None
+        elif isinstance(base, File):
+            data = base.data
+        else:
+            return file.index_html(REQUEST, RESPONSE)
+
+        etag = self._downloadETag(file)
+        mtime = getattr(base, '_p_mtime', None)
+        if etag is not None:
+            RESPONSE.setHeader('ETag', etag)
+        if mtime is not None:
+            RESPONSE.setHeader('Last-Modified', rfc1123_date(mtime))
+        RESPONSE.setHeader('Accept-Ranges', 'bytes')
+        if self._notModified(REQUEST, etag, mtime):
+            RESPONSE.setStatus(304)
+            return ''
+
+        content_type = str(file.getContentType())
+        if isinstance(data, str):
+            size = len(data)
+        else:
+            size = file.get_size()
+        ranges = None
+        header = REQUEST.get_header('Range', None)
+        if header is not None and self._ifRange(REQUEST, etag, mtime):
+            ranges = parseRange(header)
+        if ranges is not None:
+            ranges = expandRanges(ranges, size)
+            if data is not None or not ranges:
+                return rangesResponse(RESPONSE, data, size, ranges,
+                                      content_type)
+            f = base.open()
+            try:
+                return rangesResponse(RESPONSE, f, size, ranges,
+                                      content_type)
+            finally:
+                f.close()
+
+        RESPONSE.setHeader('Content-Type', content_type)
+        RESPONSE.setHeader('Content-Length', size)
+        if data is None:
+            return base.getIterator()
+        if isinstance(data, str):
+            return data
+        return PdataStreamIterator(data, size)
+
+    def _downloadETag(self, file):
+        """A strong ETag from the revision of the stored file, or None
+        while it is not committed"""
+        base = aq_base(file)
+        oid = getattr(base, '_p_oid', None)
+        serial = getattr(base, '_p_serial', None)
+        if oid is None or not serial or serial == z64 or base._p_changed:
+            return None
+        return '"%s%s"' % (oid.encode('hex'), serial.encode('hex'))
+
+    def _notModified(self, REQUEST, etag, mtime):
+        """Whether the conditional headers of REQUEST match the file"""
+        none_match = REQUEST.get_header('If-None-Match', None)
+        if none_match is not None:
+            if etag is None:
+                return False
+            tags = [tag.strip() for tag in none_match.split(',')]
+            return '*' in tags or etag in tags
+        since = REQUEST.get_header('If-Modified-Since', None)
+        if since is None or mtime is None:
+            return False
+        try:
+            since = long(DateTime(since.split(';')[0]).timeTime())
+        except (ConflictError, KeyboardInterrupt):
+            raise
+        except Exception:
+            return False
+        return long(mtime) <= since
+
+    def _ifRange(self, REQUEST, etag, mtime):
+        """Whether a Range header of REQUEST applies to the file"""
+        if_range = REQUEST.get_header('If-Range', None)
+        if if_range is None:
+            return True
+        if if_range.startswith('"'):
+            return etag is not None and if_range == etag
+        if mtime is None:
+            return False
+        try:
+            return long(DateTime(if_range).timeTime()) == long(mtime)
+        except (ConflictError, KeyboardInterrupt):
+            raise
+        except Exception:
+            return False
 
     security.declarePublic('get_size')
     def get_size(self, instance):
@@ -1281,35 +1419,158 @@ class FileField(ObjectField):
 
     security.declarePrivate('getIndexable')
     def getIndexable(self, instance):
-        # XXX Naive implementation that loads all data contents into
-        # memory.  To have this not happening set your field to not
-        # 'searchable' (the default) or define your own 'index_method'
-        # property.
+        return self.extractIndexable(instance)[1]
+
+    security.declarePrivate('extractIndexable')
+    def extractIndexable(self, instance):
+        """The digest of the data and the text getIndexable returns
+
+        The digest is None when no text could be extracted.
+        """
+        # The data is read once, chunk by chunk, to find its digest; the
+        # text extracted is cached under the digest and cut after
+        # config.INDEXABLE_TEXT_SIZE bytes. Only the head of plain text is
+        # kept, other data is spooled to a temporary file meanwhile, as
+        # portal_transforms needs it at once.
         orig_mt = self.getContentType(instance)
 
         # If there's no path to text/plain, don't do anything
         transforms = getToolByName(instance, 'portal_transforms')
         if transforms._findPath(orig_mt, 'text/plain') is None:
-            return ''
-
-        f = self.get(instance)
+            return None, ''
 
-        datastream = ''
+        plain = str(orig_mt) == 'text/plain'
+        digest, spool = self._spoolData(self.get(instance), plain)
         try:
-            datastream = transforms.convertTo(
-                "text/plain",
-                str(f),
-                mimetype=orig_mt,
-                filename=self.getFilename(instance, 0),
-                )
-        except (ConflictError, KeyboardInterrupt):
-            raise
-        except Exception, e:
-            log("Error while trying to convert file contents to 'text/plain' "
-                "in %r.getIndexable() of %r: %s" % (self, instance, e))
+            # extracted for a bulk reindex already
+            value = extractedText(instance, self.getName(), digest)
+            if value is not None:
+                return digest, value
+            key = indexableKey(transforms, orig_mt)
+            if key is not None:
+                value = transform_cache.get(digest, key)
+                if value is not None:
+                    return digest, value
+
+            spool.seek(0)
+            if plain:
+                value = limitText(spool.read(config.INDEXABLE_TEXT_SIZE + 1))
+            else:
+                try:
+                    value = extractText(transforms, spool.read(), orig_mt,
+                                        self.getFilename(instance, 0))
+                except (ConflictError, KeyboardInterrupt):
+                    raise
+                except Exception, e:
+                    log("Error while trying to convert file contents to "
+                        "'text/plain' in %r.getIndexable() of %r: %s" %
+                        (self, instance, e))
+                    return None, ''
+        finally:
+            spool.close()
+
+        if key is not None:
+            transform_cache.set(digest, key, value)
+        return digest, value
+
+    def _spoolData(self, value, head=False):
+        """Read the data of a file once, returns its digest and a temporary
+        file holding the data, or only the indexed head of it with head
+        """
+        digest = sha1()
+        spool = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        size = 0
+        for chunk in self._dataChunks(value):
+            digest.update(chunk)
+            if not head or size <= config.INDEXABLE_TEXT_SIZE:
+                spool.write(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), spool
+
+    security.declarePrivate('getExtractionJob')
+    def getExtractionJob(self, instance):
+        """What getIndexable would convert, for an ExtractionPool
+
+        Returns the (path, field name) of instance, or None when the text
+        is cheap to get or isn't cached.
+        """
+        orig_mt = self.getContentType(instance)
+        if str(orig_mt) == 'text/plain':
+            return None
+        transforms = getToolByName(instance, 'portal_transforms')
+        if transforms._findPath(orig_mt, 'text/plain') is None:
+            return None
+        if indexableKey(transforms, orig_mt) is None:
+            return None
+        return '/'.join(instance.getPhysicalPath()), self.getName()
 
-        value = str(datastream)
-        return value
+    def _dataChunks(self, value):
+        """Yield the data of a file in chunks
+
+        The chunks of a Pdata chain are turned back into ghosts once read,
+        blob files are read chunk by chunk.
+        """
+        base = aq_base(value)
+        if isinstance(base, BlobFile):
+            f = base.open()
+            try:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+            finally:
+                f.close()
+        if not isinstance(base, File) or isinstance(base, BaseUnit):
+            yield str(value)
+            return
+        data = base.data
+        if isinstance(data, basestring):
+            yield str(data)
+            return
+        while data is not None:
+            yield data.data
+            next = data.next
+            if getattr(data, '_p_changed', None) is False:
+                data._p_deactivate()
+            data = next
+
+    security.declarePrivate('migrateToBlob')
+    def migrateToBlob(self, instance):
+        """Move the values stored for the field into blobs
+
+        Only does something when the content_class is a BlobFile, e.g.
+        after it has been changed to one. Returns the number of values
+        moved.
+        """
+        if not issubclass(self.content_class, BlobFile):
+            return 0
+        storage = self.getStorage(instance)
+        moved = 0
+        for name in self._storedNames(instance):
+            try:
+                value = storage.get(name, instance)
+            except AttributeError:
+                continue
+            if isinstance(aq_base(value), BlobFile):
+                continue
+            data, mimetype, filename = self._migrate_old(value)
+            if not isinstance(data, Pdata) and not data:
+                continue
+            blob = self.content_class(name, '', data, mimetype or '')
+            blob.filename = filename
+            try:
+                delattr(blob, 'title')
+            except (KeyError, AttributeError):
+                pass
+            storage.set(name, instance, blob, mimetype=blob.content_type,
+                        filename=filename)
+            moved += 1
+        return moved
+
+    def _storedNames(self, instance):
+        """The names the values of the field are stored under"""
+        return [self.getName()]
 
 
 class TextField(FileField):
@@ -1857,6 +2118,7 @@ class ReferenceField(ObjectField):
                                           # if given, this will
                                           # override display_path_bound
         'referenceClass': Reference,
+        'lightweightReferences': False,  # store plain references as records
         'referenceReferences': False,
         'keepReferencesOnCopy': False,
         'referencesSortable': False,
@@ -1869,6 +2131,7 @@ class ReferenceField(ObjectField):
     security = ClassSecurityInfo()
 
     referencesSortable = False
+    lightweightReferences = False
 
     security.declarePrivate('get')
     def get(self, instance, aslist=False, **kwargs):
@@ -1900,7 +2163,7 @@ class ReferenceField(ObjectField):
         order = refs.get(self.relationship)
         if order is None:
             return res
-        return [rd[uid] for uid in order if uid in rd.keys()]
+        return [rd[uid] for uid in order if uid in rd]
 
     security.declarePrivate('set')
     def set(self, instance, value, **kwargs):
@@ -1961,8 +2224,7 @@ class ReferenceField(ObjectField):
         <SimpleBTreeFolder...>
         """
         tool = getToolByName(instance, REFERENCE_CATALOG)
-        targetUIDs = [ref.targetUID for ref in
-                      tool.getReferences(instance, self.relationship)]
+        targetUIDs = tool.getTargetUIDs(instance, self.relationship)
 
         if value is None:
             value = ()
@@ -1981,22 +2243,26 @@ class ReferenceField(ObjectField):
             else:
                 uids.append(IUUID(v, None))
 
-        add = [v for v in uids if v and v not in targetUIDs]
-        sub = [t for t in targetUIDs if t not in uids]
+        existing = set(targetUIDs)
+        wanted = set(uids)
+        add = [v for v in uids if v and v not in existing]
+        sub = [t for t in targetUIDs if t not in wanted]
 
         # tweak keyword arguments for addReference
         addRef_kw = kwargs.copy()
         addRef_kw.setdefault('referenceClass', self.referenceClass)
+        if self.lightweightReferences:
+            addRef_kw.setdefault('lightweight', True)
         if 'schema' in addRef_kw:
             del addRef_kw['schema']
 
-        for uid in add:
-            __traceback_info__ = (instance, uid, value, targetUIDs)
-            # throws IndexError if uid is invalid
-            tool.addReference(instance, uid, self.relationship, **addRef_kw)
+        if add:
+            __traceback_info__ = (instance, add, value, targetUIDs)
+            # throws ReferenceException if an uid is invalid
+            tool.addReferences(instance, add, self.relationship, **addRef_kw)
 
-        for uid in sub:
-            tool.deleteReference(instance, uid, self.relationship)
+        if sub:
+            tool.deleteReferences(instance, self.relationship, targets=sub)
 
         if self.referencesSortable:
             if not hasattr(aq_base(instance), 'at_ordered_refs'):
@@ -2016,9 +2282,8 @@ class ReferenceField(ObjectField):
         relationship
         """
         rc = getToolByName(instance, REFERENCE_CATALOG)
-        brains = rc(sourceUID=IUUID(instance, None),
-                    relationship=self.relationship)
-        res = [b.targetUID for b in brains]
+        uid = IUUID(instance, None)
+        res = uid and rc.getTargetUIDs(uid, self.relationship) or []
         if not self.multiValued and not aslist:
             if res:
                 res = res[0]
@@ -2312,6 +2577,33 @@ class Image(BaseImage):
         return True
 
 
+class BlobImage(BlobFile, Image):
+    """An Image keeping its data in a ZODB blob"""
+
+    meta_type = 'Blob Image'
+    security = ClassSecurityInfo()
+
+    security.declarePrivate('update_data')
+    def update_data(self, data, content_type=None, size=None):
+        BlobFile.update_data(self, data, content_type, size)
+        content_type, width, height = getImageInfo(self.head(CHUNK_SIZE))
+        if content_type:
+            self.content_type = content_type
+        if (width < 0 or height < 0) and HAS_PIL:
+            # the size isn't in the first chunk
+            f = self.open()
+            try:
+                try:
+                    width, height = PIL.Image.open(f).size
+                except IOError:
+                    pass
+            finally:
+                f.close()
+        if width >= 0 and height >= 0:
+            self.width = width
+            self.height = height
+
+
 class ImageField(FileField):
     """ implements an image attribute. it stores
         it's data in an image sub-object
@@ -2376,6 +2668,15 @@ class ImageField(FileField):
         removeScales method is able to find the scales to delete the
         data.
 
+        lazy_scales -- don't create the scales when the image is set, but
+        when one is asked for by getScale (and so by traversal to it). The
+        scales made are recorded with their size and the digest of the
+        original, and made again once either changed. Scales removed from
+        the sizes are deleted as well.
+
+        max_scales -- with lazy_scales, the number of scales kept at most,
+        the oldest ones are deleted first. 0 for no limit.
+
         Scaling will only be available if PIL is installed!
 
         If 'DELETE_IMAGE' will be given as value, then all the images
@@ -2392,6 +2693,8 @@ class ImageField(FileField):
         'swallowResizeExceptions': False,
         'pil_quality': 88,
         'pil_resize_algo': PIL_ALGO,
+        'lazy_scales': False,
+        'max_scales': 0,
         'default_content_type': 'image/png',
         'allowable_content_types': ('image/gif', 'image/jpeg', 'image/png'),
         'widget': ImageWidget,
@@ -2412,6 +2715,7 @@ class ImageField(FileField):
             self.removeScales(instance, **kwargs)
             # unset main field too
             ObjectField.unset(self, instance, **kwargs)
+            self._forgetImageInfo(instance)
             return
 
         if not value:
@@ -2438,10 +2742,15 @@ class ImageField(FileField):
             if not self.swallowResizeExceptions:
                 raise
             else:
-                data = str(value.data)
+                data = self._imageData(value)
         # TODO add self.ZCacheable_invalidate() later
         self.createOriginal(instance, data, **kwargs)
-        self.createScales(instance, value=data)
+        if self.lazy_scales:
+            self.removeScales(instance)
+            self._setScaleRecord(instance, {
+                'original': self._originalDigest(instance), 'scales': []})
+        else:
+            self.createScales(instance, value=data)
 
     security.declareProtected(permissions.View, 'getAvailableSizes')
     def getAvailableSizes(self, instance):
@@ -2474,7 +2783,7 @@ class ImageField(FileField):
 
         value must be an OFS.Image.Image instance
         """
-        data = str(value.data)
+        data = self._imageData(value)
         if not HAS_PIL:
             return data
 
@@ -2497,29 +2806,52 @@ class ImageField(FileField):
                 __traceback_info__ = (self, value, w, h)
                 fvalue, format = self.scale(data, w, h)
                 data = fvalue.read()
-        else:
-            data = str(value.data)
 
         return data
 
+    def _imageData(self, value):
+        """The data of the image value to scale
+
+        A blob image is returned as it is, it is read from the blob file.
+        """
+        if isinstance(aq_base(value), BlobFile):
+            return value
+        return str(value.data)
+
     security.declarePrivate('createOriginal')
     def createOriginal(self, instance, value, **kwargs):
         """create the original image (save it)
         """
-        if value:
+        if isinstance(aq_base(value), BlobFile):
+            # the uploaded blob image, which wasn't rescaled
+            image = aq_base(value)
+            try:
+                delattr(image, 'title')
+            except (KeyError, AttributeError):
+                pass
+        elif value:
             image = self._wrapValue(instance, value, **kwargs)
         else:
             image = self.getDefault(instance)
 
         ObjectField.set(self, instance, image, **kwargs)
+        # the scales are recorded again as they are made
+        self._forgetImageInfo(instance)
+        self._recordImageInfo(instance, None, image)
 
     security.declarePrivate('removeScales')
     def removeScales(self, instance, **kwargs):
         """Remove the scaled image
         """
-        sizes = self.getAvailableSizes(instance)
-        if sizes:
-            for name, size in sizes.items():
+        names = set(self.getAvailableSizes(instance))
+        record = self._getScaleRecord(instance)
+        if record is not None:
+            # made by lazy_scales, the sizes may have changed since
+            names.update([key[0] for key in record['scales']])
+            self._setScaleRecord(instance, None)
+        self._forgetImageInfo(instance, names)
+        if names:
+            for name in names:
                 id = self.getName() + "_" + name
                 try:
                     # the following line may throw exceptions on types, if the
@@ -2535,6 +2867,9 @@ class ImageField(FileField):
     security.declareProtected(permissions.ModifyPortalContent, 'createScales')
     def createScales(self, instance, value=_marker):
         """creates the scales and save them
+
+        The image is decoded once for all scales, see ImageScaler. Returns
+        the seconds spent decoding and making each scale.
         """
         sizes = self.getAvailableSizes(instance)
         if not HAS_PIL or not sizes:
@@ -2544,108 +2879,266 @@ class ImageField(FileField):
             img = self.getRaw(instance)
             if not img:
                 return
-            data = str(img.data)
+            data = self._imageData(img)
         else:
             data = value
 
         # empty string - stop rescaling because PIL fails on an empty string
-        if not data:
+        if isinstance(aq_base(data), BlobFile):
+            if not data.get_size():
+                return
+        elif not data:
             return
 
         filename = self.getFilename(instance)
 
-        for n, size in sizes.items():
-            if size == (0, 0):
-                continue
-            w, h = size
-            id = self.getName() + "_" + n
-            __traceback_info__ = (self, instance, id, w, h)
-            try:
-                imgdata, format = self.scale(data, w, h)
-            except (ConflictError, KeyboardInterrupt):
+        sizes = [(n, size) for n, size in sizes.items() if size != (0, 0)]
+        scaler = ImageScaler(data, self.pil_resize_algo, self.pil_quality)
+        __traceback_info__ = (self, instance, sizes)
+        # with swallowResizeExceptions, only the scales which failed aren't
+        # created
+        scales = scaler.scales(sizes, config.IMAGE_SCALING_WORKERS,
+                               swallow=self.swallowResizeExceptions)
+        for n, (imgdata, format) in scales.items():
+            self._storeScale(instance, n, imgdata, format, filename)
+        for n, error in sorted(scaler.errors.items()):
+            log('Scaling %s of %s to %s failed: %r' % (
+                self.getName(), instance.absolute_url(), n, error),
+                level=ERROR)
+        log('Scaled %s of %s: %s' % (self.getName(), instance.absolute_url(),
+            ', '.join(['%s %.3fs' % item for item in
+                       sorted(scaler.timings.items())])), level=DEBUG)
+        return scaler.timings
+
+    security.declareProtected(permissions.ModifyPortalContent, 'createScale')
+    def createScale(self, instance, scale, size, data, filename):
+        """creates one scale of the image data and saves it
+
+        Returns the scale, or None if the scaling failed and the
+        exception was swallowed.
+        """
+        w, h = size
+        id = self.getName() + "_" + scale
+        __traceback_info__ = (self, instance, id, w, h)
+        try:
+            imgdata, format = self.scale(data, w, h)
+        except (ConflictError, KeyboardInterrupt):
+            raise
+        except:
+            if not self.swallowResizeExceptions:
                 raise
-            except:
-                if not self.swallowResizeExceptions:
-                    raise
-                else:
-                    # scaling failed, don't create a scaled version
-                    continue
+            else:
+                # scaling failed, don't create a scaled version
+                return None
+        return self._storeScale(instance, scale, imgdata, format, filename)
+
+    def _storeScale(self, instance, scale, imgdata, format, filename):
+        id = self.getName() + "_" + scale
+        mimetype = 'image/%s' % format.lower()
+        image = self._make_image(id, title=self.getName(), file=imgdata,
+                                 content_type=mimetype, instance=instance)
+        # nice filename: filename_sizename.ext
+        #fname = "%s_%s%s" % (filename, n, ext)
+        #image.filename = fname
+        image.filename = filename
+        try:
+            delattr(image, 'title')
+        except (KeyError, AttributeError):
+            pass
+        # manually use storage
+        self.getStorage(instance).set(id, instance, image,
+                                      mimetype=mimetype, filename=filename)
+        self._recordImageInfo(instance, scale, image)
+        return image
+
+    security.declarePrivate('ensureScale')
+    def ensureScale(self, instance, scale):
+        """With lazy_scales, make the scale unless it is up to date
+
+        The scales are recorded by their (name, size, digest of the
+        original). Recorded scales whose size or original changed are
+        deleted, and the oldest ones once there are more than max_scales.
+        """
+        if not HAS_PIL:
+            return
+        sizes = self.getAvailableSizes(instance)
+        size = sizes.get(scale)
+        if not size or tuple(size) == (0, 0):
+            return
+        record = self._getScaleRecord(instance)
+        if record is None:
+            # set before lazy_scales was turned on
+            record = {'original': self._originalDigest(instance),
+                      'scales': []}
+        digest = record['original']
+        if digest is None:
+            return
+        key = (scale, tuple(size), digest)
+        if key in record['scales']:
+            return
 
-            mimetype = 'image/%s' % format.lower()
-            image = self._make_image(id, title=self.getName(), file=imgdata,
-                                     content_type=mimetype, instance=instance)
-            # nice filename: filename_sizename.ext
-            #fname = "%s_%s%s" % (filename, n, ext)
-            #image.filename = fname
-            image.filename = filename
+        data = self._imageData(self.getRaw(instance))
+        if self.createScale(instance, scale, size, data,
+                            self.getFilename(instance)) is None:
+            return
+        keep = []
+        stale = []
+        for old in record['scales']:
+            name, old_size, old_digest = old
+            if name == scale:
+                # replaced
+                continue
+            if old_digest == digest and \
+                   tuple(sizes.get(name) or ()) == old_size:
+                keep.append(old)
+            else:
+                stale.append(old)
+        keep.append(key)
+        if self.max_scales and len(keep) > self.max_scales:
+            stale.extend(keep[:-self.max_scales])
+            keep = keep[-self.max_scales:]
+        storage = self.getStorage(instance)
+        for name, old_size, old_digest in stale:
             try:
-                delattr(image, 'title')
-            except (KeyError, AttributeError):
+                storage.unset(self.getScaleName(scale=name), instance)
+            except KeyError:
                 pass
-            # manually use storage
-            self.getStorage(instance).set(id, instance, image,
-                                          mimetype=mimetype, filename=filename)
+        if stale:
+            self._forgetImageInfo(instance, [name for name, old_size,
+                                             old_digest in stale])
+        self._setScaleRecord(instance, {'original': digest, 'scales': keep})
+
+    # the record and the image infos are kept in a persistent mapping of
+    # their own in the annotations of the instance, whatever the storage of
+    # the field, so that making a scale doesn't modify the instance
+
+    def _scaleAnnotation(self, instance, create=False):
+        ann = getAnnotation(instance)
+        mapping = ann.getSubkey(AT_IMAGE_SCALES, self.getName())
+        if mapping is None and create:
+            mapping = PersistentMapping()
+            ann.setSubkey(AT_IMAGE_SCALES, mapping, self.getName())
+        return mapping
+
+    def _getScaleRecord(self, instance):
+        """The record of the scales made by lazy_scales, or None"""
+        mapping = self._scaleAnnotation(instance)
+        if mapping is None or 'scales' not in mapping:
+            return None
+        return {'original': mapping['original'],
+                'scales': list(mapping['scales'])}
+
+    def _setScaleRecord(self, instance, record):
+        """Store the record of the scales, None removes it"""
+        if record is None:
+            mapping = self._scaleAnnotation(instance)
+            if mapping is not None:
+                mapping.pop('original', None)
+                mapping.pop('scales', None)
+            return
+        mapping = self._scaleAnnotation(instance, create=True)
+        mapping['original'] = record['original']
+        mapping['scales'] = list(record['scales'])
+
+    security.declareProtected(permissions.View, 'getImageInfo')
+    def getImageInfo(self, instance, scale=None):
+        """(width, height, format, size in bytes) of the original or a scale
+
+        Recorded when the image or scale is stored, so that it can be told
+        without loading the image. None if nothing was recorded, e.g. for
+        images stored before, or if the scale recorded is not the one of the
+        current sizes.
+        """
+        return self._imageInfo(instance, scale,
+                               self.getAvailableSizes(instance))
+
+    def _imageInfo(self, instance, scale, sizes):
+        infos = self._getImageInfos(instance)
+        original = infos.get(None)
+        if not scale or original is None:
+            return original
+        info = infos.get(scale)
+        size = sizes.get(scale)
+        if info is None or not size or tuple(size) == (0, 0):
+            return None
+        # made for other sizes or from another original
+        if tuple(info[:2]) != fitSize(original[:2],
+                                      (int(size[0]), int(size[1]))):
+            return None
+        if self.lazy_scales:
+            record = self._getScaleRecord(instance)
+            if record is None or (scale, tuple(size), record['original']) \
+                   not in record['scales']:
+                return None
+        return info
+
+    # the infos are {scale name or None for the original: info}
+
+    def _getImageInfos(self, instance):
+        mapping = self._scaleAnnotation(instance)
+        if mapping is None:
+            return {}
+        return mapping.get('infos', {})
+
+    def _recordImageInfo(self, instance, scale, image):
+        infos = dict(self._getImageInfos(instance))
+        if not getattr(aq_base(image), 'width', None):
+            # no image
+            infos.pop(scale, None)
+        else:
+            format = str(image.content_type).split('/')[-1]
+            infos[scale] = (image.width, image.height, format,
+                            image.get_size())
+        self._scaleAnnotation(instance, create=True)['infos'] = infos
+
+    def _forgetImageInfo(self, instance, scales=None):
+        """Forget the infos of scales, all of them if None"""
+        infos = dict(self._getImageInfos(instance))
+        if not infos:
+            return
+        if scales is None:
+            infos = {}
+        for scale in scales or ():
+            infos.pop(scale, None)
+        self._scaleAnnotation(instance)['infos'] = infos
+
+    def _originalDigest(self, instance):
+        """The sha1 digest of the original image, None if there's none"""
+        img = self.getRaw(instance)
+        if not img:
+            return None
+        digest = sha1()
+        for chunk in self._dataChunks(img):
+            digest.update(chunk)
+        return digest.hexdigest()
 
     def _make_image(self, id, title='', file='', content_type='', instance=None):
         """Image content factory"""
         return self.content_class(id, title, file, content_type)
 
+    def _storedNames(self, instance):
+        return [self.getName()] + [self.getScaleName(scale=name) for name
+                                   in self.getAvailableSizes(instance)]
+
     security.declarePrivate('scale')
     def scale(self, data, w, h, default_format='PNG'):
-        """ scale image (with material from ImageTag_Hotfix)"""
-        #make sure we have valid int's
-        size = int(w), int(h)
-
-        original_file = StringIO(data)
-        image = PIL.Image.open(original_file)
+        """ scale image (with material from ImageTag_Hotfix)
 
-        if image.format == 'GIF' and size[0] >= image.size[0] and size[1] >= image.size[1]:
-            try:
-                image.seek(image.tell() + 1)
-                # original image is animated GIF and no bigger than the scale requested
-                # don't attempt to scale as this will lose animation
-                original_file.seek(0)
-                return original_file, 'gif'
-            except EOFError:
-                # image is not animated
-                image.seek(0)
-
-        # consider image mode when scaling
-        # source images can be mode '1','L,','P','RGB(A)'
-        # convert to greyscale or RGBA before scaling
-        # preserve palletted mode (but not pallette)
-        # for palletted-only image formats, e.g. GIF
-        # PNG compression is OK for RGBA thumbnails
-        original_mode = image.mode
-        img_format = image.format and image.format or default_format
-        if img_format in ('TIFF', 'EPS', 'PSD'):
-            # non web image format have jpeg thumbnails
-            target_format = 'JPEG'
-        else:
-            target_format = img_format
-
-        if original_mode == '1':
-            image = image.convert('L')
-        elif original_mode == 'P':
-            image = image.convert('RGBA')
-        elif original_mode == 'CMYK':
-            image = image.convert('RGBA')
-
-        image.thumbnail(size, self.pil_resize_algo)
-        # decided to only preserve palletted mode
-        # for GIF, could also use image.format in ('GIF','PNG')
-        if original_mode == 'P' and img_format == 'GIF':
-            image = image.convert('P')
-        thumbnail_file = StringIO()
-        # quality parameter doesn't affect lossless formats
-        image.save(thumbnail_file, target_format, quality=self.pil_quality)
-        thumbnail_file.seek(0)
-        return thumbnail_file, target_format.lower()
+        data is a string, an open file or a blob image, which is read from
+        its blob file. Use createScales to make several scales of an image.
+        """
+        scaler = ImageScaler(data, self.pil_resize_algo, self.pil_quality,
+                             default_format)
+        return scaler.scales([(None, (w, h))])[None]
 
     security.declareProtected(permissions.View, 'getSize')
     def getSize(self, instance, scale=None):
         """get size of scale or original
         """
+        info = self.getImageInfo(instance, scale=scale)
+        if info is not None:
+            return info[0], info[1]
+        # not recorded, or not up to date
         img = self.getScale(instance, scale=scale)
         if not img:
             return 0, 0
@@ -2658,6 +3151,8 @@ class ImageField(FileField):
         if scale is None:
             return self.get(instance, **kwargs)
         else:
+            if self.lazy_scales:
+                self.ensureScale(instance, scale)
             id = self.getScaleName(scale=scale)
             try:
                 image = self.getStorage(instance).get(id, instance, **kwargs)
@@ -2685,11 +3180,20 @@ class ImageField(FileField):
         TODO: We should only return the size of the original image
         """
         sizes = self.getAvailableSizes(instance)
-        original = self.get(instance)
-        size = original and original.get_size() or 0
+        info = self._imageInfo(instance, None, sizes)
+        if info is not None:
+            size = info[3]
+        else:
+            original = self.get(instance)
+            size = original and original.get_size() or 0
 
         if sizes:
             for name in sizes.keys():
+                # the recorded size when up to date, else the stored one
+                info = self._imageInfo(instance, name, sizes)
+                if info is not None:
+                    size += info[3]
+                    continue
                 id = self.getScaleName(scale=name)
                 try:
                     data = self.getStorage(instance).get(id, instance)
@@ -2704,12 +3208,8 @@ class ImageField(FileField):
             css_class=None, title=None, **kwargs):
         """Create a tag including scale
         """
-        image = self.getScale(instance, scale=scale)
-        if image:
-            img_width, img_height = self.getSize(instance, scale=scale)
-        else:
-            img_height = 0
-            img_width = 0
+        # the recorded size when up to date, else the one of the scale
+        img_width, img_height = self.getSize(instance, scale=scale)
 
         if height is None:
             height = img_height
@@ -1,6 +1,9 @@
+import logging
 import os
 from types import StringType, UnicodeType
+from itertools import islice
 import time
+import transaction
 import urllib
 from zope.interface import implements
 
@@ -11,14 +14,20 @@ from Products.Archetypes.interfaces import IReference
 from Products.Archetypes.interfaces import IReferenceCatalog
 
 from Products.Archetypes.utils import make_uuid, getRelURL, shasattr
+from Products.Archetypes.utils import isFactoryContained
+from Products.Archetypes.utils import invalidateReferencesMemo
 from Products.Archetypes.config import (
-    TOOL_NAME, UID_CATALOG, REFERENCE_CATALOG, UUID_ATTR, _www)
+    UID_CATALOG, REFERENCE_CATALOG, REFERENCE_ANNOTATION,
+    UUID_ATTR, _www)
 from Products.Archetypes.exceptions import ReferenceException
+from Products.Archetypes.adjacency import ReferenceAdjacency
 
-from Acquisition import aq_base, aq_parent
+from Acquisition import aq_base, aq_parent, aq_inner, Implicit
+from ComputedAttribute import ComputedAttribute
 from AccessControl import ClassSecurityInfo
 from OFS.SimpleItem import SimpleItem
 from OFS.ObjectManager import ObjectManager
+from Products.BTreeFolder2.BTreeFolder2 import BTreeFolder2
 
 from App.class_init import InitializeClass
 from App.special_dtml import DTMLFile
@@ -28,12 +37,13 @@ from Products.CMFCore import permissions
 from Products.PageTemplates.PageTemplateFile import PageTemplateFile
 from Products.ZCatalog.ZCatalog import ZCatalog
 from Products.ZCatalog.Catalog import Catalog
-from Products.ZCatalog.Lazy import LazyMap
+from Products.ZCatalog.Lazy import LazyCat, LazyMap
 from Products import CMFCore
 
 from plone.uuid.interfaces import IUUID
 
 _catalog_dtml = os.path.join(os.path.dirname(CMFCore.__file__), 'dtml')
+logger = logging.getLogger('Archetypes')
 
 STRING_TYPES = (StringType, UnicodeType)
 
@@ -225,6 +235,34 @@ class ReferenceCatalogBrains(UIDCatalogBrains):
     pass
 
 
+class ReferenceRecordBrain(Implicit):
+    """Brain for a lightweight reference, which isn't cataloged"""
+
+    def __init__(self, path, edge):
+        self._path = path
+        self.sourceUID, self.targetUID, self.relationship = edge
+        self.UID = self.id = path.split('/')[-1]
+
+    def getPath(self):
+        return self._path
+
+    def getRID(self):
+        return None
+
+    def _getTargetId(self):
+        uc = getToolByName(aq_parent(self), UID_CATALOG)
+        for brain in uc(UID=self.targetUID):
+            return brain.id
+
+    targetId = ComputedAttribute(_getTargetId, 1)
+
+    def getObject(self, REQUEST=None):
+        rc = aq_parent(self)
+        sobj = rc._uidFor(self.sourceUID)[1]
+        if sobj is not None:
+            return rc._recordReference(sobj, self.UID)
+
+
 class PluggableCatalog(Catalog):
     # Catalog overrides
     # smarter brains, squirrely traversal
@@ -257,6 +295,44 @@ InitializeClass(PluggableCatalog)
 class ReferenceBaseCatalog(PluggableCatalog):
     BASE_CLASS = ReferenceCatalogBrains
 
+    # Catalogs created before the adjacency index existed don't have one
+    # until manage_rebuildAdjacency is run, readers fall back to searching.
+    _adjacency = None
+
+    def clear(self):
+        records = ()
+        old = aq_base(self)._adjacency
+        if old is not None:
+            # lightweight references aren't cataloged, keep them
+            records = [(path, edge) for path, edge in old._edges.items()
+                       if path not in self.uids]
+        PluggableCatalog.clear(self)
+        invalidateReferencesMemo(self)
+        self._adjacency = ReferenceAdjacency()
+        for path, edge in records:
+            self._adjacency.index(path, *edge)
+
+    def catalogObject(self, object, uid, threshold=None, idxs=None,
+                      update_metadata=1):
+        result = PluggableCatalog.catalogObject(
+            self, object, uid, threshold, idxs, update_metadata)
+        invalidateReferencesMemo(self)
+        adjacency = aq_base(self)._adjacency
+        if adjacency is not None:
+            sid = getattr(object, 'sourceUID', None)
+            tid = getattr(object, 'targetUID', None)
+            if sid and tid:
+                adjacency.index(uid, sid, tid,
+                                getattr(object, 'relationship', None))
+        return result
+
+    def uncatalogObject(self, uid):
+        invalidateReferencesMemo(self)
+        adjacency = aq_base(self)._adjacency
+        if adjacency is not None:
+            adjacency.unindex(uid)
+        return PluggableCatalog.uncatalogObject(self, uid)
+
 
 class IndexableObjectWrapper(object):
     """Wwrapper for object indexing
@@ -290,6 +366,15 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
     manage_catalogFind = DTMLFile('catalogFind', _catalog_dtml)
     manage_options = ZCatalog.manage_options
 
+    # Store plain references as records of their source instead of
+    # Reference objects, see _useRecords
+    lightweight_references = False
+
+    # Objects handled between two savepoints or commits when rebuilding,
+    # see rebuildReferences
+    rebuild_chunk_size = 1000
+    _rebuild_state = None
+
     def __init__(self, id, title='', vocab_id=None, container=None):
         """We hook up the brains now"""
         ZCatalog.__init__(self, id, title, vocab_id, container)
@@ -316,10 +401,11 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
                 if existing:
                     # We can't del off self, we now need to remove it
                     # from the source objects annotation, which we have
-                    annotation = sobj._getReferenceAnnotations()
-                    annotation._delObject(existing.id)
+                    self._removeReference(sobj, existing.id)
 
         rID = self._makeName(sID, tID)
+        if self._useRecords(referenceClass, kwargs):
+            return self._addRecord(sobj, rID, sID, tID, relationship)
         if not referenceClass:
             referenceClass = Reference
 
@@ -339,6 +425,75 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
             annotation._setObject(rID, referenceObject)
             return referenceObject
 
+    def addReferences(self, source, targets, relationship=None,
+                      referenceClass=None, updateReferences=True,
+                      lightweight=None, **kwargs):
+        """Add references from source to each of targets
+
+        Works like addReference, but resolves all targets in one pass and
+        catalogs the new reference objects together. Returns the list of
+        added reference objects.
+
+        lightweight overrides the lightweight_references setting of the
+        catalog for these references.
+        """
+        sID, sobj = self._uidFor(source)
+        if not sID or sobj is None:
+            raise ReferenceException('Invalid source UID')
+
+        resolved = []
+        seen = set()
+        for tID, tobj in self._uidsFor(targets):
+            if not tID or tobj is None:
+                raise ReferenceException('Invalid target UID')
+            if tID not in seen:
+                seen.add(tID)
+                resolved.append((tID, tobj))
+
+        if updateReferences:
+            # we want to replace the existing references
+            for brain in self._queryFor(sID, None, relationship):
+                if brain.targetUID in seen:
+                    self._removeReference(sobj,
+                                          brain.getPath().split('/')[-1])
+
+        if self._useRecords(referenceClass, kwargs, lightweight):
+            return [self._addRecord(sobj, self._makeName(sID, tID), sID, tID,
+                                    relationship)
+                    for tID, tobj in resolved]
+
+        annotation = sobj._getReferenceAnnotations()
+        if not referenceClass:
+            referenceClass = Reference
+        # Reference classes that don't customize manage_afterAdd are added
+        # without events and cataloged below, saving the per reference
+        # tool lookups done by Referenceable.manage_afterAdd.
+        afterAdd = getattr(referenceClass, 'manage_afterAdd', None)
+        quiet = getattr(afterAdd, 'im_func', None) is \
+            Reference.manage_afterAdd.im_func
+
+        added = []
+        for tID, tobj in resolved:
+            rID = self._makeName(sID, tID)
+            referenceObject = referenceClass(rID, sID, tID, relationship,
+                                             **kwargs)
+            referenceObject = referenceObject.__of__(annotation)
+            try:
+                referenceObject.addHook(self, sobj, tobj)
+            except ReferenceException:
+                continue
+            annotation._setObject(rID, referenceObject, suppress_events=quiet)
+            added.append(annotation._getOb(rID))
+
+        if quiet and added:
+            uc = getToolByName(self, UID_CATALOG)
+            for referenceObject in added:
+                url = getRelURL(uc, referenceObject.getPhysicalPath())
+                if not isFactoryContained(referenceObject):
+                    uc.catalog_object(referenceObject, url)
+                self.catalog_object(referenceObject, url)
+        return added
+
     def deleteReference(self, source, target, relationship=None):
         sID, sobj = self._uidFor(source)
         tID, tobj = self._uidFor(target)
@@ -347,8 +502,12 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
         if objects:
             self._deleteReference(objects[0])
 
-    def deleteReferences(self, object, relationship=None):
-        # delete all the references held by an object
+    def deleteReferences(self, object, relationship=None, targets=None):
+        # delete all the references held by an object, or only those
+        # pointing to one of targets when given
+        if targets is not None:
+            return self._deleteReferencesTo(object, targets, relationship)
+
         for b in self.getReferences(object, relationship):
             self._deleteReference(b)
 
@@ -388,6 +547,147 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
             return self._resolveBrains(brains)
         return brains
 
+    security.declarePrivate('getTargetUIDs')
+    def getTargetUIDs(self, object, relationship=None, targetObject=None):
+        """UIDs of the objects referenced by object
+
+        object may be given as a UID.
+        """
+        return self._relatedUIDs(object, relationship, targetObject,
+                                 attribute='sourceUID')
+
+    security.declarePrivate('getSourceUIDs')
+    def getSourceUIDs(self, object, relationship=None, targetObject=None):
+        """UIDs of the objects referencing object
+
+        object may be given as a UID.
+        """
+        return self._relatedUIDs(object, relationship, targetObject,
+                                 attribute='targetUID')
+
+    security.declarePrivate('searchReferences')
+    def searchReferences(self, object, relationship=None, query=None,
+                         catalog='portal_catalog', **kw):
+        """Catalog brains of the objects referenced by object
+
+        query and keyword arguments are a query for catalog, e.g.
+        portal_type, review_state, path or sort_on. The catalog only
+        searches among the referenced objects, so filtering, sorting and
+        batching happen there and no object is woken up.
+        """
+        uids = self.getTargetUIDs(object, relationship)
+        return self._searchUIDs(uids, query, catalog, **kw)
+
+    security.declarePrivate('searchBackReferences')
+    def searchBackReferences(self, object, relationship=None, query=None,
+                             catalog='portal_catalog', **kw):
+        """Catalog brains of the objects referencing object
+
+        See searchReferences.
+        """
+        uids = self.getSourceUIDs(object, relationship)
+        return self._searchUIDs(uids, query, catalog, **kw)
+
+    def _searchUIDs(self, uids, query, catalog, **kw):
+        if not uids:
+            # an empty UID query would not restrict the search at all
+            return LazyCat([])
+        query = dict(query or {}, **kw)
+        query['UID'] = list(set(uids))
+        return getToolByName(self, catalog).searchResults(query)
+
+    security.declarePrivate('traverse')
+    def traverse(self, object, relationship=None, direction='forward',
+                 max_depth=1, limit=None, resolve=False):
+        """Walk the reference graph breadth first, starting at object
+
+        Returns an iterator of (uid, depth, path) for every object reachable
+        within max_depth hops (None for no limit) over references with the
+        given relationship(s). direction is 'forward' (follow references),
+        'backward' (follow back references) or 'both'. path is the tuple of
+        UIDs leading from object to uid. Every object is reported once, at
+        its smallest depth, and at most limit objects are reported.
+
+        Only the reference indexes are used, no content object is loaded
+        unless resolve is true. In that case the walk is completed first and
+        all UIDs are resolved in one go, giving (object, depth, path) for
+        the objects that could be found.
+        """
+        if isinstance(object, basestring):
+            uid = object
+        else:
+            uid = self._uidFor(object)[0]
+        try:
+            attributes = {'forward': ('sourceUID', ),
+                          'backward': ('targetUID', ),
+                          'both': ('sourceUID', 'targetUID')}[direction]
+        except KeyError:
+            raise ValueError('Unknown direction %r' % direction)
+
+        walk = self._walk(uid, relationship, attributes, max_depth)
+        if limit is not None:
+            walk = islice(walk, limit)
+        if not resolve:
+            return walk
+        return self._resolveWalk(list(walk))
+
+    def _walk(self, start, relationship, attributes, max_depth):
+        visited = set([start])
+        frontier = [(start, (start, ))]
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            reached = []
+            for uid, path in frontier:
+                for attribute in attributes:
+                    for other in self._relatedUIDs(uid, relationship,
+                                                   attribute=attribute):
+                        if other in visited:
+                            continue
+                        visited.add(other)
+                        other_path = path + (other, )
+                        yield other, depth, other_path
+                        reached.append((other, other_path))
+            frontier = reached
+
+    def _resolveWalk(self, nodes):
+        resolved = self._uidsFor([uid for uid, depth, path in nodes])
+        for (uid, obj), (uid, depth, path) in zip(resolved, nodes):
+            if obj is not None:
+                yield obj, depth, path
+
+    def _relatedUIDs(self, object, relationship=None, targetObject=None,
+                     attribute='sourceUID'):
+        if isinstance(object, basestring):
+            uid = object
+        else:
+            uid = self._uidFor(object)[0]
+        if not uid:
+            return []
+
+        adjacency = self._getAdjacency()
+        if adjacency is None:
+            if targetObject:
+                tID, tobj = self._uidFor(targetObject)
+                if attribute == 'sourceUID':
+                    brains = self._queryFor(uid, tID, relationship)
+                else:
+                    brains = self._queryFor(tID, uid, relationship)
+            else:
+                brains = self._optimizedQuery(uid, attribute, relationship)
+            if attribute == 'sourceUID':
+                return [b.targetUID for b in brains]
+            return [b.sourceUID for b in brains]
+
+        other = None
+        if targetObject:
+            other = self._uidFor(targetObject)[0]
+        if attribute == 'sourceUID':
+            return [edge[1] for path, edge in
+                    adjacency.search(uid, other, relationship)]
+        return [edge[0] for path, edge in
+                adjacency.search(other, uid, relationship)]
+
     def _optimizedQuery(self, uid, indexname, relationship):
         """query reference catalog for object matching the info we are
         given, returns brains
@@ -395,6 +695,13 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
         if not uid:  # pragma: no cover
             return []
 
+        adjacency = self._getAdjacency()
+        if adjacency is not None:
+            if indexname == 'sourceUID':
+                return self._brainsFor(adjacency.search(uid, None,
+                                                        relationship))
+            return self._brainsFor(adjacency.search(None, uid, relationship))
+
         _catalog = self._catalog
         indexes = _catalog.indexes
 
@@ -434,6 +741,11 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
         sID, sobj = self._uidFor(source)
         tID, tobj = self._uidFor(target)
 
+        adjacency = self._getAdjacency()
+        if adjacency is not None:
+            return bool(sID and tID and
+                        adjacency.search(sID, tID, relationship))
+
         brains = self._queryFor(sID, tID, relationship)
         for brain in brains:
             obj = brain.getObject()
@@ -444,6 +756,9 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
     def getRelationships(self, object):
         # Get all relationship types this object has TO other objects
         sID, sobj = self._uidFor(object)
+        adjacency = self._getAdjacency()
+        if adjacency is not None:
+            return adjacency.relationships(sID)
         brains = self._queryFor(sid=sID)
         res = {}
         for brain in brains:
@@ -454,6 +769,9 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
     def getBackRelationships(self, object):
         # Get all relationship types this object has FROM other objects
         sID, sobj = self._uidFor(object)
+        adjacency = self._getAdjacency()
+        if adjacency is not None:
+            return adjacency.backRelationships(sID)
         brains = self._queryFor(tid=sID)
         res = {}
         for b in brains:
@@ -494,13 +812,7 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
     ## Private/Internal
     def _objectByUUID(self, uuid):
         tool = getToolByName(self, UID_CATALOG)
-        brains = tool(UID=uuid)
-        for brain in brains:
-            obj = brain.getObject()
-            if obj is not None:
-                return obj
-        else:
-            return None
+        return tool.resolveUID(uuid)
 
     def _queryFor(self, sid=None, tid=None, relationship=None,
                   targetId=None, merge=1):
@@ -508,8 +820,33 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
         given, returns brains
 
         Note: targetId is the actual id of the target object, not its UID
+
+        Lightweight references aren't cataloged: they are found through the
+        adjacency index, targetId being looked up in the uid catalog. They
+        have no catalog record to return unmerged, so a merge=0 query
+        matching one raises a ReferenceException.
         """
 
+        adjacency = self._getAdjacency()
+        if adjacency is not None and (sid or tid or targetId):
+            if targetId is not None:
+                tids = self._targetUIDs(targetId)
+                if tid:
+                    tids = [uid for uid in tids if uid == tid]
+                edges = []
+                for uid in tids:
+                    edges.extend(adjacency.search(sid, uid, relationship))
+            else:
+                edges = adjacency.search(sid, tid, relationship)
+            if merge:
+                return self._brainsFor(edges)
+            uids = self._catalog.uids
+            for path, edge in edges:
+                if path not in uids:
+                    raise ReferenceException(
+                        'Lightweight references can only be queried with '
+                        'merge=1')
+
         query = {}
         if sid:
             query['sourceUID'] = sid
@@ -523,6 +860,117 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
 
         return brains
 
+    def _targetUIDs(self, targetId):
+        """UIDs of the objects with the id targetId"""
+        uc = getToolByName(self, UID_CATALOG)
+        return [brain.UID for brain in uc(id=targetId)]
+
+    def _getAdjacency(self):
+        return aq_base(self._catalog)._adjacency
+
+    def _brainsFor(self, edges):
+        """Lazily turn adjacency search results into catalog brains
+
+        Lightweight references aren't cataloged and get a
+        ReferenceRecordBrain instead.
+        """
+        _catalog = self._catalog
+        uids_get = _catalog.uids.get
+
+        def brain(item):
+            path, edge = item
+            rid = uids_get(path)
+            if rid is None:
+                return ReferenceRecordBrain(path, edge).__of__(self)
+            return _catalog[rid]
+
+        return LazyMap(brain, edges, len(edges))
+
+    ###
+    ## Lightweight references
+    def _useRecords(self, referenceClass, kwargs, lightweight=None):
+        """Can a reference be stored as a record instead of an object?
+
+        Only plain references qualify; reference classes with hooks or extra
+        attributes always need an object. Records are only visible through
+        the adjacency index, so the catalog needs to have one.
+        """
+        if lightweight is None:
+            lightweight = self.lightweight_references
+        return bool(lightweight and not kwargs and
+                    referenceClass in (None, Reference) and
+                    self._getAdjacency() is not None)
+
+    def _recordPath(self, sobj, rID):
+        # the path a Reference object with this id would be cataloged at
+        return '%s/%s/%s' % (sobj._getURL(), REFERENCE_ANNOTATION, rID)
+
+    def _addRecord(self, sobj, rID, sID, tID, relationship):
+        invalidateReferencesMemo(self)
+        sobj._getReferenceRecords(create=True)[rID] = (tID, relationship)
+        self._getAdjacency().index(self._recordPath(sobj, rID), sID, tID,
+                                   relationship)
+        return self._recordReference(sobj, rID)
+
+    def _recordReference(self, sobj, rID):
+        """A transient Reference object for the record rID held by sobj"""
+        records = sobj._getReferenceRecords()
+        if records is None or rID not in records:
+            return None
+        tID, relationship = records[rID]
+        reference = Reference(rID, IUUID(sobj, None), tID, relationship)
+        reference._v_record = True
+        # Don't create the annotation folder just to give the reference
+        # its usual path
+        annotation = getattr(aq_base(sobj), REFERENCE_ANNOTATION, None)
+        if annotation is None:
+            annotation = BTreeFolder2(REFERENCE_ANNOTATION)
+        return reference.__of__(annotation.__of__(sobj))
+
+    def _removeReference(self, sobj, rID):
+        """Remove the reference rID held by sobj, record or object"""
+        records = sobj._getReferenceRecords()
+        if records is not None and rID in records:
+            invalidateReferencesMemo(self)
+            del records[rID]
+            adjacency = self._getAdjacency()
+            if adjacency is not None:
+                adjacency.unindex(self._recordPath(sobj, rID))
+            return
+        sobj._getReferenceAnnotations()._delObject(rID)
+
+    def _indexRecords(self, sobj):
+        """(Re)index the records held by sobj in the adjacency index"""
+        adjacency = self._getAdjacency()
+        records = sobj._getReferenceRecords()
+        if adjacency is None or not records:
+            return
+        invalidateReferencesMemo(self)
+        sID = IUUID(sobj, None)
+        for rID, (tID, relationship) in records.items():
+            adjacency.index(self._recordPath(sobj, rID), sID, tID,
+                            relationship)
+
+    def _unindexRecords(self, sobj):
+        adjacency = self._getAdjacency()
+        records = sobj._getReferenceRecords()
+        if adjacency is None or not records:
+            return
+        invalidateReferencesMemo(self)
+        for rID in records.keys():
+            adjacency.unindex(self._recordPath(sobj, rID))
+
+    def _retargetRecord(self, reference, tID):
+        """Point the record behind a transient reference to tID"""
+        invalidateReferencesMemo(self)
+        sobj = reference.getSourceObject()
+        rID = reference.getId()
+        records = sobj._getReferenceRecords()
+        relationship = records[rID][1]
+        records[rID] = (tID, relationship)
+        self._getAdjacency().index(self._recordPath(sobj, rID),
+                                   reference.sourceUID, tID, relationship)
+
     def _uidFor(self, obj):
         # We should really check for the interface but I have an idea
         # about simple annotated objects I want to play out
@@ -540,11 +988,7 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
             obj = None
             #and we look up the object
             uid_catalog = getToolByName(self, UID_CATALOG)
-            brains = uid_catalog(dict(UID=uuid))
-            for brain in brains:
-                res = brain.getObject()
-                if res is not None:
-                    obj = res
+            obj = uid_catalog.resolveUID(uuid)
         return uuid, obj
 
     def _getUUIDFor(self, object):
@@ -562,17 +1006,91 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
         except ReferenceException:
             pass
         else:
-            annotation = sobj._getReferenceAnnotations()
             try:
-                annotation._delObject(IUUID(referenceObject, None))
+                self._removeReference(sobj, IUUID(referenceObject, None))
             except (AttributeError, KeyError):
                 pass
 
+    def _deleteReferencesTo(self, source, targets, relationship=None):
+        sID, sobj = self._uidFor(source)
+        if not sID or sobj is None:
+            return
+        tIDs = set()
+        for target in targets:
+            if isinstance(target, basestring):
+                tIDs.add(target)
+            else:
+                tIDs.add(IUUID(target, None))
+
+        records = sobj._getReferenceRecords()
+        annotation = None
+        uc = getToolByName(self, UID_CATALOG)
+        for brain in self._queryFor(sID, None, relationship):
+            if brain.targetUID not in tIDs:
+                continue
+            rID = brain.getPath().split('/')[-1]
+            if records is not None and rID in records:
+                # plain references have no delHook to consult
+                self._removeReference(sobj, rID)
+                continue
+            if annotation is None:
+                annotation = sobj._getReferenceAnnotations()
+            referenceObject = annotation._getOb(rID, None)
+            if referenceObject is None:
+                continue
+            try:
+                referenceObject.delHook(self, sobj,
+                                        referenceObject.getTargetObject())
+            except ReferenceException:
+                continue
+            # References with custom delete handling, or which are
+            # themselves referenced, go through the regular OFS hooks.
+            base = aq_base(referenceObject)
+            beforeDelete = getattr(base, 'manage_beforeDelete', None)
+            if (getattr(beforeDelete, 'im_func', None) is not
+                    Reference.manage_beforeDelete.im_func or
+                    base._getReferenceObjects() or
+                    self._queryFor(tid=rID)):
+                annotation._delObject(rID)
+                continue
+            url = getRelURL(uc, referenceObject.getPhysicalPath())
+            if uc.getrid(url) is not None:
+                uc.uncatalog_object(url)
+            self.uncatalog_object(url)
+            annotation._delObject(rID, suppress_events=True)
+
+    def _uidsFor(self, objs):
+        """Like _uidFor for a sequence of objects or UIDs
+
+        UIDs are resolved with a single lookup of the uid catalog.
+        """
+        uids = [obj for obj in objs if isinstance(obj, basestring)]
+        uc = getToolByName(self, UID_CATALOG)
+        resolved = dict(zip(uids, uc.resolveUIDs(uids)))
+
+        result = []
+        for obj in objs:
+            if not isinstance(obj, basestring):
+                result.append(self._uidFor(obj))
+                continue
+            result.append((obj, resolved[obj]))
+        return result
+
     def _resolveBrains(self, brains):
         objects = []
         if brains:
-            objects = [b.getObject() for b in brains]
-            objects = [b for b in objects if b]
+            # cataloged references are resolved at once by their UID,
+            # lightweight records build their reference themselves
+            uids = [b.UID for b in brains
+                    if not isinstance(b, ReferenceRecordBrain) and b.UID]
+            uc = getToolByName(self, UID_CATALOG)
+            resolved = dict(zip(uids, uc.resolveUIDs(uids)))
+            for b in brains:
+                obj = resolved.get(b.UID)
+                if obj is None:
+                    obj = b.getObject()
+                if obj:
+                    objects.append(obj)
         return objects
 
     def _makeName(self, *args):
@@ -583,9 +1101,58 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
     def __nonzero__(self):
         return 1
 
+    security.declareProtected(permissions.ManagePortal,
+                              'manage_rebuildAdjacency')
+    def manage_rebuildAdjacency(self, REQUEST=None, RESPONSE=None):
+        """Build the reference adjacency index from the cataloged references
+        """
+        elapse = time.time()
+        c_elapse = time.clock()
+
+        _catalog = self._catalog
+        indexes = _catalog.indexes
+        sources = indexes['sourceUID']._unindex.get
+        targets = indexes['targetUID']._unindex.get
+        relationships = indexes['relationship']._unindex.get
+
+        invalidateReferencesMemo(self)
+        old = _catalog._adjacency
+        adjacency = _catalog._adjacency = ReferenceAdjacency()
+        if old is not None:
+            # lightweight references aren't cataloged, keep them
+            for path, edge in old._edges.items():
+                if path not in _catalog.uids:
+                    adjacency.index(path, *edge)
+        for count, (rid, path) in enumerate(_catalog.paths.items()):
+            sid = sources(rid)
+            tid = targets(rid)
+            if sid and tid:
+                adjacency.index(path, sid, tid, relationships(rid))
+            if count and not count % 10000:
+                transaction.savepoint(optimistic=True)
+
+        elapse = time.time() - elapse
+        c_elapse = time.clock() - c_elapse
+
+        if RESPONSE:
+            RESPONSE.redirect(
+            REQUEST.URL1 +
+            '/manage_catalogView?manage_tabs_message=' +
+            urllib.quote('Adjacency index rebuilt: %s references\n'
+                         'Total time: %s\n'
+                         'Total CPU time: %s'
+                         % (len(adjacency), `elapse`, `c_elapse`))
+            )
+        return len(adjacency)
+
     def _catalogReferencesFor(self, obj, path):
         if IReferenceable.providedBy(obj):
             obj._catalogRefs(self)
+            # savepoint now and then, so that walking the whole site
+            # doesn't keep every object in memory
+            self._v_catalogued = getattr(self, '_v_catalogued', 0) + 1
+            if not self._v_catalogued % self.rebuild_chunk_size:
+                transaction.savepoint(optimistic=True)
 
     def _catalogReferences(self, root=None, **kw):
         ''' catalogs all references, where the optional parameter 'root'
@@ -641,26 +1208,16 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
         elapse = time.time()
         c_elapse = time.clock()
 
-        atool = getToolByName(self, TOOL_NAME)
-        obj = aq_parent(self)
-        if not REQUEST:
-            REQUEST = self.REQUEST
-
-        # build a list of archetype meta types
-        mt = tuple([typ['meta_type'] for typ in atool.listRegisteredTypes()])
-
-        # clear the catalog
-        self.manage_catalogClear()
-
-        # find and catalog objects
-        self._catalogReferences(obj,
-                                obj_metatypes=mt,
-                                REQUEST=REQUEST)
+        # recatalog the references of every object of the portal, in
+        # chunks separated by savepoints
+        self.rebuildReferences(resume=False)
 
         elapse = time.time() - elapse
         c_elapse = time.clock() - c_elapse
 
         if RESPONSE:
+            if not REQUEST:
+                REQUEST = self.REQUEST
             RESPONSE.redirect(
             REQUEST.URL1 +
             '/manage_catalogView?manage_tabs_message=' +
@@ -670,6 +1227,120 @@ class ReferenceCatalog(UniqueObject, UIDResolver, ZCatalog):
                          % (`elapse`, `c_elapse`))
             )
 
+    security.declarePrivate('rebuildReferences')
+    def rebuildReferences(self, chunk_size=None, commit=False, resume=True,
+                          verify=False):
+        """Recatalog the references held by the objects of the portal
+
+        The portal is walked in chunks of chunk_size objects, in the order
+        of their paths, so that objects missing from the uid catalog are
+        found too. After every chunk a savepoint is made, or with commit
+        the transaction is committed, and the path of the last object done
+        is stored on the catalog, so that an interrupted rebuild called
+        again with resume continues where it stopped. Only commit from
+        scripts, not from a request.
+
+        With verify nothing is written: the references held by the objects
+        are compared with the cataloged ones and the references missing
+        from the catalog, cataloged differently or cataloged but not held
+        anymore are counted.
+
+        Returns a mapping with the numbers of objects processed, references
+        found and differences, and the throughput in objects per second.
+        """
+        chunk_size = int(chunk_size or self.rebuild_chunk_size)
+        uc = getToolByName(self, UID_CATALOG)
+        portal = getToolByName(self, 'portal_url').getPortalObject()
+
+        stats = dict(processed=0, references=0, missing=0, changed=0, extra=0)
+        state = self._rebuild_state
+        if verify:
+            state = {}
+        elif resume and state:
+            stats['processed'] = state['processed']
+            logger.info('Resuming the reference catalog rebuild after %s',
+                        '/'.join(state['cursor']))
+        else:
+            self.manage_catalogClear()
+            state = self._rebuild_state = PersistentMapping()
+
+        started = time.time()
+        done = 0
+        cursor = tuple(state.get('cursor') or ())
+        for path, obj in uc._walk(portal, (), cursor):
+            # reference objects are catalogued along with their source
+            if (REFERENCE_ANNOTATION not in path and
+                IReferenceable.providedBy(obj)):
+                if verify:
+                    self._verifyReferences(obj, uc, stats)
+                else:
+                    obj._catalogRefs(uc, uc, self)
+                    stats['references'] += (
+                        len(obj._getReferenceObjects()) +
+                        len(obj._getReferenceRecords() or ()))
+
+            done += 1
+            stats['processed'] += 1
+            if done % chunk_size:
+                continue
+            state['cursor'] = path
+            state['processed'] = stats['processed']
+            if not verify:
+                if commit:
+                    transaction.commit()
+                else:
+                    transaction.savepoint(optimistic=True)
+            if self._p_jar is not None:
+                self._p_jar.cacheGC()
+            rate = done / max(time.time() - started, 0.001)
+            logger.info('Reference catalog rebuild: %s objects '
+                        '(%.1f objects/s)', stats['processed'], rate)
+
+        if not verify:
+            self._rebuild_state = None
+            if commit:
+                transaction.commit()
+        stats['rate'] = done / max(time.time() - started, 0.001)
+        if verify:
+            logger.info('Reference catalog verified: %(missing)s missing, '
+                        '%(changed)s changed and %(extra)s extra references',
+                        stats)
+        return stats
+
+    def _verifyReferences(self, obj, uc, stats):
+        # compare the references held by obj with the cataloged ones
+        expected = {}
+        for ref in obj._getReferenceObjects():
+            path = getRelURL(uc, ref.getPhysicalPath())
+            expected[path] = (ref.sourceUID, ref.targetUID, ref.relationship)
+        stats['references'] += len(expected)
+
+        _catalog = self._catalog
+        indexes = _catalog.indexes
+        rids = indexes['sourceUID']._index.get(IUUID(obj, None), ())
+        if isinstance(rids, int):
+            rids = (rids, )
+        cataloged = {}
+        for rid in rids:
+            cataloged[_catalog.paths[rid]] = (
+                indexes['sourceUID']._unindex.get(rid),
+                indexes['targetUID']._unindex.get(rid),
+                indexes['relationship']._unindex.get(rid))
+
+        for path, edge in expected.items():
+            found = cataloged.pop(path, None)
+            if found is None:
+                stats['missing'] += 1
+                logger.debug('Reference %s is not cataloged', path)
+            elif found != edge:
+                stats['changed'] += 1
+                logger.debug('Reference %s is cataloged as %r instead of %r',
+                             path, found, edge)
+        for path in cataloged:
+            stats['extra'] += 1
+            logger.debug('Reference %s is cataloged but not held by %s',
+                         path, obj._getURL())
+
 InitializeClass(ReferenceCatalog)
 
 
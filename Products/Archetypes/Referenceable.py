@@ -6,13 +6,16 @@ from Products.Archetypes import config
 from Products.Archetypes.exceptions import ReferenceException
 from Products.Archetypes.interfaces import IReferenceable
 from Products.Archetypes.utils import shasattr, isFactoryContained
+from Products.Archetypes.utils import LazyReferences, referencesMemo
 
 from Acquisition import aq_base, aq_parent, aq_inner
+from BTrees.OOBTree import OOBTree
 from OFS.ObjectManager import BeforeDeleteException
 
 from Products.CMFCore.utils import getToolByName
 from OFS.CopySupport import CopySource
-from OFS.Folder import Folder
+from Products.BTreeFolder2.BTreeFolder2 import BTreeFolder2
+from Products.BTreeFolder2.BTreeFolder2 import BTreeFolder2Base
 from utils import getRelURL
 
 from App.class_init import InitializeClass
@@ -54,6 +57,12 @@ class Referenceable(CopySource):
         return tool.addReference(self, object, relationship, referenceClass,
                                  updateReferences, **kwargs)
 
+    def addReferences(self, objects, relationship=None, referenceClass=None,
+                      updateReferences=True, **kwargs):
+        tool = getToolByName(self, config.REFERENCE_CATALOG)
+        return tool.addReferences(self, objects, relationship, referenceClass,
+                                  updateReferences, **kwargs)
+
     def deleteReference(self, target, relationship=None):
         tool = getToolByName(self, config.REFERENCE_CATALOG)
         return tool.deleteReference(self, target, relationship)
@@ -74,12 +83,7 @@ class Referenceable(CopySource):
 
     def getRefs(self, relationship=None, targetObject=None):
         # get all the referenced objects for this object
-        tool = getToolByName(self, 'reference_catalog')
-        brains = tool.getReferences(self, relationship, targetObject=targetObject,
-                                    objects=False)
-        if brains:
-            return [self._optimizedGetObject(b.targetUID) for b in brains]
-        return []
+        return self._lazyReferences('sourceUID', relationship, targetObject)
 
     def _getURL(self):
         # the url used as the relative path based uid in the catalogs
@@ -87,12 +91,50 @@ class Referenceable(CopySource):
 
     def getBRefs(self, relationship=None, targetObject=None):
         # get all the back referenced objects for this object
-        tool = getToolByName(self, 'reference_catalog')
-        brains = tool.getBackReferences(self, relationship,
-                                        targetObject=targetObject, objects=False)
-        if brains:
-            return [self._optimizedGetObject(b.sourceUID) for b in brains]
-        return []
+        return self._lazyReferences('targetUID', relationship, targetObject)
+
+    def _lazyReferences(self, attribute, relationship, targetObject):
+        # The UIDs on the other end are looked up once per request, the
+        # objects are only resolved when the result is accessed. Writes to
+        # the uid or reference catalog forget the memo.
+        memo = referencesMemo(self)
+        uid = IUUID(self, None)
+        key = None
+        if memo is not None and uid is not None:
+            if isinstance(relationship, list):
+                relationship = tuple(relationship)
+            target = targetObject
+            if target is not None and not isinstance(target, basestring):
+                target = IUUID(target, None)
+            key = (attribute, uid, relationship, target)
+            if key in memo:
+                uids, cache = memo[key]
+                return LazyReferences(uids, self._resolveUIDs, cache)
+
+        tool = getToolByName(self, config.REFERENCE_CATALOG)
+        if attribute == 'sourceUID':
+            uids = tool.getTargetUIDs(self, relationship, targetObject)
+        else:
+            uids = tool.getSourceUIDs(self, relationship, targetObject)
+        cache = {}
+        if key is not None:
+            memo[key] = (uids, cache)
+        return LazyReferences(uids, self._resolveUIDs, cache)
+
+    def _resolveUIDs(self, uids):
+        tool = getToolByName(self, config.UID_CATALOG)
+        return tool.resolveUIDs(uids)
+
+    def searchRefs(self, relationship=None, query=None, **kw):
+        # catalog brains of the referenced objects matching a catalog query
+        tool = getToolByName(self, config.REFERENCE_CATALOG)
+        return tool.searchReferences(self, relationship, query, **kw)
+
+    def searchBRefs(self, relationship=None, query=None, **kw):
+        # catalog brains of the back referenced objects matching a catalog
+        # query
+        tool = getToolByName(self, config.REFERENCE_CATALOG)
+        return tool.searchBackReferences(self, relationship, query, **kw)
 
     #aliases
     getReferences = getRefs
@@ -118,19 +160,7 @@ class Referenceable(CopySource):
         tool = getToolByName(self, 'uid_catalog', None)
         if tool is None:  # pragma: no cover
             return ''
-        tool = aq_inner(tool)
-        traverse = aq_parent(tool).unrestrictedTraverse
-
-        _catalog = tool._catalog
-        rids = _catalog.indexes['UID']._index.get(uid, ())
-        if isinstance(rids, int):
-            rids = (rids, )
-
-        for rid in rids:
-            path = _catalog.paths[rid]
-            obj = traverse(path, default=None)
-            if obj is not None:
-                return obj
+        return tool.resolveUID(uid)
 
     def _register(self, reference_manager=None):
         # register with the archetype tool for a unique id
@@ -148,17 +178,48 @@ class Referenceable(CopySource):
 
     def _getReferenceAnnotations(self):
         # given an object, extract the bag of references for which it is the
-        # source
-        if not getattr(aq_base(self), config.REFERENCE_ANNOTATION, None):
-            setattr(self, config.REFERENCE_ANNOTATION,
-                    Folder(config.REFERENCE_ANNOTATION))
-
-        return getattr(self, config.REFERENCE_ANNOTATION).__of__(self)
+        # source. A BTreeFolder2 keeps adding or removing a reference
+        # O(log n) and conflict resolvable.
+        annotations = getattr(aq_base(self), config.REFERENCE_ANNOTATION, None)
+        if annotations is None:
+            annotations = BTreeFolder2(config.REFERENCE_ANNOTATION)
+            setattr(self, config.REFERENCE_ANNOTATION, annotations)
+        return annotations.__of__(self)
+
+    def _getReferenceObjects(self):
+        # the reference objects held by us, without creating the annotation
+        annotations = getattr(aq_base(self), config.REFERENCE_ANNOTATION, None)
+        if annotations is None:
+            return []
+        return annotations.__of__(self).objectValues()
+
+    def _migrateReferenceAnnotations(self):
+        # move references out of an OFS Folder annotation, as used before
+        # at_references became a BTreeFolder2. The references keep their
+        # paths so the catalogs stay valid. Returns True if anything changed.
+        old = getattr(aq_base(self), config.REFERENCE_ANNOTATION, None)
+        if old is None or isinstance(old, BTreeFolder2Base):
+            return False
+        annotations = BTreeFolder2(config.REFERENCE_ANNOTATION)
+        annotations._populateFromFolder(old)
+        setattr(self, config.REFERENCE_ANNOTATION, annotations)
+        return True
 
     def _delReferenceAnnotations(self):
         # Removes annotation from self
-        if getattr(aq_base(self), config.REFERENCE_ANNOTATION, None):
+        if getattr(aq_base(self), config.REFERENCE_ANNOTATION, None) is not None:
             delattr(self, config.REFERENCE_ANNOTATION)
+        if getattr(aq_base(self), config.REFERENCE_RECORDS, None) is not None:
+            delattr(self, config.REFERENCE_RECORDS)
+
+    def _getReferenceRecords(self, create=False):
+        # the lightweight references for which we are the source, as
+        # reference id -> (targetUID, relationship)
+        records = getattr(aq_base(self), config.REFERENCE_RECORDS, None)
+        if records is None and create:
+            records = OOBTree()
+            setattr(self, config.REFERENCE_RECORDS, records)
+        return records
 
     def UID(self):
         return IUUID(self, None)
@@ -172,6 +233,9 @@ class Referenceable(CopySource):
         fw_refs = self.getReferenceImpl()
         for ref in fw_refs:
             assert ref.sourceUID == old_uid
+            if getattr(ref, '_v_record', None):
+                # reindexed below, once we carry the new uid
+                continue
             ref.sourceUID = uid
             item = ref
             container = aq_parent(aq_inner(ref))
@@ -180,8 +244,12 @@ class Referenceable(CopySource):
             ref.manage_afterAdd(item, container)
         # Update back references
         back_refs = self.getBackReferenceImpl()
+        rc = getToolByName(self, config.REFERENCE_CATALOG)
         for ref in back_refs:
             assert ref.targetUID == old_uid
+            if getattr(ref, '_v_record', None):
+                rc._retargetRecord(ref, uid)
+                continue
             ref.targetUID = uid
             item = ref
             container = aq_parent(aq_inner(ref))
@@ -189,6 +257,7 @@ class Referenceable(CopySource):
             # reference catalog about changes.
             ref.manage_afterAdd(item, container)
         setattr(self, config.UUID_ATTR, uid)
+        rc._indexRecords(self)
         item = self
         container = aq_parent(aq_inner(item))
         # We call manage_afterAdd to inform the
@@ -325,13 +394,17 @@ class Referenceable(CopySource):
             uc.uncatalog_object(url)
 
     def _catalogRefs(self, aq, uc=None, rc=None):
-        annotations = self._getReferenceAnnotations()
-        if annotations:
+        if self._getReferenceRecords():
+            if not rc:
+                rc = getToolByName(aq, config.REFERENCE_CATALOG)
+            rc._indexRecords(self)
+        references = self._getReferenceObjects()
+        if references:
             if not uc:
                 uc = getToolByName(aq, config.UID_CATALOG)
             if not rc:
                 rc = getToolByName(aq, config.REFERENCE_CATALOG)
-            for ref in annotations.objectValues():
+            for ref in references:
                 url = getRelURL(uc, ref.getPhysicalPath())
                 uc.catalog_object(ref, url)
                 rc.catalog_object(ref, url)
@@ -340,13 +413,17 @@ class Referenceable(CopySource):
     def _uncatalogRefs(self, aq, uc=None, rc=None):
         if isFactoryContained(self):
             return
-        annotations = self._getReferenceAnnotations()
-        if annotations:
+        if self._getReferenceRecords():
+            if not rc:
+                rc = getToolByName(self, config.REFERENCE_CATALOG)
+            rc._unindexRecords(self)
+        references = self._getReferenceObjects()
+        if references:
             if not uc:
                 uc = getToolByName(self, config.UID_CATALOG)
             if not rc:
                 rc = getToolByName(self, config.REFERENCE_CATALOG)
-            for ref in annotations.objectValues():
+            for ref in references:
                 url = getRelURL(uc, ref.getPhysicalPath())
                 # XXX This is an ugly workaround. This method shouldn't be
                 # called twice for an object in the first place, so we don't
@@ -401,7 +478,7 @@ class Referenceable(CopySource):
             # called multiple times.
             nc = lambda obj: isinstance(obj, Referenceable)
             children.extend(filter(nc, self.objectValues()))
-        children.extend(self._getReferenceAnnotations().objectValues())
+        children.extend(self._getReferenceObjects())
         if children:
             for child in children:
                 if shasattr(Referenceable, methodName):
@@ -2,6 +2,7 @@ import logging
 import os
 import time
 import urllib
+import transaction
 from zope.interface import implements
 from zope import component
 from zope import interface
@@ -9,6 +10,7 @@ from zope import interface
 from App.class_init import InitializeClass
 from App.special_dtml import DTMLFile
 from ExtensionClass import Base
+from Persistence import PersistentMapping
 from ZODB.POSException import ConflictError
 from AccessControl import ClassSecurityInfo
 from AccessControl.Permissions import manage_zcatalog_entries as ManageZCatalogEntries
@@ -23,6 +25,8 @@ from Products.Archetypes.config import UID_CATALOG
 from Products.Archetypes.config import TOOL_NAME
 from Products.Archetypes.interfaces import IUIDCatalog
 from Products.Archetypes.utils import getRelURL
+from Products.Archetypes.utils import invalidateReferencesMemo
+from Products.Archetypes.uidcache import uid_path_cache
 from plone.indexer.interfaces import IIndexableObject
 from plone.indexer.decorator import indexer
 from plone.uuid.interfaces import IUUID, IUUIDAware
@@ -106,6 +110,13 @@ class UIDCatalogBrains(AbstractCatalogBrain):
                 if REQUEST is None:
                     REQUEST = self.REQUEST
                 obj = self.aq_parent.resolve_url(self.getPath(), REQUEST)
+            elif IUUID(obj, None) == self.UID:
+                catalog = aq_parent(self)
+                # reference catalog brains share this class, only paths
+                # found in the uid catalog are cached
+                if isinstance(aq_base(catalog), UIDCatalog):
+                    uid_path_cache.set(catalog._uidCacheScope(), self.UID,
+                                       path)
 
             return obj
         except (ConflictError, KeyboardInterrupt):
@@ -194,6 +205,26 @@ InitializeClass(UIDResolver)
 class UIDBaseCatalog(PluggableCatalog):
     BASE_CLASS = UIDCatalogBrains
 
+    # The catalog built by UIDCatalog.rebuildCatalog, it gets the changes
+    # made while the rebuild is running
+    _shadow = None
+
+    # objects moving around change what references resolve to
+    def catalogObject(self, object, uid, threshold=None, idxs=None,
+                      update_metadata=1):
+        invalidateReferencesMemo(self)
+        if self._shadow is not None:
+            self._shadow.__of__(aq_parent(self)).catalogObject(
+                object, uid, threshold, idxs, update_metadata)
+        return PluggableCatalog.catalogObject(
+            self, object, uid, threshold, idxs, update_metadata)
+
+    def uncatalogObject(self, uid):
+        invalidateReferencesMemo(self)
+        if self._shadow is not None:
+            self._shadow.__of__(aq_parent(self)).uncatalogObject(uid)
+        return PluggableCatalog.uncatalogObject(self, uid)
+
 
 class UIDCatalog(UniqueObject, UIDResolver, ZCatalog):
     """Unique id catalog
@@ -205,6 +236,11 @@ class UIDCatalog(UniqueObject, UIDResolver, ZCatalog):
 
     manage_catalogFind = DTMLFile('catalogFind', _catalog_dtml)
 
+    # Objects visited between two savepoints or commits when rebuilding,
+    # see rebuildCatalog
+    rebuild_chunk_size = 1000
+    _rebuild_state = None
+
     def __init__(self, id, title='', vocab_id=None, container=None):
         """We hook up the brains now"""
         ZCatalog.__init__(self, id, title, vocab_id, container)
@@ -216,15 +252,132 @@ class UIDCatalog(UniqueObject, UIDResolver, ZCatalog):
 
         if idxs is None:
             idxs = []
-        w = object
+        w = self._indexable(object)
+
+        ZCatalog.catalog_object(self, w, uid, idxs,
+                                update_metadata, pghandler=pghandler)
+
+    def _indexable(self, object):
         if not IIndexableObject.providedBy(object):
             # This is the CMF 2.2 compatible approach, which should be used going forward
             wrapper = component.queryMultiAdapter((object, self), IIndexableObject)
             if wrapper is not None:
-                w = wrapper
+                return wrapper
+        return object
 
-        ZCatalog.catalog_object(self, w, uid, idxs,
-                                update_metadata, pghandler=pghandler)
+    security.declarePrivate('resolveUID')
+    def resolveUID(self, uid):
+        """Return the object with the given UID or None
+        """
+        return self.resolveUIDs((uid, ))[0]
+
+    security.declarePrivate('resolveUIDs')
+    def resolveUIDs(self, uids):
+        """Return the objects with the given UIDs, in the same order
+
+        Missing objects are returned as None. The paths are looked up in
+        the process wide UID cache first; the UID index is only used when
+        the cache misses or the cached path does not lead to the object
+        anymore. All paths are traversed at once, see _resolvePaths.
+        """
+        scope = self._uidCacheScope()
+        found = {}
+
+        cached = {}
+        for uid in uids:
+            if uid not in cached:
+                path = uid_path_cache.get(scope, uid)
+                if path is not None:
+                    cached[uid] = path
+        if cached:
+            objects = self._resolvePaths(cached.values())
+            for uid, path in cached.items():
+                obj = objects[path]
+                if obj is not None and IUUID(obj, None) == uid:
+                    uid_path_cache.hit()
+                    found[uid] = obj
+                else:
+                    uid_path_cache.invalidate(uid)
+
+        _catalog = self._catalog
+        index_get = _catalog.indexes['UID']._index.get
+        candidates = []
+        for uid in set(uids):
+            if uid in found:
+                continue
+            uid_path_cache.miss()
+            rids = index_get(uid, ())
+            if isinstance(rids, int):
+                rids = (rids, )
+            candidates.append((uid, [_catalog.paths[rid] for rid in rids]))
+        if candidates:
+            objects = self._resolvePaths(
+                [path for uid, paths in candidates for path in paths])
+            for uid, paths in candidates:
+                for path in paths:
+                    obj = objects[path]
+                    if obj is not None:
+                        if IUUID(obj, None) == uid:
+                            uid_path_cache.set(scope, uid, path)
+                        found[uid] = obj
+                        break
+
+        return [found.get(uid) for uid in uids]
+
+    def _resolvePaths(self, paths):
+        """Map paths relative to the portal to the objects found there
+
+        The paths are sorted so that objects in the same container follow
+        each other, and the containers shared with the previous path are
+        not traversed again.
+        """
+        portal = aq_parent(aq_inner(self))
+        result = {}
+        steps = []      # names of the last path traversed
+        stack = [portal]  # objects along the last path traversed
+        for path in sorted(set(paths)):
+            if path.startswith('/'):
+                # cataloged outside of the portal
+                result[path] = portal.unrestrictedTraverse(path, None)
+                continue
+            names = path.split('/')
+            common = 0
+            for name, last in zip(names[:-1], steps):
+                if name != last:
+                    break
+                common += 1
+            del stack[common + 1:]
+            del steps[common:]
+            obj = stack[-1]
+            for name in names[common:]:
+                if obj is None:
+                    break
+                obj = obj.unrestrictedTraverse(name, None)
+                stack.append(obj)
+                steps.append(name)
+            result[path] = obj
+        return result
+
+    security.declareProtected(CMFCore.permissions.ManagePortal,
+                              'getUIDCacheStats')
+    def getUIDCacheStats(self):
+        """Hits, misses and size of the process wide UID cache
+        """
+        return uid_path_cache.stats()
+
+    def _uidCacheScope(self):
+        # paths are relative to the portal, so they are only valid for the
+        # uid catalog of this database they were found with
+        scope = getattr(aq_base(self), '_v_uid_cache_scope', None)
+        if scope is None:
+            jar = aq_base(self)._p_jar
+            if jar is None:
+                # not stored yet, don't remember it
+                return '/'.join(self.getPhysicalPath())
+            scope = '%s:%s' % (jar.db().database_name,
+                               '/'.join(self.getPhysicalPath()))
+            self._v_uid_cache_scope = scope
+        return scope
 
     def _catalogObject(self, obj, path):
         """Catalog the object. The object will be cataloged with the absolute
@@ -240,30 +393,14 @@ class UIDCatalog(UniqueObject, UIDResolver, ZCatalog):
         elapse = time.time()
         c_elapse = time.clock()
 
-        atool = getToolByName(self, TOOL_NAME)
-        obj = aq_parent(self)
-        path = '/'.join(obj.getPhysicalPath())
-        if not REQUEST:
-            REQUEST = self.REQUEST
-
-        # build a list of archetype meta types
-        mt = tuple([typ['meta_type'] for typ in atool.listRegisteredTypes()])
-
-        # clear the catalog
-        self.manage_catalogClear()
-
-        # find and catalog objects
-        self.ZopeFindAndApply(obj,
-                              obj_metatypes=mt,
-                              search_sub=1,
-                              REQUEST=REQUEST,
-                              apply_func=self._catalogObject,
-                              apply_path=path)
+        self.rebuildCatalog(resume=False)
 
         elapse = time.time() - elapse
         c_elapse = time.clock() - c_elapse
 
         if RESPONSE:
+            if not REQUEST:
+                REQUEST = self.REQUEST
             RESPONSE.redirect(
             REQUEST.URL1 +
             '/manage_catalogView?manage_tabs_message=' +
@@ -273,4 +410,139 @@ class UIDCatalog(UniqueObject, UIDResolver, ZCatalog):
                          % (`elapse`, `c_elapse`))
             )
 
+    security.declarePrivate('rebuildCatalog')
+    def rebuildCatalog(self, chunk_size=None, commit=False, resume=True):
+        """Rebuild the catalog into a shadow catalog swapped in at the end
+
+        The catalog in use is left alone, so UIDs keep resolving while the
+        portal is walked; changes made meanwhile go to both catalogs. After
+        every chunk of chunk_size objects visited a savepoint is made, or
+        with commit the transaction is committed, and the path of the last
+        object is stored, so that an interrupted rebuild called again with
+        resume continues where it stopped. Only commit from scripts, not
+        from a request.
+
+        Returns the number of objects cataloged.
+        """
+        chunk_size = int(chunk_size or self.rebuild_chunk_size)
+        elapse = time.time()
+        c_elapse = time.clock()
+
+        # build a list of archetype meta types
+        atool = getToolByName(self, TOOL_NAME)
+        mt = set([typ['meta_type'] for typ in atool.listRegisteredTypes()])
+
+        live = self._catalog
+        state = self._rebuild_state
+        if resume and state and live._shadow is not None:
+            cursor = state['cursor']
+            logger.info('Resuming the uid catalog rebuild after %s',
+                        '/'.join(cursor))
+        else:
+            live._shadow = self._emptyCopy(live)
+            state = self._rebuild_state = PersistentMapping(
+                cursor=(), count=0)
+            cursor = ()
+        shadow = live._shadow.__of__(self)
+
+        count = state['count']
+        visited = 0
+        portal = aq_parent(aq_inner(self))
+        for path, obj in self._walk(portal, (), cursor):
+            if getattr(aq_base(obj), 'meta_type', None) in mt:
+                url = '/'.join(path)
+                __traceback_info__ = (repr(obj), url)
+                shadow.catalogObject(self._indexable(obj), url)
+                count += 1
+            visited += 1
+            if not visited % chunk_size:
+                state['cursor'] = path
+                state['count'] = count
+                if commit:
+                    transaction.commit()
+                else:
+                    transaction.savepoint(optimistic=True)
+                logger.info('uid catalog rebuild: %s objects cataloged '
+                            '(%.1f objects/s)', count,
+                            visited / max(time.time() - elapse, 0.001))
+
+        # swap in the new catalog
+        live._shadow = None
+        self._catalog = aq_base(shadow)
+        self._rebuild_state = None
+        invalidateReferencesMemo(self)
+        if commit:
+            transaction.commit()
+
+        elapse = time.time() - elapse
+        c_elapse = time.clock() - c_elapse
+        logger.info('uid catalog rebuilt: %s objects cataloged in %.1fs, '
+                    '%.1fs CPU time (%.1f objects/s)', count, elapse,
+                    c_elapse, visited / max(elapse, 0.001))
+        return count
+
+    def _emptyCopy(self, catalog):
+        # a new catalog with the same columns and indexes
+        copy = UIDBaseCatalog()
+        for name in catalog.names:
+            copy.addColumn(name)
+        for name, index in catalog.indexes.items():
+            copy.addIndex(name, self._emptyIndex(aq_base(index)))
+        return copy
+
+    def _emptyIndex(self, index):
+        # a new index of the class and settings of index, made like
+        # ZCatalog.addIndex makes them, so that nothing is shared with it
+        base = index.__class__
+        varnames = base.__init__.func_code.co_varnames
+        if 'extra' in varnames:
+            return base(index.getId(), extra=_IndexSettings(index),
+                        caller=self)
+        elif 'caller' in varnames:
+            return base(index.getId(), caller=self)
+        return base(index.getId())
+
+    def _walk(self, container, path, cursor=()):
+        """Yield (path, object) for the objects below container
+
+        The tree is walked depth first with the children in the order of
+        their ids, so the paths are yielded in order and the walk can start
+        after the path cursor. Objects become ghosts again once their
+        subtree has been walked, unless they were modified.
+        """
+        for id in sorted(container.objectIds()):
+            child = path + (id, )
+            if child < cursor and cursor[:len(child)] != child:
+                # done before
+                continue
+            obj = container._getOb(id, None)
+            if obj is None:
+                continue
+            if child > cursor:
+                yield child, obj
+            base = aq_base(obj)
+            if hasattr(base, 'objectIds'):
+                for item in self._walk(obj, child, cursor):
+                    yield item
+            if getattr(base, '_p_changed', None) is False:
+                base._p_deactivate()
+
 InitializeClass(UIDCatalog)
+
+
+class _IndexSettings(object):
+    """The extra record of the settings of an index, for _emptyIndex"""
+
+    def __init__(self, index):
+        sources = getattr(index, 'getIndexSourceNames', None)
+        if sources is not None:
+            self.indexed_attrs = self.doc_attr = ','.join(sources())
+        # DateRangeIndex
+        for name in ('since_field', 'until_field'):
+            value = getattr(index, '_' + name, None)
+            if value is not None:
+                setattr(self, name, value)
+        # ZCTextIndex
+        if getattr(index, 'lexicon_id', None) is not None:
+            self.lexicon_id = index.lexicon_id
+            self.index_type = index.getIndexType()
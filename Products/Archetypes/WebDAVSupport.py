@@ -1,5 +1,6 @@
 import tempfile
 import posixpath
+from mimetools import choose_boundary
 
 from zope import event
 from zExceptions import MethodNotAllowed
@@ -12,26 +13,63 @@ from Products.Archetypes.utils import shasattr, mapply
 from zope.interface import implements, Interface
 
 
+def writePdata(f, data, start=0, end=None):
+    """Write the bytes from start up to end of data to the file f
+
+    data is a string, a Pdata chain, which is followed no further than
+    end, or a file opened for reading, e.g. a blob file.
+    """
+    if isinstance(data, str):
+        f.write(data[start:end])
+        return
+    if hasattr(data, 'read'):
+        data.seek(start)
+        left = None
+        if end is not None:
+            left = end - start
+        while left is None or left > 0:
+            size = 1 << 16
+            if left is not None:
+                size = min(left, size)
+            chunk = data.read(size)
+            if not chunk:
+                break
+            f.write(chunk)
+            if left is not None:
+                left -= len(chunk)
+        return
+    pos = 0
+    while data is not None and (end is None or pos < end):
+        chunk = data.data
+        if pos + len(chunk) > start:
+            stop = None
+            if end is not None:
+                stop = end - pos
+            f.write(chunk[max(start - pos, 0):stop])
+        pos += len(chunk)
+        data = data.next
+
+
 class PdataStreamIterator(object):
 
     implements(IStreamIterator)
 
-    def __init__(self, data, size, streamsize=1 << 16):
+    def __init__(self, data, size, streamsize=1 << 16, start=0, end=None):
         # Consume the whole data into a TemporaryFile when
         # constructing, otherwise we might end up loading the whole
         # file in memory or worse, loading objects after the
         # connection is closed.
         f = tempfile.TemporaryFile(mode='w+b')
+        writePdata(f, data, start, end)
 
-        while data is not None:
-            f.write(data.data)
-            data = data.next
-
-        assert size == f.tell(), 'Informed length does not match real length'
+        if end is None:
+            end = size
+        assert end - start == f.tell(), \
+               'Informed length does not match real length'
         f.seek(0)
 
         self.file = f
-        self.size = size
+        self.size = end - start
         self.streamsize = streamsize
 
     def __iter__(self):
@@ -47,6 +85,60 @@ class PdataStreamIterator(object):
     def __len__(self):
         return self.size
 
+
+class PdataRangesStreamIterator(PdataStreamIterator):
+    """The multipart/byteranges body of several ranges of data
+
+    ranges are (start, end) pairs, end excluded.
+    """
+
+    def __init__(self, data, size, ranges, content_type, boundary,
+                 streamsize=1 << 16):
+        f = tempfile.TemporaryFile(mode='w+b')
+        for start, end in ranges:
+            f.write('\r\n--%s\r\n'
+                    'Content-Type: %s\r\n'
+                    'Content-Range: bytes %d-%d/%d\r\n\r\n' %
+                    (boundary, content_type, start, end - 1, size))
+            writePdata(f, data, start, end)
+        f.write('\r\n--%s--\r\n' % boundary)
+
+        self.size = f.tell()
+        f.seek(0)
+        self.file = f
+        self.streamsize = streamsize
+
+
+
+def rangesResponse(RESPONSE, data, size, ranges, content_type):
+    """Answer with the ranges of data, as returned by expandRanges
+
+    data is a string, a Pdata chain or a file opened for reading, which
+    is read before returning and may be closed then.
+    """
+    if not ranges:
+        RESPONSE.setStatus(416)
+        RESPONSE.setHeader('Content-Range', 'bytes */%d' % size)
+        RESPONSE.setHeader('Content-Length', 0)
+        return ''
+    RESPONSE.setStatus(206)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        RESPONSE.setHeader('Content-Type', content_type)
+        RESPONSE.setHeader('Content-Range', 'bytes %d-%d/%d' %
+                           (start, end - 1, size))
+        RESPONSE.setHeader('Content-Length', end - start)
+        if isinstance(data, str):
+            return data[start:end]
+        return PdataStreamIterator(data, size, start=start, end=end)
+    boundary = choose_boundary()
+    body = PdataRangesStreamIterator(data, size, ranges, content_type,
+                                     boundary)
+    RESPONSE.setHeader('Content-Type',
+                       'multipart/byteranges; boundary=%s' % boundary)
+    RESPONSE.setHeader('Content-Length', len(body))
+    return body
+
 _marker = []
 
 
@@ -45,6 +45,10 @@ ATToolModule = sys.modules[ArchetypeTool.__module__]  # mpf :|
 from Products.Archetypes.ReferenceEngine import ReferenceCatalog as RefTool
 from Products.Archetypes.UIDCatalog import UIDCatalog as UIDTool
 
+# let catalog searches see the catalog operations queued so far
+from Products.Archetypes.indexing import wrapCatalogSearches
+wrapCatalogSearches()
+
 
 tools = (ArchetypeTool, RefTool, UIDTool)
 
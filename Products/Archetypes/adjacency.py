@@ -0,0 +1,123 @@
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import intersection
+from Persistence import Persistent
+
+
+class ReferenceAdjacency(Persistent):
+    """Adjacency lists of the references cataloged in a reference catalog.
+
+    Every reference is recorded once under its catalog path. The forward
+    mapping is keyed by (sourceUID, relationship) and the backward mapping by
+    (targetUID, relationship); both hold a small BTree mapping the reference
+    path to the UID at the other end. Lookups are therefore O(log n) and do
+    not need any catalog search or brain.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._edges = OOBTree()     # path -> (sourceUID, targetUID, rel)
+        self._forward = OOBTree()   # (sourceUID, rel) -> {path: targetUID}
+        self._backward = OOBTree()  # (targetUID, rel) -> {path: sourceUID}
+        self._length = Length()
+
+    def __len__(self):
+        return self._length()
+
+    def __contains__(self, path):
+        return path in self._edges
+
+    def get(self, path, default=None):
+        return self._edges.get(path, default)
+
+    def index(self, path, sid, tid, relationship):
+        """Record the reference stored at path"""
+        edge = (sid, tid, relationship)
+        old = self._edges.get(path)
+        if old == edge:
+            return
+        if old is None:
+            self._length.change(1)
+        else:
+            self._unlink(path, old)
+        self._edges[path] = edge
+        self._link(self._forward, (sid, relationship), path, tid)
+        self._link(self._backward, (tid, relationship), path, sid)
+
+    def unindex(self, path):
+        """Forget the reference stored at path"""
+        edge = self._edges.get(path)
+        if edge is None:
+            return
+        del self._edges[path]
+        self._length.change(-1)
+        self._unlink(path, edge)
+
+    def search(self, sid=None, tid=None, relationship=None):
+        """Return (path, (sourceUID, targetUID, relationship)) pairs
+
+        At least one of sid and tid is required. relationship may be None
+        (any relationship), a string or a sequence of strings.
+        """
+        if sid:
+            result = []
+            for rel, bucket in self._buckets(self._forward, sid, relationship):
+                if tid:
+                    back = self._backward.get((tid, rel))
+                    if back is None:
+                        continue
+                    for path in intersection(bucket, back):
+                        result.append((path, (sid, tid, rel)))
+                else:
+                    for path, target in bucket.items():
+                        result.append((path, (sid, target, rel)))
+            return result
+        if tid:
+            return [(path, (source, tid, rel))
+                    for rel, bucket in self._buckets(self._backward, tid,
+                                                     relationship)
+                    for path, source in bucket.items()]
+        raise ValueError('Either a source or a target UID is required')
+
+    def relationships(self, sid):
+        """Relationship names of the references held by sid"""
+        return [rel for rel, bucket in self._buckets(self._forward, sid)]
+
+    def backRelationships(self, tid):
+        """Relationship names of the references pointing to tid"""
+        return [rel for rel, bucket in self._buckets(self._backward, tid)]
+
+    def _buckets(self, tree, uid, relationship=None):
+        if relationship is None:
+            # (uid,) sorts before every (uid, relationship) key
+            for key, bucket in tree.items(min=(uid, )):
+                if key[0] != uid:
+                    break
+                yield key[1], bucket
+            return
+        if isinstance(relationship, basestring):
+            relationship = (relationship, )
+        for rel in set(relationship):
+            bucket = tree.get((uid, rel))
+            if bucket is not None:
+                yield rel, bucket
+
+    def _link(self, tree, key, path, uid):
+        bucket = tree.get(key)
+        if bucket is None:
+            bucket = tree[key] = OOBTree()
+        bucket[path] = uid
+
+    def _unlink(self, path, edge):
+        sid, tid, relationship = edge
+        for tree, key in ((self._forward, (sid, relationship)),
+                          (self._backward, (tid, relationship))):
+            bucket = tree.get(key)
+            if bucket is None:
+                continue
+            if path in bucket:
+                del bucket[path]
+            if not bucket:
+                del tree[key]
@@ -42,9 +42,11 @@ AT_ANN_STORAGE = 'Archetypes.storage.AnnotationStorage'
 AT_MD_STORAGE = 'Archetypes.storage.MetadataAnnotationStorage'
 AT_FIELD_MD = 'Archetypes.field.Metadata'
 AT_REF = 'Archetypes.referenceEngine.Reference'
+AT_IMAGE_SCALES = 'Archetypes.field.ImageScales'
 
 # all keys so someone can test against this list
-AT_ANN_KEYS = (AT_ANN_STORAGE, AT_MD_STORAGE, AT_FIELD_MD, AT_REF)
+AT_ANN_KEYS = (AT_ANN_STORAGE, AT_MD_STORAGE, AT_FIELD_MD, AT_REF,
+               AT_IMAGE_SCALES)
 
 
 class ATAnnotations(DictMixin, Explicit):
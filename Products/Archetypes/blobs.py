@@ -0,0 +1,185 @@
+"""File content kept in ZODB blobs.
+
+BlobFile is an OFS.Image.File whose data is stored in a ZODB blob instead of
+a chain of Pdata records, so that it doesn't bloat the storage and the
+object cache. Uploads are copied chunk by chunk into the blob file and the
+committed file is served with a filestream_iterator. Use it, or
+Field.BlobImage, as the content_class of a FileField or ImageField; the
+stored values of existing content are moved into blobs by
+FileField.migrateToBlob.
+"""
+from cStringIO import StringIO
+
+from AccessControl import ClassSecurityInfo
+from Acquisition import aq_base
+from App.class_init import InitializeClass
+from App.Common import rfc1123_date
+from ComputedAttribute import ComputedAttribute
+from DateTime import DateTime
+from OFS.Image import File
+from OFS.Image import Pdata
+from ZODB.blob import Blob
+from ZODB.interfaces import BlobError
+from ZODB.POSException import ConflictError
+from ZPublisher.HTTPRangeSupport import expandRanges
+from ZPublisher.HTTPRangeSupport import parseRange
+from ZPublisher.Iterators import filestream_iterator
+from Products.CMFCore import permissions
+
+from Products.Archetypes.WebDAVSupport import rangesResponse
+
+CHUNK_SIZE = 1 << 16
+
+
+class _Written(object):
+    """The result of BlobFile._read_data, the data is in the blob already
+
+    Looks like a Pdata chunk to OFS.Image.File._get_content_type.
+    """
+
+    def __init__(self, head):
+        self.data = head
+
+
+class BlobFile(File):
+    """An OFS.Image.File keeping its data in a ZODB blob"""
+
+    meta_type = 'Blob File'
+    security = ClassSecurityInfo()
+
+    _blob = None
+
+    def _getData(self):
+        # the whole data for code expecting File.data, better use open()
+        f = self.open()
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    data = ComputedAttribute(_getData)
+
+    security.declarePrivate('open')
+    def open(self, mode='r'):
+        """The blob file, opened for reading unless told otherwise"""
+        if self._blob is None:
+            if mode != 'r':
+                self._blob = Blob()
+            else:
+                return StringIO()
+        return self._blob.open(mode)
+
+    security.declarePrivate('head')
+    def head(self, size=8096):
+        """The first size bytes of the data"""
+        f = self.open()
+        try:
+            return f.read(size)
+        finally:
+            f.close()
+
+    security.declarePrivate('getIterator')
+    def getIterator(self):
+        """An iterator streaming the committed blob file
+
+        Data not committed yet is returned as a string.
+        """
+        if self._blob is None:
+            return ''
+        try:
+            filename = self._blob.committed()
+        except BlobError:
+            return self.data
+        return filestream_iterator(filename, 'rb')
+
+    def _read_data(self, file):
+        """Copy file, a string, Pdata chain, File or file like object,
+        into the blob
+        """
+        if isinstance(file, unicode):
+            raise TypeError('Data can only be str or read-only buffer.')
+        base = aq_base(file)
+        opened = None
+        if isinstance(base, BlobFile):
+            file = opened = base.open()
+        elif isinstance(base, File):
+            file = base.data
+        f = self.open('w')
+        size = 0
+        try:
+            if isinstance(file, str):
+                f.write(file)
+                size = len(file)
+            elif isinstance(file, Pdata):
+                while file is not None:
+                    f.write(file.data)
+                    size += len(file.data)
+                    next = file.next
+                    if getattr(file, '_p_changed', None) is False:
+                        # don't keep the whole chain in the cache
+                        file._p_deactivate()
+                    file = next
+            else:
+                if hasattr(file, 'seek'):
+                    file.seek(0)
+                while True:
+                    chunk = file.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    size += len(chunk)
+        finally:
+            f.close()
+            if opened is not None:
+                opened.close()
+        return _Written(self.head()), size
+
+    security.declarePrivate('update_data')
+    def update_data(self, data, content_type=None, size=None):
+        if not isinstance(data, _Written):
+            data, size = self._read_data(data)
+        if content_type is not None:
+            self.content_type = content_type
+        self.size = size
+        self.ZCacheable_invalidate()
+        self.ZCacheable_set(None)
+        self.http__refreshEtag()
+
+    security.declareProtected(permissions.View, 'index_html')
+    def index_html(self, REQUEST, RESPONSE):
+        """Stream the blob file, or the byte ranges asked for"""
+        if self._if_modified_since_request_handler(REQUEST, RESPONSE):
+            return ''
+        RESPONSE.setHeader('Last-Modified', rfc1123_date(self._p_mtime))
+        RESPONSE.setHeader('Accept-Ranges', 'bytes')
+        header = REQUEST.get_header('Range', None)
+        if header is not None and self._ifRange(REQUEST):
+            ranges = parseRange(header)
+            if ranges is not None:
+                ranges = expandRanges(ranges, self.size)
+                f = self.open()
+                try:
+                    return rangesResponse(RESPONSE, f, self.size, ranges,
+                                          self.content_type)
+                finally:
+                    f.close()
+        RESPONSE.setHeader('Content-Type', self.content_type)
+        RESPONSE.setHeader('Content-Length', self.size)
+        return self.getIterator()
+
+    def _ifRange(self, REQUEST):
+        # like OFS.Image.File, an ETag or a date
+        if_range = REQUEST.get_header('If-Range', None)
+        if if_range is None:
+            return True
+        if if_range[:2] == 'ts':
+            return if_range == self.http__etag()
+        try:
+            since = long(DateTime(if_range.split(';')[0]).timeTime())
+        except (ConflictError, KeyboardInterrupt):
+            raise
+        except Exception:
+            return True
+        return long(self._p_mtime) <= since
+
+InitializeClass(BlobFile)
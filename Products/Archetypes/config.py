@@ -16,6 +16,23 @@ RENAME_AFTER_CREATION_ATTEMPTS = 100
 REFERENCE_CATALOG = "reference_catalog"
 UUID_ATTR = "_at_uid"
 REFERENCE_ANNOTATION = "at_references"
+REFERENCE_RECORDS = "at_reference_records"
+
+# Number of UIDs whose path is kept in the process wide cache used to
+# resolve UIDs, see uidcache.py. 0 disables the cache.
+UID_PATH_CACHE_SIZE = 10000
+
+# Bytes of transformed text kept in the process wide cache used by
+# BaseUnit.transform, see transformcache.py. 0 disables the cache.
+TRANSFORM_CACHE_SIZE = 16 * 1024 * 1024
+
+# Bytes of text extracted from a file by FileField.getIndexable which are
+# indexed, the rest is cut off.
+INDEXABLE_TEXT_SIZE = 1024 * 1024
+
+# Threads encoding the scales of an image made by ImageField.createScales,
+# see imagescaling.py. 1 encodes them one after the other.
+IMAGE_SCALING_WORKERS = 4
 
 # In zope 2.6.3+ and 2.7.0b4+ a lines field returns a tuple not a list. Per
 # default archetypes returns a tuple, too. If this breaks your software you
@@ -46,5 +63,24 @@ LANGUAGE_DEFAULT = u'en'
 # portal types. If you need this old behaviour change this setting to False.
 CATALOGMAP_USES_PORTALTYPE = True
 
+# indexObject, unindexObject and reindexObject queue their catalog
+# operations until the end of the transaction, see indexing.py. Set to
+# False to catalog immediately, e.g. when debugging.
+QUEUE_INDEXING = True
+
+# The asynchronous catalogs of the archetype tool are updated right away
+# again while the indexing queue holds more than ASYNC_INDEXING_MAX_LENGTH
+# records or its oldest record has waited more than ASYNC_INDEXING_MAX_AGE
+# seconds, e.g. because no worker runs. None for no limit.
+ASYNC_INDEXING_MAX_LENGTH = 10000
+ASYNC_INDEXING_MAX_AGE = 15 * 60
+
+# reindexObjectSecurity updates a subtree in batches of this many objects,
+# with a savepoint after every batch. Past SECURITY_REINDEX_LIMIT objects
+# the rest of the subtree is left to the asynchronous indexing queue of the
+# archetype tool; 0 updates the whole subtree right away.
+SECURITY_REINDEX_BATCH_SIZE = 500
+SECURITY_REINDEX_LIMIT = 0
+
 import os
 _www = os.path.join(os.path.dirname(__file__), 'www')
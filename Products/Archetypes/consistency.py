@@ -0,0 +1,218 @@
+"""Cross checks of the uid catalog, the reference catalog and the content.
+
+ArchetypeTool.checkConsistency drives a ConsistencyChecker a few chunks per
+call, see checkConsistency.
+"""
+import logging
+from itertools import islice
+
+import transaction
+from Acquisition import aq_inner, aq_parent
+from Persistence import PersistentMapping
+from ZODB.POSException import ConflictError
+from Products.CMFCore.utils import getToolByName
+from plone.uuid.interfaces import IUUID
+
+from Products.Archetypes.config import UID_CATALOG, REFERENCE_CATALOG
+from Products.Archetypes.interfaces.referenceable import IReferenceable
+
+logger = logging.getLogger('Archetypes')
+
+# The checks, in the order they run. References are checked last, so that
+# references to objects merely missing from the uid catalog are kept.
+PHASES = ('uid_catalog', 'content', 'reference_catalog')
+
+# The inconsistencies counted:
+#   stale_uids: uid catalog entries without the object at their path
+#   stale_references: reference catalog entries without the reference
+#   dangling_references: references to a UID which doesn't resolve
+#   missing_uids: referenceable objects not in the uid catalog
+PROBLEMS = ('stale_uids', 'stale_references', 'dangling_references',
+            'missing_uids')
+
+
+def checkConsistency(tool, repair=False, max_steps=1, chunk_size=500,
+                     restart=False, commit=False):
+    """Check the next chunks of the consistency check kept on tool
+
+    At most max_steps chunks are checked, separated by savepoints, or with
+    commit every chunk is committed in its own transaction. A chunk
+    conflicting with other writes is then retried a few times. Returns the
+    counts of the check and whether it is complete.
+    """
+    if restart:
+        tool._consistency_state = None
+    checker = _checker(tool, repair, chunk_size)
+    steps = conflicts = 0
+    while max_steps is None or steps < max_steps:
+        try:
+            more = checker.step()
+            if commit:
+                transaction.commit()
+            else:
+                transaction.savepoint(optimistic=True)
+        except ConflictError:
+            if not commit:
+                raise
+            transaction.abort()
+            conflicts += 1
+            if conflicts > 3:
+                logger.info('Consistency check gave up after %s conflicts',
+                            conflicts)
+                break
+            # the state is back to the one last committed
+            checker = _checker(tool, repair, chunk_size)
+            continue
+        conflicts = 0
+        steps += 1
+        if not more:
+            break
+    result = dict(checker.state['counts'])
+    result['complete'] = checker.complete()
+    return result
+
+
+def _checker(tool, repair, chunk_size):
+    state = tool._consistency_state
+    if state is None:
+        state = tool._consistency_state = PersistentMapping()
+    return ConsistencyChecker(tool, state, repair=repair,
+                              chunk_size=chunk_size)
+
+
+class ConsistencyChecker(object):
+    """Chunked and resumable cross check of the catalogs and the content
+
+    The phase, the cursor within the phase and the counts are kept in the
+    persistent mapping state, so that a check interrupted in between two
+    chunks continues where it stopped.
+    """
+
+    def __init__(self, context, state, repair=False, chunk_size=500):
+        self.uc = getToolByName(context, UID_CATALOG)
+        self.rc = getToolByName(context, REFERENCE_CATALOG)
+        self.state = state
+        self.repair = repair
+        self.chunk_size = chunk_size
+        self._walker = None
+        if state.get('phase') is None:
+            self.reset()
+
+    def reset(self):
+        state = self.state
+        state.clear()
+        state['phase'] = PHASES[0]
+        state['cursor'] = None
+        counts = dict.fromkeys(PROBLEMS, 0)
+        counts['checked'] = counts['repaired'] = 0
+        state['counts'] = counts
+
+    def complete(self):
+        return self.state['phase'] is None
+
+    def step(self):
+        """Check the next chunk, returns False once everything is checked
+        """
+        state = self.state
+        phase = state['phase']
+        if phase is None:
+            return False
+        counts = dict(state['counts'])
+        cursor = getattr(self, '_check_' + phase)(state['cursor'], counts)
+        if cursor is None:
+            index = PHASES.index(phase) + 1
+            if index < len(PHASES):
+                state['phase'] = PHASES[index]
+            else:
+                state['phase'] = None
+            logger.info('Consistency check of %s done: %r', phase, counts)
+        state['cursor'] = cursor
+        state['counts'] = counts
+        return state['phase'] is not None
+
+    def _keys(self, tree, cursor):
+        if cursor is None:
+            keys = tree.keys()
+        else:
+            keys = tree.keys(min=cursor, excludemin=True)
+        return list(islice(keys, self.chunk_size))
+
+    def _check_uid_catalog(self, cursor, counts):
+        _catalog = self.uc._catalog
+        chunk = self._keys(_catalog.uids, cursor)
+        if not chunk:
+            return None
+        indexed = _catalog.indexes['UID']._unindex
+        objects = self.uc._resolvePaths(chunk)
+        for path in chunk:
+            counts['checked'] += 1
+            uid = indexed.get(_catalog.uids[path])
+            obj = objects[path]
+            if obj is not None and IUUID(obj, None) == uid:
+                continue
+            counts['stale_uids'] += 1
+            logger.debug('uid catalog entry %s (%s) is stale', path, uid)
+            if self.repair:
+                self.uc.uncatalog_object(path)
+                counts['repaired'] += 1
+        return chunk[-1]
+
+    def _check_reference_catalog(self, cursor, counts):
+        _catalog = self.rc._catalog
+        chunk = self._keys(_catalog.uids, cursor)
+        if not chunk:
+            return None
+        indexes = _catalog.indexes
+        known = self.uc._catalog.indexes['UID']._index
+        objects = self.uc._resolvePaths(chunk)
+        for path in chunk:
+            counts['checked'] += 1
+            ref = objects[path]
+            if ref is None:
+                counts['stale_references'] += 1
+                logger.debug('reference catalog entry %s is stale', path)
+                if self.repair:
+                    self.rc.uncatalog_object(path)
+                    counts['repaired'] += 1
+                continue
+            rid = _catalog.uids[path]
+            tid = indexes['targetUID']._unindex.get(rid)
+            if tid in known:
+                continue
+            counts['dangling_references'] += 1
+            logger.debug('reference %s points to the unknown UID %s',
+                         path, tid)
+            if self.repair:
+                self.rc._deleteReference(ref)
+                counts['repaired'] += 1
+        return chunk[-1]
+
+    def _check_content(self, cursor, counts):
+        # the walk is kept from one chunk to the next as long as it is at
+        # the cursor, the portal is only walked to the cursor again after
+        # the checker has been recreated
+        if self._walker is None or self._walker[0] != cursor:
+            portal = aq_parent(aq_inner(self.uc))
+            self._walker = (cursor, self.uc._walk(portal, (), cursor or ()))
+        walk = self._walker[1]
+        chunk = list(islice(walk, self.chunk_size))
+        if not chunk:
+            self._walker = None
+            return None
+        known = self.uc._catalog.indexes['UID']._index
+        for path, obj in chunk:
+            if not IReferenceable.providedBy(obj):
+                continue
+            counts['checked'] += 1
+            uid = IUUID(obj, None)
+            if uid is None or uid in known:
+                continue
+            counts['missing_uids'] += 1
+            url = '/'.join(path)
+            logger.debug('%s (%s) is missing from the uid catalog', url, uid)
+            if self.repair:
+                self.uc.catalog_object(obj, url)
+                counts['repaired'] += 1
+        cursor = chunk[-1][0]
+        self._walker = (cursor, walk)
+        return cursor
@@ -0,0 +1,259 @@
+"""Text extraction for the SearchableText of file fields.
+
+FileField.getIndexable converts files to text/plain with portal_transforms
+and caches the text in the transform cache. For a bulk reindex,
+reindexContent has an ExtractionPool convert the files of the next batch of
+objects in worker threads while the current batch is cataloged. The
+converters are mostly external commands, which run in parallel. The texts
+are handed to getIndexable for the batch, see extractedText, as the
+transform cache may have dropped them by then.
+
+Threads are used rather than processes: they share the database and the
+transform cache of the process, which a process would have to open again
+and send the text back from, and the interpreter lock is released while
+the converters run.
+"""
+import logging
+import threading
+import time
+from itertools import islice
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import transaction
+from ZODB.POSException import ConflictError
+from Products.CMFCore.utils import getToolByName
+
+from Products.Archetypes import config
+from Products.Archetypes.interfaces.base import IBaseObject
+from Products.Archetypes.interfaces.field import IFileField
+from Products.Archetypes.interfaces.field import ITextField
+from Products.Archetypes.indexing import processQueue
+from Products.Archetypes.transformcache import transformChain
+
+logger = logging.getLogger('Archetypes')
+
+
+def indexableKey(transforms, mimetype):
+    """The transform cache key of the text extracted from mimetype
+
+    None when the text isn't to be cached, see transformChain.
+    """
+    chain = transformChain(transforms, mimetype, 'text/plain')
+    if chain is None:
+        return None
+    return (str(mimetype), 'text/plain', 'indexable',
+            config.INDEXABLE_TEXT_SIZE, chain)
+
+
+# the texts extracted for the batch reindexed by the current thread, by
+# (path, field name)
+_extracted = threading.local()
+
+
+def extractedText(instance, name, digest):
+    """The text extracted for the field name of instance by an
+    ExtractionPool, None unless it was extracted from data of digest
+    """
+    texts = getattr(_extracted, 'texts', None)
+    if not texts:
+        return None
+    found = texts.get(('/'.join(instance.getPhysicalPath()), name))
+    if found is None or found[0] != digest:
+        return None
+    return found[1]
+
+
+def limitText(value):
+    """Cut value after config.INDEXABLE_TEXT_SIZE bytes, at a word boundary
+    """
+    limit = config.INDEXABLE_TEXT_SIZE
+    if len(value) > limit:
+        head = value[:limit]
+        # no word boundary when the head is a single word or whitespace
+        words = head.rsplit(None, 1)
+        value = words and words[0] or head
+    return value
+
+
+def extractText(transforms, data, mimetype, filename):
+    """Convert data to text/plain, cut to the indexed size"""
+    datastream = transforms.convertTo("text/plain", data, mimetype=mimetype,
+                                      filename=filename)
+    return limitText(str(datastream))
+
+
+class ExtractionPool(object):
+    """Worker threads extracting text with portal_transforms
+
+    Every extraction is done in a connection of its own to the database of
+    context, extractIndexable streaming the committed data of the field
+    from it. There is a worker per processor by default, but no more than
+    half of the connection pool of the database, which is left to the
+    rest of the instance.
+    """
+
+    def __init__(self, context, workers=None):
+        self.db = context._p_jar.db()
+        portal = getToolByName(context, 'portal_url').getPortalObject()
+        self.path = '/'.join(portal.getPhysicalPath())
+        pool_size = self.db.getPoolSize()
+        if workers is None:
+            workers = min(cpu_count(), pool_size // 2)
+        # the reindexing thread holds a connection too
+        workers = max(min(workers, pool_size - 1), 1)
+        self.pool = ThreadPool(workers)
+
+    def extract(self, jobs):
+        """Start extracting the text for jobs from getExtractionJob
+
+        Returns an AsyncResult whose get() returns for each job its
+        (job, digest, text), or None if it failed.
+        """
+        return self.pool.map_async(self._extract, jobs)
+
+    def _extract(self, job):
+        conn = self.db.open()
+        try:
+            return self._extractIn(conn.root()['Application'], job)
+        finally:
+            transaction.abort()
+            conn.close()
+
+    def _extractIn(self, app, job):
+        path, name = job
+        try:
+            obj = app.unrestrictedTraverse(path, None)
+            if obj is None:
+                # removed meanwhile
+                return None
+            digest, text = obj.getField(name).extractIndexable(obj)
+        except Exception, e:
+            logger.warning("Error while trying to extract the text of %s "
+                           "of %s: %s", name, path, e)
+            return None
+        if digest is None:
+            return None
+        return job, digest, text
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def extractionJobs(obj):
+    """The extraction jobs of the searchable file fields of obj"""
+    jobs = []
+    if not IBaseObject.providedBy(obj):
+        return jobs
+    for field in obj.Schema().fields():
+        if not field.searchable or not IFileField.providedBy(field) or \
+               ITextField.providedBy(field):
+            continue
+        if field.getIndexAccessorName() not in (field.edit_accessor,
+                                                field.accessor):
+            # indexed by a method of its own
+            continue
+        try:
+            job = field.getExtractionJob(obj)
+        except (ConflictError, KeyboardInterrupt):
+            raise
+        except Exception:
+            # getIndexable reports it
+            continue
+        if job is not None:
+            jobs.append(job)
+    return jobs
+
+
+def reindexContent(context, batch_size=50, workers=None, commit=False):
+    """Reindex the objects of the uid catalog in their catalogs
+
+    The objects are reindexed in batches of batch_size in the order of
+    their paths. While a batch is reindexed, the text of the file fields of
+    the next one is extracted by an ExtractionPool. With commit the
+    transaction is committed after every batch, else a savepoint is made.
+    Returns the number of objects reindexed.
+    """
+    uc = getToolByName(context, config.UID_CATALOG)
+    paths = uc._catalog.uids
+    # reference objects are catalogued along with their source
+    annotation = '/%s/' % config.REFERENCE_ANNOTATION
+
+    def batches():
+        cursor = None
+        while True:
+            if cursor is None:
+                keys = paths.keys()
+            else:
+                keys = paths.keys(min=cursor, excludemin=True)
+            # the keys are fetched again for every batch, the tree may have
+            # changed after a commit
+            chunk = list(islice(keys, batch_size))
+            if not chunk:
+                return
+            cursor = chunk[-1]
+            wanted = [path for path in chunk if annotation not in path]
+            objects = uc._resolvePaths(wanted)
+            batch = [objects[path] for path in wanted
+                     if IBaseObject.providedBy(objects[path])]
+            jobs = []
+            for obj in batch:
+                jobs.extend(extractionJobs(obj))
+            yield batch, jobs
+
+    pool = ExtractionPool(context, workers)
+    started = time.time()
+    done = 0
+    try:
+        pending = None
+        for batch, jobs in batches():
+            extracting = pool.extract(jobs)
+            if pending is not None:
+                done += _reindexBatch(*pending)
+                _finishBatch(context, commit)
+                logger.info('Reindexed %s objects (%.1f objects/s)', done,
+                            done / max(time.time() - started, 0.001))
+            pending = batch, extracting
+        if pending is not None:
+            done += _reindexBatch(*pending)
+            _finishBatch(context, commit)
+    finally:
+        pool.close()
+    logger.info('Reindexed %s objects in %.1fs', done, time.time() - started)
+    return done
+
+
+def _reindexBatch(batch, extracting):
+    texts = {}
+    for found in extracting.get():
+        if found is not None:
+            job, digest, text = found
+            texts[job] = digest, text
+    _extracted.texts = texts
+    try:
+        indexes = {}
+        for obj in batch:
+            catalogs = obj.getCatalogs()
+            key = tuple([catalog.getId() for catalog in catalogs])
+            idxs = indexes.get(key)
+            if idxs is None:
+                idxs = set()
+                for catalog in catalogs:
+                    idxs.update(catalog.indexes())
+                idxs = indexes[key] = sorted(idxs)
+            # naming the indexes doesn't mark the object modified
+            obj.reindexObject(idxs=idxs)
+        processQueue()
+    finally:
+        _extracted.texts = None
+    return len(batch)
+
+
+def _finishBatch(context, commit):
+    if commit:
+        transaction.commit()
+    else:
+        transaction.savepoint(optimistic=True)
+    if context._p_jar is not None:
+        context._p_jar.cacheGC()
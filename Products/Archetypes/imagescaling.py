@@ -0,0 +1,234 @@
+"""Scaling of the images of ImageField.
+
+An ImageScaler decodes an image once for all the scales made of it. A JPEG
+is only decoded at the smallest draft size still big enough for the
+largest scale. The scales are made largest first, each from the smallest
+image made so far which is big enough for it, and are encoded in a pool of
+threads shared by all scalers, as PIL releases the interpreter lock while
+encoding.
+"""
+import threading
+import time
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from Acquisition import aq_base
+from ZODB.POSException import ConflictError
+
+from Products.Archetypes import config
+from Products.Archetypes.blobs import BlobFile
+
+try:
+    import PIL.Image
+except ImportError:
+    # ImageField doesn't scale without PIL
+    pass
+
+
+def openData(data):
+    """A file to read the image data from
+
+    data is a string, a blob image or a file, which is rewound.
+    """
+    if isinstance(data, basestring):
+        return StringIO(data)
+    if isinstance(aq_base(data), BlobFile):
+        return data.open()
+    data.seek(0)
+    return data
+
+
+def fitSize(size, box):
+    """The size of an image of size made to fit into box
+
+    Computed like the thumbnail method of PIL images, which never enlarges
+    an image.
+    """
+    x, y = size
+    if x > box[0]:
+        y = max(y * box[0] // x, 1)
+        x = box[0]
+    if y > box[1]:
+        x = max(x * box[1] // y, 1)
+        y = box[1]
+    return x, y
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def getPool():
+    """The pool of threads encoding the scales
+
+    Made when first asked for, of config.IMAGE_SCALING_WORKERS threads, and
+    kept for the life of the process.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(max(config.IMAGE_SCALING_WORKERS, 1))
+        return _pool
+
+
+class ImageScaler(object):
+    """The scales of one image, decoded once
+
+    The seconds spent are in timings after scales returned: under 'decode'
+    for decoding the image and under the name of each scale for resizing
+    and encoding it. The scales which failed are in errors, by name.
+    """
+
+    def __init__(self, data, resize_algo, quality, default_format='PNG'):
+        self.data = data
+        self.file = None
+        self.resize_algo = resize_algo
+        self.quality = quality
+        self.default_format = default_format
+        self.timings = {}
+        self.errors = {}
+
+    def scales(self, sizes, workers=1, swallow=False):
+        """Make the scales of sizes, a list of (name, (width, height))
+
+        Returns a dict of name: (file, format), like ImageField.scale. With
+        more than one worker, the scales are encoded in the pool of getPool.
+        With swallow, a scale which fails is left out and its exception kept
+        in errors, and an image which can't be decoded makes no scales.
+        """
+        self.file = openData(self.data)
+        try:
+            return self._scales(sizes, workers, swallow)
+        except (ConflictError, KeyboardInterrupt):
+            raise
+        except Exception, e:
+            if not swallow:
+                raise
+            for name, size in sizes:
+                self.errors.setdefault(name, e)
+            return {}
+        finally:
+            if self._opened():
+                self.file.close()
+            self.file = None
+
+    def _opened(self):
+        # the blob file opened for a blob image is ours to close
+        return isinstance(aq_base(self.data), BlobFile)
+
+    def _scales(self, sizes, workers, swallow):
+        started = time.time()
+        image = PIL.Image.open(self.file)
+        original_size = image.size
+        original_mode = image.mode
+        img_format = image.format or self.default_format
+        if img_format in ('TIFF', 'EPS', 'PSD'):
+            # non web image format have jpeg thumbnails
+            target_format = 'JPEG'
+        else:
+            target_format = img_format
+        # decided to only preserve palletted mode for GIF
+        self.palette = original_mode == 'P' and img_format == 'GIF'
+        self.target_format = target_format
+
+        results = {}
+        todo = []
+        animated = None
+        for name, size in sizes:
+            fit = fitSize(original_size, (int(size[0]), int(size[1])))
+            if image.format == 'GIF' and fit == original_size:
+                if animated is None:
+                    animated = self._animated(image)
+                if animated:
+                    # no bigger than the scale requested, don't scale as
+                    # this would lose the animation
+                    results[name] = (self._originalFile(), 'gif')
+                    continue
+            todo.append((name, fit))
+        if not todo:
+            return results
+        todo.sort(key=lambda item: item[1][0] * item[1][1], reverse=True)
+
+        image.draft(None, (max([fit[0] for name, fit in todo]),
+                           max([fit[1] for name, fit in todo])))
+        # consider image mode when scaling: convert to greyscale or RGBA
+        # before scaling, PNG compression is OK for RGBA thumbnails
+        if original_mode == '1':
+            image = image.convert('L')
+        elif original_mode in ('P', 'CMYK'):
+            image = image.convert('RGBA')
+        else:
+            image.load()
+        self.timings['decode'] = time.time() - started
+
+        pool = None
+        if workers > 1 and len(todo) > 1:
+            pool = getPool()
+        made = [image]
+        encoding = []
+        for name, fit in todo:
+            started = time.time()
+            try:
+                # a draft may be a pixel short when rounded
+                source = min([i for i in made if i.size[0] >= fit[0] and
+                              i.size[1] >= fit[1]] or [image],
+                             key=lambda i: i.size[0] * i.size[1])
+                if source.size == fit:
+                    scaled = source
+                else:
+                    scaled = source.resize(fit, self.resize_algo)
+                    made.append(scaled)
+                resized = time.time() - started
+                if pool is None:
+                    result = self._encode(scaled)
+                else:
+                    result = pool.apply_async(self._encode, (scaled,))
+            except (ConflictError, KeyboardInterrupt):
+                raise
+            except Exception, e:
+                if not swallow:
+                    raise
+                self.errors[name] = e
+                continue
+            encoding.append((name, resized, result))
+        for name, resized, result in encoding:
+            try:
+                if pool is not None:
+                    result = result.get()
+            except Exception, e:
+                if not swallow:
+                    raise
+                self.errors[name] = e
+                continue
+            f, encoded = result
+            results[name] = (f, target_format.lower())
+            self.timings[name] = resized + encoded
+        return results
+
+    def _animated(self, image):
+        try:
+            image.seek(image.tell() + 1)
+        except EOFError:
+            return False
+        finally:
+            image.seek(0)
+        return True
+
+    def _originalFile(self):
+        if isinstance(self.data, basestring):
+            return StringIO(self.data)
+        self.file.seek(0)
+        if self._opened():
+            # the blob file is closed once the scales are made
+            return StringIO(self.file.read())
+        return self.file
+
+    def _encode(self, image):
+        started = time.time()
+        if self.palette:
+            image = image.convert('P')
+        f = StringIO()
+        # quality parameter doesn't affect lossless formats
+        image.save(f, self.target_format, quality=self.quality)
+        f.seek(0)
+        return f, time.time() - started
@@ -0,0 +1,457 @@
+"""A queue of catalog operations bound to the current transaction.
+
+CatalogMultiplex queues its indexObject, unindexObject and reindexObject
+calls instead of cataloging right away. The operations queued for one path
+are merged into one, and the queue is processed once before the transaction
+commits, or earlier when a catalog is searched or read with one of the
+READ_METHODS. Code reading the internal data structures of a catalog, like
+_catalog.uids, calls processQueue first. Set config.QUEUE_INDEXING to False
+to catalog immediately again, e.g. when debugging.
+
+An object cataloged in several catalogs is handed to each of them wrapped
+in a MemoizedIndexable, so that the values of its indexes and metadata are
+computed once for all of them.
+
+The catalogs listed by the archetype tool's getAsyncCatalogs are not
+updated by the transaction at all: their operations are stored in a
+persistent AsyncIndexQueue, processed later by processIndexingQueue.
+"""
+import threading
+import time
+from logging import DEBUG
+from collections import OrderedDict
+from itertools import islice
+
+import transaction
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from Persistence import Persistent
+from ZODB.POSException import ConflictError
+from zope.component import queryMultiAdapter
+from zope.interface import implements
+from zope.interface import providedBy
+from plone.indexer.interfaces import IIndexableObject
+from plone.indexer.interfaces import IIndexer
+from Products.CMFCore.interfaces import ICatalogTool
+from Products.CMFCore.utils import getToolByName
+from Products.ZCatalog.ZCatalog import ZCatalog
+
+from Products.Archetypes import config
+from Products.Archetypes.log import log
+from Products.Archetypes.utils import call_original
+from Products.Archetypes.utils import make_uuid
+from Products.Archetypes.utils import wrap_method
+
+INDEX = 'index'
+REINDEX = 'reindex'
+UNINDEX = 'unindex'
+
+
+class IndexQueue(object):
+    """The catalog operations of one transaction, by path
+
+    An index list of [] stands for all indexes.
+    """
+
+    def __init__(self, txn=None):
+        self.transaction = txn
+        self._ops = OrderedDict()  # path -> (op, obj, idxs)
+        self._processing = False
+
+    def __len__(self):
+        return len(self._ops)
+
+    def get(self, path):
+        """The (operation, object, idxs) queued for path, or None"""
+        return self._ops.get(path)
+
+    def index(self, obj, path):
+        self._add(path, INDEX, obj, [])
+
+    def reindex(self, obj, path, idxs=None):
+        self._add(path, REINDEX, obj, list(idxs or []))
+
+    def unindex(self, obj, path):
+        self._add(path, UNINDEX, obj, [])
+
+    def _add(self, path, op, obj, idxs):
+        queued = self._ops.get(path)
+        if queued is not None:
+            old, _, old_idxs = queued
+            if op == UNINDEX:
+                # an index followed by an unindex cancels out; only an
+                # unindex remains, which does nothing unless the path was
+                # cataloged before
+                idxs = []
+            elif old == UNINDEX:
+                if op == REINDEX:
+                    # gone from there already
+                    return
+                # removed and added again
+            elif op == INDEX or old == INDEX:
+                # added and modified
+                op, idxs = INDEX, []
+            else:
+                # reindexed twice, [] stands for all indexes
+                if old_idxs and idxs:
+                    idxs = old_idxs + [i for i in idxs if i not in old_idxs]
+                else:
+                    idxs = []
+        self._ops[path] = (op, obj, idxs)
+
+    def process(self):
+        """Perform the queued operations, returns how many there were
+
+        Operations queued meanwhile are performed as well.
+        """
+        if self._processing:
+            return 0
+        self._processing = True
+        count = 0
+        try:
+            while self._ops:
+                path, (op, obj, idxs) = self._ops.popitem(last=False)
+                if op == UNINDEX:
+                    obj._unindexObject(path)
+                elif op == INDEX:
+                    obj._indexObject(path)
+                else:
+                    obj._reindexObject(path, idxs)
+                count += 1
+        finally:
+            self._processing = False
+        return count
+
+    def clear(self):
+        self._ops.clear()
+
+
+_local = threading.local()
+
+
+def queueIndexing():
+    """Whether catalog operations are queued"""
+    return config.QUEUE_INDEXING
+
+
+def getQueue():
+    """The queue of the current transaction, created when needed"""
+    txn = transaction.get()
+    queue = getattr(_local, 'queue', None)
+    if queue is None or queue.transaction is not txn:
+        queue = _local.queue = IndexQueue(txn)
+        txn.addBeforeCommitHook(queue.process)
+    return queue
+
+
+def processQueue():
+    """Perform the operations queued in the current transaction"""
+    queue = getattr(_local, 'queue', None)
+    if queue is None or not len(queue):
+        return 0
+    if queue.transaction is not transaction.get():
+        # left over by an aborted transaction
+        _local.queue = None
+        return 0
+    return queue.process()
+
+
+PATTERN = '__at_indexing_%s__'
+
+# The ZCatalog methods searching or reading the catalog
+READ_METHODS = ('searchResults', '__call__', 'getrid', 'getpath',
+                'getobject', 'getIndexDataForUID', 'getIndexDataForRID',
+                'getMetadataForUID', 'getMetadataForRID', 'uniqueValuesFor')
+
+
+def readMethod(name):
+    """A wrapper of the ZCatalog method name performing the queued
+    operations first
+    """
+    def method(self, *args, **kw):
+        """Read the catalog, once the queued operations are performed
+        """
+        processQueue()
+        return call_original(self, name, PATTERN, *args, **kw)
+    method.__name__ = name
+    return method
+
+
+def wrapCatalogSearches():
+    """Make catalog reads see the operations queued so far"""
+    for name in READ_METHODS:
+        wrap_method(ZCatalog, name, readMethod(name), pattern=PATTERN)
+
+
+# Indexes and columns whose value depends on the catalog asking for it, and
+# so is computed for every catalog, see volatileIndexable.
+_volatile = set()
+
+_memo_stats = {'computed': 0, 'reused': 0}
+
+_marker = object()
+_missing = object()
+
+
+def volatileIndexable(name):
+    """Never share the value of the index or column name between catalogs
+
+    For custom indexers and methods whose result depends on the catalog,
+    or which must see the changes done by cataloging in another catalog.
+    """
+    _volatile.add(name)
+
+
+def memoStats():
+    """How many values were computed and how many reused since startup"""
+    return dict(_memo_stats)
+
+
+class IndexableMemo(object):
+    """The values computed for one object while cataloging it
+
+    Values found by an indexer registered for a catalog are only shared
+    with the catalogs providing the same interfaces, which find the same
+    indexers.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.computed = 0
+        self.reused = 0
+
+    def wrap(self, obj, catalog):
+        """The object to pass to catalog.catalog_object"""
+        if not ICatalogTool.providedBy(catalog):
+            return MemoizedIndexable(obj, self, None)
+        # what the catalog tool would catalog, with the indexers registered
+        # for it
+        indexable = queryMultiAdapter((obj, catalog), IIndexableObject,
+                                      default=obj)
+        return MemoizedIndexable(indexable, self, (obj, catalog))
+
+    def get(self, indexable, context, name):
+        if name.startswith('_') or name in _volatile:
+            return getattr(indexable, name)
+        key = (None, name)
+        if context is not None and queryMultiAdapter(
+                context, IIndexer, name=name) is not None:
+            key = (providedBy(context[1]), name)
+        value = self.values.get(key, _marker)
+        if value is _marker:
+            value = getattr(indexable, name, _missing)
+            if value is not _missing and callable(value):
+                value = _MemoizedCall(self, value)
+            self.values[key] = value
+            self._count('computed')
+        elif not isinstance(value, _MemoizedCall):
+            self._count('reused')
+        if value is _missing:
+            raise AttributeError(name)
+        return value
+
+    def _count(self, what):
+        setattr(self, what, getattr(self, what) + 1)
+        _memo_stats[what] += 1
+
+
+class _MemoizedCall(object):
+    """A method of the object, called once without arguments"""
+
+    def __init__(self, memo, method):
+        self.memo = memo
+        self.method = method
+        self.result = _marker
+
+    def __call__(self, *args, **kw):
+        if args or kw:
+            return self.method(*args, **kw)
+        if self.result is _marker:
+            self.result = self.method()
+        else:
+            self.memo._count('reused')
+        return self.result
+
+
+class MemoizedIndexable(object):
+    """An object as seen by the catalogs, remembering what they asked"""
+    implements(IIndexableObject)
+
+    def __init__(self, indexable, memo, context):
+        self.__indexable = indexable
+        self.__memo = memo
+        self.__context = context
+
+    def __getattr__(self, name):
+        return self.__memo.get(self.__indexable, self.__context, name)
+
+
+def indexables(obj, catalogs):
+    """Yield (catalog, object to catalog) for the catalogs
+
+    With several catalogs the values computed for the object are shared.
+    """
+    catalogs = [c for c in catalogs if c is not None]
+    if len(catalogs) < 2:
+        for catalog in catalogs:
+            yield catalog, obj
+        return
+    memo = IndexableMemo()
+    for catalog in catalogs:
+        yield catalog, memo.wrap(obj, catalog)
+    if memo.reused:
+        log('Cataloged %s in %s catalogs, %s values computed, %s reused' %
+            ('/'.join(obj.getPhysicalPath()), len(catalogs), memo.computed,
+             memo.reused), level=DEBUG)
+
+
+class AsyncIndexQueue(Persistent):
+    """Persistent queue of (path, operation, idxs, catalog ids,
+    update_metadata) records
+
+    The records are stored in a BTree under keys sorting by time, and
+    counted with a Length, so that transactions adding records at the same
+    time rarely conflict and their conflicts are resolved.
+    """
+
+    def __init__(self):
+        self._records = OOBTree()
+        self._length = Length()
+
+    def __len__(self):
+        return self._length()
+
+    def put(self, path, op, idxs, catalogs, update_metadata=1):
+        key = (time.time(), make_uuid())
+        self._records[key] = (path, op, tuple(idxs), tuple(catalogs),
+                              update_metadata)
+        self._length.change(1)
+
+    def age(self):
+        """Seconds the oldest record has waited, 0 without records"""
+        try:
+            queued = self._records.minKey()[0]
+        except ValueError:
+            return 0
+        return max(time.time() - queued, 0)
+
+    def lagging(self, max_length=None, max_age=None):
+        """Whether the records are too many or too old"""
+        if max_length is not None and len(self) > max_length:
+            return True
+        return max_age is not None and self.age() > max_age
+
+    def take(self, count):
+        """Remove and return the count oldest records"""
+        keys = list(islice(self._records.keys(), count))
+        records = [self._records.pop(key) for key in keys]
+        if records:
+            self._length.change(-len(records))
+        return records
+
+
+def deferCatalogs(context, catalogs, op, path, idxs=()):
+    """Queue the operation for the asynchronous catalogs
+
+    Returns the catalogs to update now: all of them while the queue lags
+    behind, see config.ASYNC_INDEXING_MAX_LENGTH.
+    """
+    tool = getToolByName(context, config.TOOL_NAME, None)
+    names = tool is not None and tool.getAsyncCatalogs() or ()
+    if not names:
+        return catalogs
+    if tool.getIndexingQueue().lagging(config.ASYNC_INDEXING_MAX_LENGTH,
+                                       config.ASYNC_INDEXING_MAX_AGE):
+        return catalogs
+    now = []
+    later = []
+    for catalog in catalogs:
+        if catalog is not None and catalog.getId() in names:
+            later.append(catalog.getId())
+        else:
+            now.append(catalog)
+    if later:
+        tool.getIndexingQueue().put(path, op, idxs, later)
+    return now
+
+
+def performRecords(context, records):
+    """Update the catalogs from queued records, returns the operations done
+
+    The records of one path and catalogs are merged like the operations of
+    a transaction. Records are checked against the current state, as the
+    catalogs may have been updated right away since they were queued.
+    """
+    queue = IndexQueue()
+    metadata = {}
+    for path, op, idxs, catalogs, update_metadata in records:
+        queue._add((path, catalogs), op, None, list(idxs))
+        metadata[(path, catalogs)] = (metadata.get((path, catalogs)) or
+                                      update_metadata)
+
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    count = 0
+    for (path, catalogs), (op, _, idxs) in queue._ops.items():
+        obj = portal.unrestrictedTraverse(path, None)
+        if op == UNINDEX:
+            if obj is not None:
+                # added again meanwhile, its index is queued or done
+                continue
+        elif obj is None:
+            # removed meanwhile, its unindex is queued as well
+            continue
+        for name in catalogs:
+            catalog = getToolByName(portal, name, None)
+            if catalog is None:
+                continue
+            if op == UNINDEX:
+                if catalog._catalog.uids.get(path, None) is not None:
+                    catalog.uncatalog_object(path)
+            else:
+                lst = idxs
+                if idxs:
+                    indexes = catalog.indexes()
+                    lst = [i for i in idxs if i in indexes]
+                catalog.catalog_object(obj, path, idxs=lst,
+                    update_metadata=metadata[(path, catalogs)])
+        count += 1
+    return count
+
+
+def processIndexingQueue(tool, batch_size=100, max_batches=None,
+                         commit=False):
+    """Perform the records of the tool's AsyncIndexQueue in batches
+
+    The batches are separated by savepoints, or with commit every batch is
+    committed in its own transaction. A batch conflicting with other
+    writes is then retried a few times. Returns the number of records
+    processed.
+    """
+    queue = tool._indexing_queue
+    if queue is None:
+        return 0
+    done = batches = conflicts = 0
+    while max_batches is None or batches < max_batches:
+        try:
+            records = queue.take(batch_size)
+            if not records:
+                break
+            performRecords(tool, records)
+            if commit:
+                transaction.commit()
+            else:
+                transaction.savepoint(optimistic=True)
+        except ConflictError:
+            if not commit:
+                raise
+            transaction.abort()
+            conflicts += 1
+            if conflicts > 3:
+                log('Indexing queue worker gave up after %s conflicts' %
+                    conflicts)
+                break
+            continue
+        conflicts = 0
+        done += len(records)
+        batches += 1
+    return done
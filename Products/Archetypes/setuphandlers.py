@@ -47,6 +47,8 @@ def install_referenceCatalog(out, site, rebuild=False):
             reindex = True
     if reindex:
         catalog.manage_reindexIndex()
+    if catalog._getAdjacency() is None:
+        catalog.manage_rebuildAdjacency()
 
 
 def install_templates(out, site):
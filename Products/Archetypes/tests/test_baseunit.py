@@ -28,10 +28,12 @@ from unittest import TestSuite, makeSuite
 import os
 import glob
 
+from Products.CMFCore.utils import getToolByName
 from Products.Archetypes.tests.atsitetestcase import ATSiteTestCase
 from Products.Archetypes.tests.utils import PACKAGE_HOME
 from Products.Archetypes.tests.utils import normalize_html
 from Products.Archetypes.atapi import BaseUnit
+from Products.Archetypes.transformcache import transform_cache
 from Products.Archetypes.tests.test_classgen import Dummy
 from Products.Archetypes.tests.test_classgen import gen_dummy
 
@@ -81,6 +83,64 @@ for f in input_files:
     tests.append(BaseUnitTestSubclass)
 
 
+class TransformCacheTest(ATSiteTestCase):
+
+    def afterSetUp(self):
+        gen_dummy()
+        parent = Dummy(oid='parent')
+        self.dummy = Dummy(oid='dummy', init_transforms=1).__of__(parent)
+        transform_cache.clear()
+
+    def makeUnit(self, data, mimetype='text/restructured'):
+        return BaseUnit(name='test', file=data, mimetype=mimetype,
+                        instance=self.dummy)
+
+    def testCached(self):
+        bu = self.makeUnit('*hello*')
+        first = bu.transform(self.dummy, 'text/html')
+        self.failUnless('<em>hello</em>' in first)
+        self.assertEqual(transform_cache.stats()['misses'], 1)
+        # the same data in another unit is not transformed again
+        other = self.makeUnit('*hello*')
+        self.assertEqual(other.transform(self.dummy, 'text/html'), first)
+        self.assertEqual(transform_cache.stats()['hits'], 1)
+
+    def testUpdateInvalidates(self):
+        bu = self.makeUnit('*hello*')
+        bu.transform(self.dummy, 'text/html')
+        self.assertEqual(len(transform_cache), 1)
+        bu.update('*bye*', self.dummy, mimetype='text/restructured')
+        self.assertEqual(len(transform_cache), 0)
+        self.failUnless('<em>bye</em>' in bu.transform(self.dummy,
+                                                       'text/html'))
+
+    def testNoTransform(self):
+        bu = self.makeUnit('hello', mimetype='text/plain')
+        self.assertEqual(bu.transform(self.dummy, 'image/png'), 'hello')
+        self.assertEqual(bu.transform(self.dummy, 'image/png'), 'hello')
+        self.assertEqual(transform_cache.stats()['hits'], 1)
+
+    def testTransformSettings(self):
+        from Acquisition import aq_base
+        from Products.Archetypes.transformcache import transformChain
+        transforms = getToolByName(self.dummy, 'portal_transforms')
+        chain = transformChain(transforms, 'text/restructured', 'text/html')
+        self.failUnless(chain)
+        transform = transforms._findPath('text/restructured', 'text/html')[0]
+        base = aq_base(transform)
+        base.cacheable = False
+        try:
+            self.assertEqual(transformChain(transforms, 'text/restructured',
+                                            'text/html'), None)
+            bu = self.makeUnit('*hello*')
+            bu.transform(self.dummy, 'text/html')
+            self.assertEqual(len(transform_cache), 0)
+        finally:
+            del base.cacheable
+
+tests.append(TransformCacheTest)
+
+
 def test_suite():
     suite = TestSuite()
     for test in tests:
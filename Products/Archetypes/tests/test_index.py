@@ -25,6 +25,7 @@
 
 import time
 
+from Products.Archetypes import config
 from Products.Archetypes.tests.atsitetestcase import ATSiteTestCase
 from Products.CMFCore.utils import getToolByName
 from Products.Archetypes.tests.utils import makeContent
@@ -145,3 +146,208 @@ class MultiplexTest(ATSiteTestCase):
         results = self.zc.searchResults(dict(getId='simple_type'))
         self.assertEqual(len(results), 1)
         self.assertEqual(results[0].getObject(), inst)
+
+    def test_catalogs_cached(self):
+        catalogs = self.tool.getCatalogsByType('SimpleType')
+        self.assertEqual([c.getId() for c in catalogs], ['portal_catalog'])
+        cache = self.tool._v_catalogs_by_type[1]
+        self.failUnless('SimpleType' in cache)
+        # changing the map forgets the cached catalogs
+        self.tool.setCatalogsByType('SimpleType', ['zope_catalog'])
+        catalogs = self.tool.getCatalogsByType('SimpleType')
+        self.assertEqual([c.getId() for c in catalogs], ['zope_catalog'])
+        # as does the end of the transaction
+        self.tool._v_catalogs_by_type = (None, {'SimpleType': []})
+        catalogs = self.tool.getCatalogsByType('SimpleType')
+        self.assertEqual([c.getId() for c in catalogs], ['zope_catalog'])
+
+    def test_values_shared(self):
+        from Products.Archetypes.indexing import processQueue
+        self.tool.setCatalogsByType('SimpleType',
+                                    ['portal_catalog', 'zope_catalog'])
+        before = self.tool.getIndexableMemoStats()
+        inst = makeContent(self.portal,
+                           portal_type='SimpleType',
+                           id='simple_type')
+        processQueue()
+        after = self.tool.getIndexableMemoStats()
+        # getId is asked by both catalogs, but only computed once
+        self.assertTrue(after['reused'] > before['reused'])
+        for catalog in (self.pc, self.zc):
+            results = catalog.searchResults(dict(getId='simple_type'))
+            self.assertEqual(len(results), 1)
+            self.assertEqual(results[0].getObject(), inst)
+
+    def test_memoized_indexable(self):
+        from Products.Archetypes.indexing import IndexableMemo
+        from Products.Archetypes.indexing import volatileIndexable
+        from Products.Archetypes.indexing import _volatile
+        inst = makeContent(self.portal,
+                           portal_type='SimpleType',
+                           id='simple_type')
+        volatileIndexable('getPhysicalPath')
+        memo = IndexableMemo()
+        try:
+            for catalog in (self.pc, self.zc):
+                indexable = memo.wrap(inst, catalog)
+                self.assertEqual(indexable.getId(), 'simple_type')
+                self.assertRaises(AttributeError, getattr, indexable,
+                                  'notAnAttribute')
+                self.assertEqual(indexable.getPhysicalPath(),
+                                 inst.getPhysicalPath())
+        finally:
+            _volatile.discard('getPhysicalPath')
+        self.assertEqual(memo.computed, 2)
+        self.assertEqual(memo.reused, 2)
+        self.assertEqual(sorted(k[1] for k in memo.values),
+                         ['getId', 'notAnAttribute'])
+
+
+class IndexQueueTest(ATSiteTestCase):
+
+    def afterSetUp(self):
+        self.setRoles(['Manager'])
+        self.ct = getToolByName(self.portal, 'portal_catalog')
+        self.inst = makeContent(self.portal, portal_type='SimpleType',
+                                id='simple_type')
+        self.path = '/'.join(self.inst.getPhysicalPath())
+
+    def test_search_processes_queue(self):
+        from Products.Archetypes.indexing import getQueue
+        self.assertEqual(len(self.ct(getId='simple_type')), 1)
+        self.assertEqual(getQueue().get(self.path), None)
+
+    def test_reads_process_queue(self):
+        from Products.Archetypes.indexing import getQueue
+        self.assertNotEqual(self.ct.getrid(self.path), None)
+        self.assertEqual(getQueue().get(self.path), None)
+        self.inst.setTitle('Mosquito')
+        self.inst.reindexObject()
+        self.failUnless('Mosquito' in self.ct.uniqueValuesFor('Title'))
+        self.assertEqual(
+            self.ct.getMetadataForUID(self.path)['Title'], 'Mosquito')
+
+    def test_merged(self):
+        from Products.Archetypes.indexing import getQueue, REINDEX
+        queue = getQueue()
+        queue.process()
+        self.inst.reindexObject(idxs=['Title'])
+        self.inst.reindexObject(idxs=['Title', 'Description'])
+        self.assertEqual(queue.get(self.path)[0], REINDEX)
+        self.assertEqual(queue.get(self.path)[2], ['Title', 'Description'])
+        self.inst.reindexObject()
+        self.assertEqual(queue.get(self.path)[2], [])
+        self.assertEqual(queue.process(), 1)
+
+    def test_cancelled(self):
+        from Products.Archetypes.indexing import getQueue, UNINDEX
+        self.portal.manage_delObjects(['simple_type'])
+        self.assertEqual(getQueue().get(self.path)[0], UNINDEX)
+        self.assertEqual(len(self.ct(getId='simple_type')), 0)
+
+    def test_immediate(self):
+        from Products.Archetypes import config
+        from Products.Archetypes.indexing import getQueue
+        getQueue().process()
+        config.QUEUE_INDEXING = False
+        try:
+            self.inst.setTitle('Mosquito')
+            self.inst.reindexObject()
+            self.assertEqual(len(getQueue()), 0)
+        finally:
+            config.QUEUE_INDEXING = True
+        self.assertEqual(len(self.ct(Title='Mosquito')), 1)
+
+
+class AsyncIndexingTest(ATSiteTestCase):
+
+    def afterSetUp(self):
+        self.setRoles(['Manager'])
+        self.ct = getToolByName(self.portal, 'portal_catalog')
+        self.tool = self.portal.archetype_tool
+        self.tool.setAsyncCatalogs(['portal_catalog', 'uid_catalog'])
+
+    def test_lag(self):
+        self.assertEqual(self.tool.getAsyncCatalogs(), ('portal_catalog', ))
+        inst = makeContent(self.portal, portal_type='SimpleType',
+                           id='simple_type')
+        self.assertEqual(len(self.ct(getId='simple_type')), 0)
+        # the uid catalog is up to date
+        uc = getToolByName(self.portal, 'uid_catalog')
+        self.assertEqual(uc.resolveUID(inst.UID()), inst)
+        self.assertTrue(len(self.tool.getIndexingQueue()) > 0)
+
+        self.assertTrue(self.tool.drainIndexingQueue() > 0)
+        self.assertEqual(len(self.tool.getIndexingQueue()), 0)
+        self.assertEqual(len(self.ct(getId='simple_type')), 1)
+
+        self.portal.manage_delObjects(['simple_type'])
+        self.assertEqual(len(self.ct(getId='simple_type')), 1)
+        self.tool.drainIndexingQueue()
+        self.assertEqual(len(self.ct(getId='simple_type')), 0)
+
+    def test_lag_tolerance(self):
+        from Products.Archetypes.indexing import UNINDEX
+        queue = self.tool.getIndexingQueue()
+        saved = config.ASYNC_INDEXING_MAX_LENGTH
+        config.ASYNC_INDEXING_MAX_LENGTH = 0
+        try:
+            queue.put('/nowhere', UNINDEX, (), ('portal_catalog', ))
+            self.assertTrue(queue.lagging(0))
+            inst = makeContent(self.portal, portal_type='SimpleType',
+                               id='simple_type')
+            # cataloged right away while the queue lags
+            self.assertEqual(len(self.ct(getId='simple_type')), 1)
+        finally:
+            config.ASYNC_INDEXING_MAX_LENGTH = saved
+        # a stale unindex doesn't remove the object cataloged since
+        path = '/'.join(inst.getPhysicalPath())
+        queue.put(path, UNINDEX, (), ('portal_catalog', ))
+        self.tool.drainIndexingQueue()
+        self.assertEqual(len(self.ct(getId='simple_type')), 1)
+        self.assertEqual(queue.age(), 0)
+
+
+class SecurityReindexTest(ATSiteTestCase):
+
+    def afterSetUp(self):
+        self.setRoles(['Manager'])
+        self.ct = getToolByName(self.portal, 'portal_catalog')
+        self.folder = makeContent(self.portal, portal_type='SimpleFolder',
+                                  id='secured')
+        for i in range(5):
+            makeContent(self.folder, portal_type='SimpleType',
+                        id='doc%s' % i)
+        self.folder.manage_setLocalRoles('someuser', ['Manager'])
+        self._saved = (config.SECURITY_REINDEX_BATCH_SIZE,
+                       config.SECURITY_REINDEX_LIMIT)
+        config.SECURITY_REINDEX_BATCH_SIZE = 2
+
+    def beforeTearDown(self):
+        (config.SECURITY_REINDEX_BATCH_SIZE,
+         config.SECURITY_REINDEX_LIMIT) = self._saved
+
+    def found(self):
+        return len(self.ct.unrestrictedSearchResults(
+            allowedRolesAndUsers='user:someuser'))
+
+    def test_batches(self):
+        self.assertEqual(self.found(), 0)
+        self.assertEqual(self.folder.reindexObjectSecurity(), 6)
+        self.assertEqual(self.found(), 6)
+
+    def test_skip_self(self):
+        self.assertEqual(self.folder.reindexObjectSecurity(skip_self=True), 5)
+        self.assertEqual(self.found(), 5)
+
+    def test_deferred(self):
+        config.SECURITY_REINDEX_LIMIT = 2
+        self.assertEqual(self.folder.reindexObjectSecurity(), 2)
+        self.assertEqual(self.found(), 2)
+        tool = self.portal.archetype_tool
+        self.assertEqual(len(tool.getIndexingQueue()), 4)
+        # like the objects updated right away, without their metadata
+        records = tool.getIndexingQueue()._records.values()
+        self.assertEqual([r[4] for r in records], [0] * 4)
+        tool.drainIndexingQueue()
+        self.assertEqual(self.found(), 6)
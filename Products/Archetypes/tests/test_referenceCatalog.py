@@ -37,6 +37,7 @@ from Products.Archetypes.tests.utils import makeContent
 
 from Products.Archetypes import config
 from Products.Archetypes.references import HoldingReference, CascadeReference
+from Products.Archetypes.exceptions import ReferenceException
 from OFS.ObjectManager import BeforeDeleteException
 import transaction
 
@@ -252,6 +253,33 @@ class ReferenceCatalogTests(ATSiteTestCase):
         assert len(rc.getReferences(uid2)) == 0
         assert len(rc.getBackReferences(uid2)) == 0
 
+    def test_bulk_references(self):
+        rc = getattr(self.portal, config.REFERENCE_CATALOG)
+        uc = getattr(self.portal, config.UID_CATALOG)
+
+        source = makeContent(self.folder, portal_type='Fact', id='source')
+        targets = [makeContent(self.folder, portal_type='Fact', id='t%s' % i)
+                   for i in range(4)]
+        uids = [t.UID() for t in targets]
+
+        added = rc.addReferences(source, [targets[0]] + uids[1:] + uids[:1],
+                                 'example')
+        self.assertEqual(len(added), 4)
+        self.assertEqual(set(source.getRefs('example')), set(targets))
+        for ref in added:
+            self.assertTrue(uc.getrid(ref._getURL()) is not None)
+            self.assertTrue(rc.getrid(ref._getURL()) is not None)
+
+        rc.deleteReferences(source, 'example', targets=uids[:2] + [targets[2]])
+        self.assertEqual(source.getRefs('example'), [targets[3]])
+        self.assertEqual(targets[0].getBRefs('example'), [])
+        self.assertEqual(len(rc(sourceUID=source.UID())), 1)
+        self.assertEqual(len(source._getReferenceAnnotations().objectIds()), 1)
+        self.verifyBrains()
+
+        self.assertRaises(ReferenceException, rc.addReferences, source,
+                          ['no-such-uid'], 'example')
+
     def test_custome_metadata(self):
         # create two objects
         # make ref from one object to the other
@@ -1,5 +1,6 @@
 from Products.CMFCore.utils import getToolByName
 
+from Products.Archetypes.exceptions import ReferenceException
 from Products.Archetypes.tests.attestcase import ATTestCase
 from Products.Archetypes.tests.utils import makeContent
 
@@ -206,3 +207,431 @@ class TestReferenceable(RefSpeedupTestMixin, ATTestCase):
         self.assertEqual(self.doc2.getRawRelated(), [self.doc1.UID()])
         self.assertEqual(self.doc2.getReferences(), [self.doc1])
         self.assertEqual(self.doc2.getRelationships(), ['related'])
+
+
+class TestAdjacency(RefSpeedupTestMixin, ATTestCase):
+
+    def adjacency(self):
+        return self.rc._getAdjacency()
+
+    def test_maintained(self):
+        adjacency = self.adjacency()
+        self.assertEqual(len(adjacency), 0)
+        self.doc1.setRelated([self.doc2.UID(), self.doc3.UID()])
+        self.assertEqual(len(adjacency), 2)
+        targets = [edge[1] for path, edge in
+                   adjacency.search(self.doc1.UID(), None, 'related')]
+        self.assertEqual(set(targets), set([self.doc2.UID(), self.doc3.UID()]))
+        self.assertEqual(adjacency.relationships(self.doc1.UID()), ['related'])
+        self.assertEqual(adjacency.backRelationships(self.doc2.UID()),
+                         ['related'])
+
+        self.doc1.setRelated([self.doc3.UID()])
+        self.assertEqual(len(adjacency), 1)
+        self.assertEqual(adjacency.search(None, self.doc2.UID()), [])
+
+    def test_rebuild(self):
+        self.doc1.setRelated([self.doc2.UID()])
+        self.doc2.setRel2([self.doc1.UID(), self.doc3.UID()])
+        before = sorted(self.adjacency().search(self.doc2.UID()))
+        self.assertEqual(self.rc.manage_rebuildAdjacency(), 3)
+        self.assertEqual(sorted(self.adjacency().search(self.doc2.UID())),
+                         before)
+
+    def test_catalog_fallback(self):
+        self.doc1.setRelated([self.doc2.UID()])
+        self.rc._catalog._adjacency = None
+        self.assertEqual(self.doc1.getReferences(), [self.doc2])
+        self.assertEqual(self.doc2.getBackReferences(), [self.doc1])
+        self.assertEqual(self.doc1.getRawRelated(), [self.doc2.UID()])
+        self.assertTrue(self.doc1.hasRelationshipTo(self.doc2, 'related'))
+        self.assertEqual(self.doc1.getRelationships(), ['related'])
+
+    def test_has_relationship(self):
+        self.doc1.setRelated([self.doc2.UID()])
+        self.assertTrue(self.doc1.hasRelationshipTo(self.doc2, 'related'))
+        self.assertTrue(self.doc1.hasRelationshipTo(self.doc2))
+        self.assertFalse(self.doc1.hasRelationshipTo(self.doc2, 'rel2'))
+        self.assertFalse(self.doc2.hasRelationshipTo(self.doc1))
+
+
+class TestLightweightReferences(RefSpeedupTestMixin, ATTestCase):
+
+    def afterSetUp(self):
+        RefSpeedupTestMixin.afterSetUp(self)
+        self.rc.lightweight_references = True
+
+    def test_stored_as_records(self):
+        self.doc1.setRelated([self.doc2.UID(), self.doc3.UID()])
+        records = self.doc1._getReferenceRecords()
+        self.assertEqual(len(records), 2)
+        self.assertEqual(len(self.rc(sourceUID=self.doc1.UID())), 0)
+        self.assertEqual(set(self.doc1.getRelated()),
+                         set([self.doc2, self.doc3]))
+        self.assertEqual(self.doc2.getBackReferences(), [self.doc1])
+        refs = self.rc.getReferences(self.doc1, 'related')
+        self.assertEqual(set([r.getTargetObject() for r in refs]),
+                         set([self.doc2, self.doc3]))
+        self.assertTrue(self.doc1.hasRelationshipTo(self.doc3, 'related'))
+
+        self.doc1.setRelated([self.doc3.UID()])
+        self.assertEqual(len(records), 1)
+        self.assertEqual(self.doc2.getBackReferences(), [])
+
+    def test_reference_class_keeps_objects(self):
+        from Products.Archetypes.references import HoldingReference
+        self.doc1.addReference(self.doc2, 'related',
+                               referenceClass=HoldingReference)
+        self.assertEqual(self.doc1._getReferenceRecords(), None)
+        self.assertEqual(len(self.rc(sourceUID=self.doc1.UID())), 1)
+
+    def test_survives_catalog_clear(self):
+        self.doc1.setRelated([self.doc2.UID()])
+        self.rc.manage_catalogClear()
+        self.assertEqual(self.doc1.getRelated(), [self.doc2])
+        self.rc.manage_rebuildAdjacency()
+        self.assertEqual(self.doc1.getRelated(), [self.doc2])
+
+    def test_delete_target(self):
+        self.doc1.setRelated([self.doc2.UID()])
+        self.portal.manage_delObjects(['doc2'])
+        self.assertEqual(self.doc1.getRelated(), [])
+        self.assertEqual(len(self.doc1._getReferenceRecords()), 0)
+
+    def test_delete_source(self):
+        self.doc1.setRelated([self.doc2.UID()])
+        self.portal.manage_delObjects(['doc1'])
+        self.assertEqual(self.doc2.getBackReferences(), [])
+        self.assertEqual(len(self.rc._getAdjacency()), 0)
+
+    def test_query_target_id(self):
+        self.doc1.setRelated([self.doc2.UID(), self.doc3.UID()])
+        brains = self.rc._queryFor(self.doc1.UID(), targetId='doc3')
+        self.assertEqual([b.targetUID for b in brains], [self.doc3.UID()])
+        self.assertEqual(brains[0].targetId, 'doc3')
+        brains = self.rc._queryFor(targetId='doc2', relationship='related')
+        self.assertEqual([b.sourceUID for b in brains], [self.doc1.UID()])
+
+    def test_query_unmerged(self):
+        self.doc1.setRelated([self.doc2.UID()])
+        self.assertRaises(ReferenceException, self.rc._queryFor,
+                          self.doc1.UID(), merge=0)
+
+
+class TestTraverse(RefSpeedupTestMixin, ATTestCase):
+
+    def afterSetUp(self):
+        RefSpeedupTestMixin.afterSetUp(self)
+        self.doc1.setRelated([self.doc2.UID()])
+        self.doc2.setRelated([self.doc3.UID()])
+        self.doc3.setRel2([self.doc1.UID()])
+        self.uids = [d.UID() for d in (self.doc1, self.doc2, self.doc3)]
+
+    def test_forward(self):
+        u1, u2, u3 = self.uids
+        self.assertEqual(list(self.rc.traverse(self.doc1, 'related')),
+                         [(u2, 1, (u1, u2))])
+        self.assertEqual(
+            list(self.rc.traverse(u1, 'related', max_depth=None)),
+            [(u2, 1, (u1, u2)), (u3, 2, (u1, u2, u3))])
+        # the cycle back to doc1 is not followed
+        self.assertEqual(
+            [uid for uid, depth, path in
+             self.rc.traverse(u1, max_depth=5)], [u2, u3])
+
+    def test_backward(self):
+        u1, u2, u3 = self.uids
+        self.assertEqual(
+            list(self.rc.traverse(u3, 'related', direction='backward',
+                                  max_depth=2)),
+            [(u2, 1, (u3, u2)), (u1, 2, (u3, u2, u1))])
+        both = list(self.rc.traverse(u1, direction='both'))
+        self.assertEqual(set([uid for uid, depth, path in both]),
+                         set([u2, u3]))
+
+    def test_limit_and_resolve(self):
+        u1, u2, u3 = self.uids
+        self.assertEqual(len(list(self.rc.traverse(u1, max_depth=None,
+                                                   limit=1))), 1)
+        resolved = list(self.rc.traverse(u1, max_depth=None, resolve=True))
+        self.assertEqual([obj for obj, depth, path in resolved],
+                         [self.doc2, self.doc3])
+        self.assertRaises(ValueError, self.rc.traverse, u1,
+                          direction='sideways')
+
+
+class TestSearchReferences(RefSpeedupTestMixin, ATTestCase):
+
+    def test_search(self):
+        self.doc1.setRelated([self.doc2.UID(), self.doc3.UID()])
+        brains = self.rc.searchReferences(self.doc1, 'related',
+                                          sort_on='getId')
+        self.assertEqual([b.getId for b in brains], ['doc2', 'doc3'])
+        brains = self.rc.searchReferences(self.doc1, 'related',
+                                          {'getId': 'doc3'})
+        self.assertEqual([b.getObject() for b in brains], [self.doc3])
+        brains = self.doc3.searchBRefs('related', portal_type='DDocument')
+        self.assertEqual([b.getObject() for b in brains], [self.doc1])
+
+    def test_no_references(self):
+        self.assertEqual(len(self.rc.searchReferences(self.doc1)), 0)
+        self.assertEqual(len(self.doc1.searchBRefs('related')), 0)
+
+
+class TestLazyReferences(RefSpeedupTestMixin, ATTestCase):
+
+    def test_lazy(self):
+        self.doc1.setRelated([self.doc2.UID(), self.doc3.UID()])
+        refs = self.doc1.getRefs('related')
+        self.assertEqual(len(refs), 2)
+        self.assertEqual(refs._objects, {})
+        first = refs[0]
+        self.assertEqual(len(refs._objects), 1)
+        self.assertTrue(first in (self.doc2, self.doc3))
+        self.assertEqual(set(refs), set([self.doc2, self.doc3]))
+        self.assertEqual(refs[:1], [first])
+
+    def test_memo(self):
+        self.doc1.setRelated([self.doc2.UID()])
+        refs = self.doc1.getRefs('related')
+        self.assertEqual(refs, [self.doc2])
+        again = self.doc1.getRefs('related')
+        self.assertTrue(again._objects is refs._objects)
+
+        # changing references forgets what was remembered
+        self.doc1.setRelated([self.doc3.UID()])
+        self.assertEqual(self.doc1.getRefs('related'), [self.doc3])
+        self.assertEqual(self.doc3.getBRefs('related'), [self.doc1])
+
+    def test_mutation(self):
+        self.doc1.setRelated([self.doc2.UID()])
+        refs = self.doc1.getRefs('related')
+        refs.append(self.doc3)
+        self.assertEqual(refs, [self.doc2, self.doc3])
+        self.assertEqual(self.doc1.getRefs('related'), [self.doc2])
+
+
+class TestUIDPathCache(RefSpeedupTestMixin, ATTestCase):
+
+    def afterSetUp(self):
+        RefSpeedupTestMixin.afterSetUp(self)
+        from Products.Archetypes.uidcache import uid_path_cache
+        self.cache = uid_path_cache
+        self.cache.clear()
+        self.uc = getToolByName(self.portal, 'uid_catalog')
+
+    def test_hits_and_misses(self):
+        uid = self.doc1.UID()
+        self.assertEqual(self.uc.resolveUID(uid), self.doc1)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.rc.lookupObject(uid), self.doc1)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.uc.getUIDCacheStats()['size'], 1)
+        self.assertEqual(self.uc.resolveUID('missing'), None)
+
+    def test_rename(self):
+        import transaction
+        uid = self.doc1.UID()
+        self.uc.resolveUID(uid)
+        transaction.savepoint(optimistic=True)
+        self.portal.manage_renameObject('doc1', 'renamed')
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.uc.resolveUID(uid).getId(), 'renamed')
+
+    def test_stale_path(self):
+        uid = self.doc1.UID()
+        self.cache.set(self.uc._uidCacheScope(), uid, 'doc2')
+        self.assertEqual(self.uc.resolveUID(uid), self.doc1)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_abort(self):
+        import transaction
+        self.uc.resolveUID(self.doc1.UID())
+        transaction.abort()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_savepoint(self):
+        import transaction
+        self.uc.resolveUID(self.doc1.UID())
+        transaction.savepoint().rollback()
+        self.assertEqual(self.uc.resolveUID(self.doc1.UID()), self.doc1)
+
+    def test_reference_brain(self):
+        self.doc1.addReference(self.doc2, 'related')
+        brain = self.rc(sourceUID=self.doc1.UID())[0]
+        ref = brain.getObject()
+        self.assertNotEqual(ref, None)
+        self.assertEqual(ref.targetUID, self.doc2.UID())
+        self.assertEqual(len(self.cache), 0)
+
+
+class TestResolveUIDs(RefSpeedupTestMixin, ATTestCase):
+
+    def test_order_and_missing(self):
+        uc = getToolByName(self.portal, 'uid_catalog')
+        uids = [self.doc3.UID(), 'missing', self.doc1.UID(), self.doc3.UID()]
+        self.assertEqual(uc.resolveUIDs(uids),
+                         [self.doc3, None, self.doc1, self.doc3])
+        self.assertEqual(uc.resolveUIDs([]), [])
+
+    def test_nested(self):
+        uc = getToolByName(self.portal, 'uid_catalog')
+        folder = makeContent(self.portal, portal_type='SimpleFolder',
+                             id='folder')
+        inner = makeContent(folder, portal_type='DDocument', id='inner')
+        result = uc.resolveUIDs([inner.UID(), folder.UID(), self.doc2.UID()])
+        self.assertEqual([o.getPhysicalPath() for o in result],
+                         [inner.getPhysicalPath(), folder.getPhysicalPath(),
+                          self.doc2.getPhysicalPath()])
+
+    def test_references(self):
+        self.doc1.setRelated([self.doc2.UID(), self.doc3.UID()])
+        refs = self.rc.getReferences(self.doc1, 'related')
+        self.assertEqual(set([r.getTargetObject() for r in refs]),
+                         set([self.doc2, self.doc3]))
+        self.assertEqual(set(self.doc1.getRelated()),
+                         set([self.doc2, self.doc3]))
+
+
+class TestRebuildReferences(RefSpeedupTestMixin, ATTestCase):
+
+    def test_verify_and_rebuild(self):
+        self.doc1.setRelated([self.doc2.UID(), self.doc3.UID()])
+        self.doc2.setRelated([self.doc3.UID()])
+        stats = self.rc.rebuildReferences(verify=True)
+        self.assertEqual(stats['references'], 3)
+        self.assertEqual(stats['missing'] + stats['changed'] +
+                         stats['extra'], 0)
+
+        self.rc.manage_catalogClear()
+        stats = self.rc.rebuildReferences(verify=True)
+        self.assertEqual(stats['missing'], 3)
+        self.assertEqual(self.doc1.getRefs('related'), [])
+
+        stats = self.rc.rebuildReferences(chunk_size=2)
+        self.assertEqual(stats['references'], 3)
+        self.assertEqual(self.rc._rebuild_state, None)
+        self.assertEqual(set(self.doc1.getRefs('related')),
+                         set([self.doc2, self.doc3]))
+        self.assertEqual(self.rc.rebuildReferences(verify=True)['missing'], 0)
+
+    def test_resume(self):
+        from Persistence import PersistentMapping
+        self.doc1.setRelated([self.doc2.UID()])
+        self.doc3.setRelated([self.doc2.UID()])
+        self.rc.manage_catalogClear()
+        # pretend an earlier rebuild stopped after doc1
+        self.rc._rebuild_state = PersistentMapping(
+            cursor=('doc1', ), processed=1)
+        stats = self.rc.rebuildReferences()
+        self.assertEqual(stats['references'], 1)
+        self.assertEqual(self.doc1.getRefs('related'), [])
+        self.assertEqual(self.doc3.getRefs('related'), [self.doc2])
+
+    def test_missing_from_uid_catalog(self):
+        self.doc1.setRelated([self.doc2.UID()])
+        uc = getToolByName(self.portal, 'uid_catalog')
+        uc.uncatalog_object(self.doc1._getURL())
+        self.rc.manage_catalogClear()
+        stats = self.rc.rebuildReferences()
+        self.assertEqual(stats['references'], 1)
+        self.assertEqual(len(self.rc(sourceUID=self.doc1.UID())), 1)
+
+
+class TestRebuildUIDCatalog(RefSpeedupTestMixin, ATTestCase):
+
+    def afterSetUp(self):
+        RefSpeedupTestMixin.afterSetUp(self)
+        self.uc = getToolByName(self.portal, 'uid_catalog')
+
+    def test_empty_copy(self):
+        live = self.uc._catalog
+        copy = self.uc._emptyCopy(live)
+        self.assertEqual(copy.names, live.names)
+        for name, index in live.indexes.items():
+            fresh = copy.indexes[name]
+            self.assertEqual(fresh.numObjects(), 0)
+            self.assertEqual(fresh.getIndexSourceNames(),
+                             index.getIndexSourceNames())
+        self.assertEqual(len(self.uc(UID=self.doc1.UID())), 1)
+
+    def test_rebuild(self):
+        live = self.uc._catalog
+        uid = self.doc2.UID()
+        self.uc.uncatalog_object(self.doc2._getURL())
+        self.assertEqual(len(self.uc(UID=uid)), 0)
+
+        count = self.uc.rebuildCatalog(chunk_size=2)
+        self.assertTrue(count >= 3)
+        self.assertFalse(self.uc._catalog is live)
+        self.assertEqual(self.uc._rebuild_state, None)
+        self.assertEqual(self.uc._catalog._shadow, None)
+        self.assertEqual(self.uc(UID=uid)[0].getObject(), self.doc2)
+        self.assertEqual(self.uc.resolveUID(self.doc1.UID()), self.doc1)
+
+    def test_walk_resume(self):
+        walked = [path for path, obj in self.uc._walk(self.portal, ())]
+        self.assertEqual(walked, sorted(walked))
+        self.assertTrue(('doc2', ) in walked)
+        resumed = [path for path, obj in
+                   self.uc._walk(self.portal, (), ('doc2', ))]
+        self.assertEqual(resumed, [p for p in walked if p > ('doc2', )])
+
+
+class TestConsistencyChecker(RefSpeedupTestMixin, ATTestCase):
+
+    def afterSetUp(self):
+        RefSpeedupTestMixin.afterSetUp(self)
+        self.uc = getToolByName(self.portal, 'uid_catalog')
+
+    def check(self, repair=False):
+        from Products.Archetypes.consistency import ConsistencyChecker
+        checker = ConsistencyChecker(self.portal, {}, repair=repair,
+                                     chunk_size=2)
+        while checker.step():
+            pass
+        return checker.state['counts']
+
+    def test_consistent(self):
+        self.doc1.setRelated([self.doc2.UID()])
+        counts = self.check()
+        self.assertEqual(counts['stale_uids'] + counts['stale_references'] +
+                         counts['dangling_references'] +
+                         counts['missing_uids'], 0)
+        self.assertTrue(counts['checked'] > 0)
+
+    def test_repair(self):
+        self.doc1.setRelated([self.doc2.UID(), self.doc3.UID()])
+        # doc2 lost from the uid catalog, a stale entry for doc1
+        self.uc.uncatalog_object(self.doc2._getURL())
+        self.uc.catalog_object(self.doc1, 'gone')
+        # doc3 removed behind the catalogs' back
+        self.portal._delObject('doc3', suppress_events=True)
+
+        counts = self.check(repair=True)
+        self.assertEqual(counts['stale_uids'], 2)
+        self.assertEqual(counts['missing_uids'], 1)
+        self.assertEqual(counts['dangling_references'], 1)
+        self.assertEqual(counts['repaired'], 4)
+        self.assertEqual(len(self.uc(UID=self.doc2.UID())), 1)
+        self.assertEqual(self.doc1.getRefs('related'), [self.doc2])
+
+        counts = self.check()
+        self.assertEqual(counts['stale_uids'] + counts['stale_references'] +
+                         counts['dangling_references'] +
+                         counts['missing_uids'], 0)
+
+    def test_bounded_calls(self):
+        from Products.Archetypes.consistency import checkConsistency
+        tool = getToolByName(self.portal, 'archetype_tool')
+        result = checkConsistency(tool, chunk_size=1, restart=True,
+                                  commit=False)
+        self.assertFalse(result['complete'])
+        self.assertEqual(result['checked'], 1)
+        calls = 1
+        while not result['complete']:
+            result = checkConsistency(tool, max_steps=2, chunk_size=1,
+                                      commit=False)
+            calls += 1
+        self.assertTrue(calls > 2)
+        self.assertEqual(result['stale_uids'] + result['missing_uids'], 0)
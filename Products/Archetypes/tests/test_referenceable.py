@@ -413,6 +413,35 @@ class SimpleFolderReferenceableTests(ATSiteTestCase):
         self.assertEqual(len(a.getRefs('KnowsAbout')), 1)
         self.assertEqual(len(a.getRefs()), 2)
 
+    def test_referenceAnnotationsMigration(self):
+        from OFS.Folder import Folder
+        from Products.BTreeFolder2.BTreeFolder2 import BTreeFolder2Base
+        from Products.Archetypes.config import REFERENCE_ANNOTATION
+
+        a = makeContent(self.folder, portal_type='DDocument', id='a')
+        b = makeContent(self.folder, portal_type='DDocument', id='b')
+        a.addReference(b, 'KnowsAbout')
+        annotations = getattr(aq_base(a), REFERENCE_ANNOTATION)
+        self.assertTrue(isinstance(annotations, BTreeFolder2Base))
+        self.assertFalse(a._migrateReferenceAnnotations())
+
+        # Put the reference back into a pre BTree annotation folder
+        old = Folder(REFERENCE_ANNOTATION)
+        for id, ref in annotations.objectItems():
+            old._setOb(id, aq_base(ref))
+            old._objects += ({'id': id, 'meta_type': ref.meta_type}, )
+        setattr(a, REFERENCE_ANNOTATION, old)
+
+        self.assertTrue(a._migrateReferenceAnnotations())
+        annotations = getattr(aq_base(a), REFERENCE_ANNOTATION)
+        self.assertTrue(isinstance(annotations, BTreeFolder2Base))
+        self.assertEqual(len(annotations.objectIds()), 1)
+        self.assertEqual(a.getRefs('KnowsAbout'), [b])
+        ref = a.getReferenceImpl('KnowsAbout')[0]
+        self.assertEqual(ref.getTargetObject(), b)
+        a.deleteReference(b, 'KnowsAbout')
+        self.assertEqual(a.getRefs('KnowsAbout'), [])
+
     def test_multipleReferences(self):
         # If you provide updateReferences=False to addReference, it
         # will add, not replace the reference
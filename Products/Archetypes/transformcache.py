@@ -0,0 +1,120 @@
+"""A process wide cache of transformed text.
+
+BaseUnit.transform keeps the output of portal_transforms here, keyed by a
+digest of the raw data, so that an entry is valid for every ZODB connection
+and no longer found once the data changes. Besides the digest the source
+and target mimetypes, the output encoding, the url of the instance, which
+transforms rewriting links depend on, and the names and settings of the
+transforms used, see transformChain, are part of the key. That no
+transformation was possible is remembered as well.
+"""
+import threading
+from collections import OrderedDict
+
+from Acquisition import aq_base
+
+from Products.Archetypes.config import TRANSFORM_CACHE_SIZE
+
+
+class _NoTransform(object):
+
+    def __repr__(self):
+        return 'NO_TRANSFORM'
+
+# cached when portal_transforms found no way to the target mimetype
+NO_TRANSFORM = _NoTransform()
+
+
+def transformChain(transforms, orig_mt, mt):
+    """The names and settings of the transforms converting orig_mt to mt
+
+    Part of the cache key, so that the output cached is not used anymore
+    once the transforms or their settings change. Returns None if one of
+    the transforms doesn't want its output cached, by having a false
+    cacheable attribute.
+    """
+    required = getattr(aq_base(transforms), '_policies', {}).get(str(mt), ())
+    path = transforms._findPath(str(orig_mt), str(mt), list(required))
+    chain = []
+    for transform in path or ():
+        base = aq_base(transform)
+        if not getattr(base, 'cacheable', True):
+            return None
+        settings = getattr(base, '_config', None) or {}
+        chain.append((transform.name(), repr(sorted(settings.items()))))
+    return tuple(chain)
+
+
+def _cost(value):
+    if isinstance(value, basestring):
+        return len(value) + 1
+    return 1
+
+
+class TransformCache(object):
+    """LRU mapping of data digests to their transformations
+
+    The cache holds at most maxsize bytes of transformed text.
+    """
+
+    def __init__(self, maxsize=TRANSFORM_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.size = 0
+        self._data = OrderedDict()  # digest -> {key: value}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest, key):
+        with self._lock:
+            values = self._data.pop(digest, None)
+            if values is not None:
+                # move to the most recently used end
+                self._data[digest] = values
+                value = values.get(key)
+                if value is not None:
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def set(self, digest, key, value):
+        cost = _cost(value)
+        if cost > self.maxsize:
+            return
+        with self._lock:
+            values = self._data.pop(digest, {})
+            old = values.get(key)
+            if old is not None:
+                self.size -= _cost(old)
+            values[key] = value
+            self.size += cost
+            self._data[digest] = values
+            while self.size > self.maxsize:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= sum([_cost(v) for v in evicted.values()])
+
+    def invalidate(self, digest):
+        """Forget the transformations of the data with digest"""
+        with self._lock:
+            values = self._data.pop(digest, None)
+            if values:
+                self.size -= sum([_cost(v) for v in values.values()])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._data),
+                'size': self.size,
+                'maxsize': self.maxsize}
+
+    def __len__(self):
+        return len(self._data)
+
+
+transform_cache = TransformCache()
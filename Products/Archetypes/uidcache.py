@@ -0,0 +1,160 @@
+"""A process wide cache of UID to path lookups.
+
+The cache is shared by all ZODB connections, so an entry may be stale for
+the connection reading it: users of the cache must check that the object
+found at the cached path still carries the UID. Entries are dropped when
+objects are moved, renamed or removed, and entries added during a
+transaction which is aborted are dropped as well.
+"""
+import threading
+from collections import OrderedDict
+
+import transaction
+from zope.interface import implements
+from transaction.interfaces import ISavepointDataManager
+from plone.uuid.interfaces import IUUID
+
+from Products.Archetypes.config import UID_PATH_CACHE_SIZE
+
+
+class UIDPathCache(object):
+    """Bounded LRU mapping of UIDs to paths relative to the portal
+
+    Paths are stored per scope, which tells apart the uid catalogs of
+    several sites or databases served by the same process.
+    """
+
+    def __init__(self, maxsize=UID_PATH_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # uid -> {scope: path}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, scope, uid):
+        with self._lock:
+            paths = self._data.pop(uid, None)
+            if paths is None:
+                return None
+            # move to the most recently used end
+            self._data[uid] = paths
+            return paths.get(scope)
+
+    def set(self, scope, uid, path):
+        if not self.maxsize:
+            return
+        try:
+            self._joinTransaction().keys.add((scope, uid))
+        except ValueError:
+            # the transaction is committing or aborting already
+            return
+        with self._lock:
+            paths = self._data.pop(uid, {})
+            paths[scope] = path
+            self._data[uid] = paths
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, uid):
+        """Forget the paths of uid"""
+        with self._lock:
+            self._data.pop(uid, None)
+
+    def evict(self, keys):
+        """Forget the paths of (scope, uid) pairs"""
+        with self._lock:
+            for scope, uid in keys:
+                paths = self._data.get(uid)
+                if paths is not None:
+                    paths.pop(scope, None)
+                    if not paths:
+                        del self._data[uid]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._data),
+                    'maxsize': self.maxsize}
+
+    def __len__(self):
+        return len(self._data)
+
+    def _joinTransaction(self):
+        txn = transaction.get()
+        dm = getattr(self._local, 'dm', None)
+        if dm is None or dm.transaction is not txn:
+            dm = AbortEviction(self, txn)
+            txn.join(dm)
+            self._local.dm = dm
+        return dm
+
+
+class AbortEviction(object):
+    """Data manager dropping the entries added during an aborted transaction
+    """
+    implements(ISavepointDataManager)
+
+    def __init__(self, cache, txn):
+        self.cache = cache
+        self.transaction = txn
+        # the manager the transaction was begun with, which isn't
+        # necessarily the thread's default one
+        self.transaction_manager = txn._manager
+        self.keys = set()
+
+    def abort(self, txn):
+        self.cache.evict(self.keys)
+        self.keys.clear()
+
+    tpc_abort = abort
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        pass
+
+    def tpc_finish(self, txn):
+        self.keys.clear()
+
+    def sortKey(self):
+        return 'Products.Archetypes.uidcache'
+
+    def savepoint(self):
+        # entries added after the savepoint stay until the transaction
+        # ends, a rollback only leaves them to be checked when read
+        return NoRollback()
+
+
+class NoRollback(object):
+
+    def rollback(self):
+        pass
+
+
+uid_path_cache = UIDPathCache()
+
+
+def invalidateMovedUID(obj, event):
+    """Subscriber forgetting the cached path of moved or removed objects"""
+    uid = IUUID(obj, None)
+    if uid is not None:
+        uid_path_cache.invalidate(uid)
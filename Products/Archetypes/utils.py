@@ -882,3 +882,164 @@ def isFactoryContained(obj):
         return False
     meta_type = getattr(aq_base(parent), 'meta_type', '')
     return meta_type == 'TempFolder'
+
+
+security.declarePrivate('LazyReferences')
+class LazyReferences(list):
+    """A list of referenced objects, resolved from their UIDs on demand
+
+    len() comes from the UIDs without loading anything. Indexing and
+    slicing resolve only the requested items and iteration resolves a few
+    items at a time. Objects that can't be resolved are None, as before.
+
+    resolve is called with a list of UIDs and returns the objects in the
+    same order. The first change made to the list resolves everything,
+    from then on it behaves like a plain list.
+    """
+
+    batch_size = 10
+
+    def __init__(self, uids, resolve, cache=None):
+        list.__init__(self)
+        self._uids = list(uids)
+        self._resolve = resolve
+        # maps the index of a uid to its object, may be shared
+        self._objects = cache if cache is not None else {}
+
+    def _get(self, indexes):
+        objects = self._objects
+        missing = [i for i in indexes if i not in objects]
+        if missing:
+            resolved = self._resolve([self._uids[i] for i in missing])
+            objects.update(zip(missing, resolved))
+        return [objects[i] for i in indexes]
+
+    def _materialize(self):
+        if self._uids is not None:
+            objects = self._get(range(len(self._uids)))
+            self._uids = None
+            list.extend(self, objects)
+
+    def __len__(self):
+        if self._uids is None:
+            return list.__len__(self)
+        return len(self._uids)
+
+    def __nonzero__(self):
+        return bool(len(self))
+
+    def __getitem__(self, index):
+        if self._uids is None:
+            return list.__getitem__(self, index)
+        if isinstance(index, slice):
+            return self._get(range(*index.indices(len(self._uids))))
+        if index < 0:
+            index += len(self._uids)
+        if not 0 <= index < len(self._uids):
+            raise IndexError('list index out of range')
+        return self._get([index])[0]
+
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(max(0, i), max(0, j)))
+
+    def __iter__(self):
+        if self._uids is None:
+            for obj in list.__iter__(self):
+                yield obj
+            return
+        size = self.batch_size
+        for start in xrange(0, len(self._uids), size):
+            for obj in self._get(range(start, min(start + size,
+                                                  len(self._uids)))):
+                yield obj
+
+    def __reversed__(self):
+        return reversed(self[:])
+
+    def __contains__(self, obj):
+        for item in self:
+            if item == obj:
+                return True
+        return False
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple)):
+            return NotImplemented
+        return self[:] == list(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return repr(self[:])
+
+    def __add__(self, other):
+        return self[:] + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self[:]
+
+    def __mul__(self, n):
+        return self[:] * n
+
+    __rmul__ = __mul__
+
+    def __reduce__(self):
+        # copies and pickles are plain lists
+        return list, (self[:], )
+
+    def count(self, obj):
+        return self[:].count(obj)
+
+    def index(self, obj, *args):
+        return self[:].index(obj, *args)
+
+    def _mutator(name):
+        method = getattr(list, name)
+
+        def mutate(self, *args):
+            self._materialize()
+            return method(self, *args)
+        mutate.__name__ = name
+        return mutate
+
+    append = _mutator('append')
+    extend = _mutator('extend')
+    insert = _mutator('insert')
+    pop = _mutator('pop')
+    remove = _mutator('remove')
+    reverse = _mutator('reverse')
+    sort = _mutator('sort')
+    __setitem__ = _mutator('__setitem__')
+    __delitem__ = _mutator('__delitem__')
+    __setslice__ = _mutator('__setslice__')
+    __delslice__ = _mutator('__delslice__')
+    __iadd__ = _mutator('__iadd__')
+    __imul__ = _mutator('__imul__')
+    del _mutator
+
+
+REFERENCES_MEMO = '_at_references_memo'
+
+
+security.declarePrivate('referencesMemo')
+def referencesMemo(context):
+    """A dict for remembering reference lookups during one request
+
+    Returns None if there is no request.
+    """
+    other = getattr(getattr(context, 'REQUEST', None), 'other', None)
+    if not isinstance(other, dict):
+        return None
+    return other.setdefault(REFERENCES_MEMO, {})
+
+
+security.declarePrivate('invalidateReferencesMemo')
+def invalidateReferencesMemo(context):
+    """Forget the reference lookups made during the current request"""
+    other = getattr(getattr(context, 'REQUEST', None), 'other', None)
+    if isinstance(other, dict):
+        other.pop(REFERENCES_MEMO, None)